@@ -5,11 +5,68 @@ PWD=`pwd`
 export PYTHONPATH=$PWD/chat
 
 #set name, host and port of local etcd storage
+#several etcd hosts are comma separated, e.g. etcd1,etcd2:2380
+#with STORAGE=sqlite, STORAGE_HOST is path of database file
 export STORAGE=etcd
 export STORAGE_HOST=localhost
 export STORAGE_PORT=2379
+#number of etcd clients shared by server threads
+export STORAGE_POOL_SIZE=1
+#with STORAGE=sharded, type of shard storages; shards in STORAGE_HOST
+#are separated by semicolons, e.g. "etcd1,etcd2;etcd3"
+export STORAGE_SHARD_STORAGE=etcd
+#comma separated storage wrappers: user_cache, metrics
+export STORAGE_WRAPPERS=
+#codec of values written to storage: json or protobuf, both are readable
+export STORAGE_CODEC=json
+#seconds messages are kept if not read and most messages kept per user,
+#messages are kept until read if empty
+export STORAGE_MESSAGE_TTL=
+export STORAGE_MAILBOX_SIZE=
+#seconds between compactions of storage, no compaction if empty
+export STORAGE_COMPACTION_INTERVAL=60
+#1 to compact etcd history on every compaction, it is cluster-wide,
+#so leave it empty if etcd auto-compaction is on or etcd is shared
+export STORAGE_COMPACT_HISTORY=
 
 #set host name and port for server
 export SERVER_HOST=localhost
 export SERVER_PORT=50051
+#address other server nodes reach this one at, e.g. localhost:50051;
+#subscribers are registered in storage only if it is set
+export SERVER_NODE_ADDRESS=
 
+#optional delivery limits for every subscriber stream, not limited if empty
+export SERVER_SUBSCRIBE_BATCH_SIZE=100
+export SERVER_SUBSCRIBE_MESSAGES_PER_SECOND=
+export SERVER_SUBSCRIBE_BYTES_PER_SECOND=
+#bytes of messages buffered for every subscriber stream; subscriber falling
+#behind is paused and reads the rest from storage when it catches up, or
+#with disconnect policy is disconnected if it stays behind longer than
+#timeout in seconds
+export SERVER_SUBSCRIBE_BUFFER_BYTES=1048576
+export SERVER_SLOW_CONSUMER_POLICY=pause
+export SERVER_SLOW_CONSUMER_TIMEOUT=30
+
+#optional admission limits, not applied if empty: messages per second of
+#every sender and of the whole server, calls in progress per method, e.g.
+#SendMessage=64,Subscribe=1000, and storage write latency in seconds over
+#which sending is rejected
+export SERVER_SENDER_MESSAGES_PER_SECOND=
+export SERVER_GLOBAL_MESSAGES_PER_SECOND=
+export SERVER_METHOD_CONCURRENCY=
+export SERVER_SHED_STORAGE_LATENCY=
+
+#directory of write-ahead log, if set messages are acknowledged once
+#written there and saved to storage in background
+export SERVER_WAL_DIR=
+
+#port of HTTP endpoint serving Prometheus metrics on /metrics, off if empty
+export METRICS_PORT=
+
+#server mode: thread (thread pool) or aio (asyncio, for many subscribers)
+export SERVER_MODE=thread
+#number of server processes sharing SERVER_PORT, 0 for number of CPUs;
+#every worker keeps its write-ahead log in SERVER_WAL_DIR/worker-<n> and
+#serves metrics on METRICS_PORT+<n>
+export SERVER_WORKERS=1
@@ -0,0 +1,49 @@
+"""Micro-benchmark of storage codecs: encode and decode throughput
+and stored bytes per message and per user. Protobuf codec speed depends
+on protobuf runtime, which is printed first: the C one (upb or cpp) is
+faster than JSON, the pure Python one is slower.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_codecs.py -n 100000
+"""
+
+import argparse
+import time
+
+from google.protobuf.internal import api_implementation
+
+from chat_codecs import CODECS, decode_message
+from chat_storage import Message, User
+
+
+def measure(function, items) -> float:
+    """Returns items processed by function per second."""
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+def run(count: int):
+    """Prints throughput and sizes of every codec."""
+    messages = [Message(f"user_{x % 100}", f"user_{x % 37}",
+                        f"Hello, this is message number {x}!")
+                for x in range(count)]
+    user = User("user_A", "AA AAA")
+    print(f"protobuf runtime: {api_implementation.Type()}")
+    for name, codec in CODECS.items():
+        encode_rate = measure(codec.encode_message, messages)
+        values = [codec.encode_message(message) for message in messages]
+        decode_rate = measure(decode_message, values)
+        message_bytes = sum(map(len, values)) / count
+        user_bytes = len(codec.encode_user(user))
+        print(f"{name:>8}: encode {encode_rate:,.0f} msg/s, "
+              f"decode {decode_rate:,.0f} msg/s, "
+              f"{message_bytes:.1f} bytes/message, {user_bytes} bytes/user")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--count", type=int, default=100000,
+                        help="number of messages.")
+    run(parser.parse_args().count)
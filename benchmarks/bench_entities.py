@@ -0,0 +1,85 @@
+"""Micro-benchmark of message entities: memory and creation time of
+plain dataclass and slotted entity, and conversion of entity to the
+protobuf message streamed by Subscribe, built anew as it was before or
+attached to the entity by SendMessage and the protobuf codec.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_entities.py -n 100000
+"""
+
+import argparse
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+import chat_pb2
+from chat_convert import message_from_pb, message_to_pb
+from chat_storage import Message
+
+
+@dataclass(frozen=True)
+class DictMessage:
+
+    """Message entity as it was before slots, for comparison."""
+
+    login_from: str
+    login_to: str
+    body: str
+    created_at: int
+    message_id: str
+
+
+def build_pb(message) -> chat_pb2.Message:
+    """Builds protobuf message of entity, as it was before attaching."""
+    return chat_pb2.Message(
+        login_from=message.login_from, login_to=message.login_to,
+        created_at=message.created_at, body=message.body)
+
+
+def measure_entities(entity_class, fields_list):
+    """Returns entities created per second and bytes allocated per
+    entity kept, not counting its field values.
+    """
+    tracemalloc.start()
+    entities = [entity_class(*fields) for fields in fields_list]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del entities
+    start = time.perf_counter()
+    entities = [entity_class(*fields) for fields in fields_list]
+    rate = len(fields_list) / (time.perf_counter() - start)
+    return rate, allocated / len(fields_list)
+
+
+def measure_conversion(function, messages):
+    """Returns messages converted per second."""
+    start = time.perf_counter()
+    for message in messages:
+        function(message)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def run(count: int):
+    """Prints memory and creation rate of entities and conversion rate
+    of both ways to get protobuf message.
+    """
+    fields_list = [(f"user_{x % 100}", f"user_{x % 37}",
+                    f"Hello, this is message number {x}!", x,
+                    f"{x:020d}-node") for x in range(count)]
+    for entity_class in (DictMessage, Message):
+        rate, allocated = measure_entities(entity_class, fields_list)
+        print(f"{entity_class.__name__:>15}: {rate:,.0f} entities/s, "
+              f"{allocated:.0f} bytes/entity")
+    messages = [message_from_pb(chat_pb2.Message(
+        login_from=login_from, login_to=login_to, body=body))
+        for login_from, login_to, body, _, _ in fields_list]
+    for name, function in (("built", build_pb), ("attached", message_to_pb)):
+        rate = measure_conversion(function, messages)
+        print(f"{name:>15}: {rate:,.0f} protobuf messages/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--count", type=int, default=100000,
+                        help="number of messages.")
+    run(parser.parse_args().count)
@@ -0,0 +1,66 @@
+"""Benchmark of etcd round-trips per message delivered by Chat.Subscribe.
+
+Drains a queued backlog from EtcdStorage backed by an in-process etcd
+stand-in, acknowledging messages one by one and in transactions.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_etcd_ack.py -n 10000
+"""
+
+import argparse
+import time
+from unittest import mock
+
+from chat_server import Chat
+from chat_storage import Message, Storage
+from fake_etcd import FakeEtcdClient
+from storages.etcd_storage import EtcdStorage
+
+
+class PerMessageAckEtcdStorage(EtcdStorage):
+
+    """EtcdStorage acknowledging every message with its own delete."""
+
+    delete_user_messages = Storage.delete_user_messages
+
+
+def drain(storage_class, count: int, batch_size: int):
+    """Queues count messages, drains them and returns round-trips
+    spent on delivery and elapsed time.
+    """
+    client = FakeEtcdClient()
+    with mock.patch("storages.etcd_storage.etcd3.client", return_value=client):
+        storage = storage_class("localhost", 2379)
+    for x in range(count):
+        storage.create_message(Message("userA", "userB", f"message {x}"))
+    client.round_trips = 0
+    context = mock.Mock()
+    subscription = Chat(storage, subscribe_batch_size=batch_size).Subscribe(
+        mock.Mock(login="userB"), context)
+    start = time.perf_counter()
+    for x in range(count):
+        next(subscription)
+    context.add_callback.call_args[0][0]()
+    list(subscription)
+    elapsed = time.perf_counter() - start
+    assert not storage.get_user_messages("userB")
+    return client.round_trips, elapsed
+
+
+def run(count: int, batch_size: int):
+    """Prints round-trips per delivered message for both ack modes."""
+    for name, storage_class in [("per message", PerMessageAckEtcdStorage),
+                                ("transaction", EtcdStorage)]:
+        round_trips, elapsed = drain(storage_class, count, batch_size)
+        print(f"{name}: {round_trips} round-trips for {count} messages, "
+              f"{round_trips / count:.3f} per message, {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--count", type=int, default=10000,
+                        help="number of queued messages.")
+    parser.add_argument("-b", "--batch-size", type=int, default=100,
+                        help="subscribe acknowledgement batch size.")
+    args = parser.parse_args()
+    run(args.count, args.batch_size)
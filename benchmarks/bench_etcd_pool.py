@@ -0,0 +1,79 @@
+"""Benchmark of concurrent Chat.SendMessage calls over EtcdStorage
+with different client pool sizes.
+
+Every stand-in client serves one call at a time with given latency,
+as a single etcd connection does when it is the bottleneck, while all
+clients share one key space.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_etcd_pool.py -n 2000 -t 16
+"""
+
+import argparse
+import threading
+import time
+from concurrent import futures
+from unittest import mock
+
+import chat_pb2
+from chat_server import Chat
+from fake_etcd import FakeEtcdClient
+from storages.etcd_storage import EtcdStorage
+
+
+class FakeEtcdConnection:
+
+    """Serializes calls to shared stand-in client and adds latency."""
+
+    def __init__(self, client: FakeEtcdClient, latency: float):
+        self._client = client
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.transactions = client.transactions
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def call(*args, **kwargs):
+            with self._lock:
+                time.sleep(self._latency)
+                return method(*args, **kwargs)
+        return call
+
+
+def send(pool_size: int, count: int, threads: int, latency: float) -> float:
+    """Sends count messages from threads and returns messages per second."""
+    client = FakeEtcdClient()
+    with mock.patch("storages.etcd_storage.etcd3.client",
+                    side_effect=lambda host, port:
+                    FakeEtcdConnection(client, latency)):
+        storage = EtcdStorage("localhost", 2379, pool_size=pool_size)
+    chat = Chat(storage)
+    request = chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+        login_from="userA", login_to="userB", body="Hello!"))
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda x: chat.SendMessage(request, None),
+                          range(count)))
+    elapsed = time.perf_counter() - start
+    assert len(storage.get_user_messages("userB")) == count
+    return count / elapsed
+
+
+def run(count: int, threads: int, latency: float):
+    """Prints SendMessage throughput for growing pool sizes."""
+    for pool_size in (1, 2, 4, 8):
+        rate = send(pool_size, count, threads, latency)
+        print(f"pool size {pool_size}: {rate:,.0f} msg/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--count", type=int, default=2000,
+                        help="number of messages.")
+    parser.add_argument("-t", "--threads", type=int, default=16,
+                        help="number of concurrent senders.")
+    parser.add_argument("-l", "--latency", type=float, default=0.001,
+                        help="seconds of every etcd round-trip.")
+    args = parser.parse_args()
+    run(args.count, args.threads, args.latency)
@@ -0,0 +1,249 @@
+"""Load test of chat server: starts server in-process over memory storage,
+EtcdStorage backed by in-process etcd stand-in or SQLite database, connects simulated
+senders and subscribers over gRPC and reports messages per second,
+delivery latency percentiles, CPU time and memory of the process
+while messages are sent and delivered.
+
+Every sender sends messages to random subscribers, message body keeps
+time it was sent, so subscribers measure latency from send to delivery.
+Client and server share the process, CPU time includes both of them.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_load.py --senders 100 \
+--subscribers 1000 --messages 20 -o results.json
+Compare with results saved before:
+    PYTHONPATH=chat python benchmarks/bench_load.py --compare old.json new.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import grpc
+
+import chat_ext_grpc
+import chat_pb2
+from chat_aio_server import create_aio_server
+from chat_aio_storage import AsyncStorageAdapter
+from chat_server import create_server
+from fake_etcd import FakeEtcdClient
+from storages.etcd_storage import EtcdStorage
+from storages.memory_storage import MemoryStorage
+from storages.sqlite_storage import SqliteStorage
+
+STORAGES = ("memory", "etcd", "sqlite")
+MODES = ("thread", "aio")
+# Results compared by --compare, higher is better for the first ones.
+HIGHER_IS_BETTER = ("messages_per_second",)
+LOWER_IS_BETTER = ("latency_p50_ms", "latency_p99_ms", "cpu_seconds",
+                   "max_rss_mb")
+
+
+def free_port() -> int:
+    """Returns port free on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def create_storage(name: str, latency: float):
+    """Returns memory storage, EtcdStorage over etcd stand-in or
+    SqliteStorage with database in temporary directory.
+    """
+    if name == "memory":
+        return MemoryStorage()
+    if name == "sqlite":
+        return SqliteStorage(os.path.join(tempfile.mkdtemp(), "chat.db"))
+    client = FakeEtcdClient(latency)
+    with mock.patch("storages.etcd_storage.etcd3.client", return_value=client):
+        return EtcdStorage("localhost", 2379)
+
+
+def git_commit() -> str:
+    """Returns commit of working tree, empty outside of git."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def percentile(values, percent: int) -> float:
+    """Returns percentile of values, 0 for no values."""
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+async def subscribe(stub, login: str, expected: int, latencies: list):
+    """Receives expected number of messages of login and records their
+    latencies.
+    """
+    call = stub.Subscribe(chat_pb2.SubscribeRequest(login=login))
+    received = 0
+    try:
+        async for message in call:
+            latencies.append(time.perf_counter() - float(message.body))
+            received += 1
+            if received == expected:
+                break
+    finally:
+        call.cancel()
+
+
+async def send(stub, login: str, targets: list, rate: float):
+    """Sends message to every target at rate per second."""
+    for target in targets:
+        await stub.SendMessage(chat_pb2.SendMessageRequest(
+            message=chat_pb2.Message(login_from=login, login_to=target,
+                                     body=repr(time.perf_counter()))))
+        if rate:
+            await asyncio.sleep(1 / rate)
+
+
+async def drive(address: str, args) -> dict:
+    """Runs senders and subscribers against server, returns results."""
+    random.seed(args.seed)
+    logins = [f"subscriber_{x}" for x in range(args.subscribers)]
+    targets = [random.choice(logins)
+               for x in range(args.senders * args.messages)]
+    expected = {login: 0 for login in logins}
+    for login in targets:
+        expected[login] += 1
+    latencies = []
+    async with grpc.aio.insecure_channel(address) as channel:
+        stub = chat_ext_grpc.ChatExtStub(channel)
+        await channel.channel_ready()
+        subscribers = [asyncio.ensure_future(subscribe(
+            stub, login, expected[login], latencies))
+            for login in logins if expected[login]]
+        # Subscribe replies nothing until the first message, so streams
+        # are given time to be opened before sending.
+        await asyncio.sleep(args.warmup)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        await asyncio.gather(*(send(
+            stub, f"sender_{x}",
+            targets[x * args.messages:(x + 1) * args.messages], args.rate)
+            for x in range(args.senders)))
+        sent = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.gather(*subscribers), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - start
+        finished = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (finished.ru_utime - usage.ru_utime
+           + finished.ru_stime - usage.ru_stime)
+    delivered = len(latencies)
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        "sent": args.senders * args.messages,
+        "delivered": delivered,
+        "send_seconds": round(sent - start, 3),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(delivered / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies_ms, 50), 3),
+        "latency_p90_ms": round(percentile(latencies_ms, 90), 3),
+        "latency_p99_ms": round(percentile(latencies_ms, 99), 3),
+        "latency_max_ms": round(max(latencies_ms, default=0.0), 3),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_percent": round(100 * cpu / elapsed, 1),
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        "max_rss_mb": round(finished.ru_maxrss / (
+            1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+async def run_aio(storage, address: str, args) -> dict:
+    """Runs asyncio server and clients in one event loop."""
+    server = create_aio_server(AsyncStorageAdapter(storage), "localhost",
+                               address.split(":")[1])
+    await server.start()
+    try:
+        return await drive(address, args)
+    finally:
+        await server.stop(None)
+
+
+def run(args) -> dict:
+    """Runs load test and returns results with its configuration."""
+    storage = create_storage(args.storage, args.latency)
+    address = "localhost:{}".format(free_port())
+    if args.mode == "aio":
+        results = asyncio.run(run_aio(storage, address, args))
+    else:
+        server = create_server(storage, "localhost", address.split(":")[1],
+                               max_workers=args.subscribers + args.senders + 8)
+        server.start()
+        try:
+            results = asyncio.run(drive(address, args))
+        finally:
+            server.stop(None)
+    config = {name: getattr(args, name)
+              for name in ("storage", "mode", "senders", "subscribers",
+                           "messages", "rate", "latency", "seed")}
+    return {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": config, "results": results}
+
+
+def compare(old: dict, new: dict):
+    """Prints results of two runs and relative change of the new one."""
+    for name in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+        before, after = old["results"][name], new["results"][name]
+        change = (after - before) / before * 100 if before else 0.0
+        better = (change >= 0) == (name in HIGHER_IS_BETTER)
+        print(f"{name:>20}: {before:>10} -> {after:>10} ({change:+.1f}%"
+              f"{'' if not change else ', better' if better else ', worse'})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--storage", choices=STORAGES, default="memory",
+                        help="storage of server.")
+    parser.add_argument("--mode", choices=MODES, default="aio",
+                        help="server mode.")
+    parser.add_argument("--senders", type=int, default=100,
+                        help="number of concurrent senders.")
+    parser.add_argument("--subscribers", type=int, default=1000,
+                        help="number of subscribed users.")
+    parser.add_argument("--messages", type=int, default=20,
+                        help="messages sent by every sender.")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages per second of every sender, "
+                             "0 sends as fast as possible.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds of every etcd round-trip.")
+    parser.add_argument("--warmup", type=float, default=1.0,
+                        help="seconds to open subscriptions before sending.")
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="seconds to wait for delivery after sending.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed choosing recipients.")
+    parser.add_argument("-o", "--output", help="file to save results to.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved results instead of running.")
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
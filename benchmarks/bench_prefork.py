@@ -0,0 +1,122 @@
+"""Benchmark of Chat.SendMessage throughput of prefork server with
+different numbers of worker processes.
+
+Every worker serves on the same port with memory storage of its own.
+Messages are sent by several client processes, every one of them keeps
+its own connections, which SO_REUSEPORT spreads over workers.
+Throughput may grow with workers only up to the number of CPUs shared by
+workers and clients.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_prefork.py --workers 1 2 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+
+import grpc
+
+import chat_ext_grpc
+from chat_client_lib import MAX_IN_FLIGHT, message_request
+from chat_prefork import REUSEPORT_OPTIONS, Supervisor
+from chat_server import create_server
+from storages.memory_storage import MemoryStorage
+
+
+def free_port() -> int:
+    """Returns port free on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, worker: int):
+    """Runs server worker over memory storage until it is terminated."""
+    server = create_server(MemoryStorage(), "localhost", port,
+                           options=REUSEPORT_OPTIONS)
+    server.start()
+    server.wait_for_termination()
+
+
+def run_supervisor(port: int, workers: int):
+    """Runs supervisor of server workers on port."""
+    Supervisor(lambda worker: serve(port, worker), workers).run()
+
+
+def send(port: int, count: int, connections: int, ready, start, done):
+    """Sends count messages over connections once start is set."""
+    # Local subchannel pools make every channel open its own connection.
+    channels = [grpc.insecure_channel(
+        f"localhost:{port}", [("grpc.use_local_subchannel_pool", 1)])
+        for x in range(connections)]
+    for channel in channels:
+        grpc.channel_ready_future(channel).result(timeout=10)
+    stubs = [chat_ext_grpc.ChatExtStub(channel) for channel in channels]
+    ready.release()
+    start.wait()
+    for offset in range(0, count, MAX_IN_FLIGHT):
+        sent = [stubs[x % connections].SendMessage.future(message_request(
+            "userA", "userB", f"message {x}"))
+            for x in range(offset, min(offset + MAX_IN_FLIGHT, count))]
+        for future in sent:
+            future.result()
+    done.put(time.perf_counter())
+    for channel in channels:
+        channel.close()
+
+
+def measure(workers: int, args) -> float:
+    """Returns messages per second sent to server with workers."""
+    context = multiprocessing.get_context("fork")
+    port = free_port()
+    supervisor = context.Process(target=run_supervisor, args=(port, workers))
+    supervisor.start()
+    # Workers bind the port after they are forked.
+    time.sleep(args.startup)
+    ready = context.Semaphore(0)
+    start = context.Event()
+    done = context.Queue()
+    clients = [context.Process(target=send, args=(
+        port, args.messages, args.connections, ready, start, done))
+        for x in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        ready.acquire()
+    started = time.perf_counter()
+    start.set()
+    finished = max(done.get() for client in clients)
+    for client in clients:
+        client.join()
+    supervisor.terminate()
+    supervisor.join()
+    return args.clients * args.messages / (finished - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="numbers of server workers to measure.")
+    parser.add_argument("--clients", type=int,
+                        default=max(2, (os.cpu_count() or 2) // 2),
+                        help="number of client processes.")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="connections of every client process.")
+    parser.add_argument("-n", "--messages", type=int, default=5000,
+                        help="messages sent by every client process.")
+    parser.add_argument("--startup", type=float, default=1.0,
+                        help="seconds given to workers to start.")
+    args = parser.parse_args()
+    baseline = None
+    for workers in args.workers:
+        rate = measure(workers, args)
+        baseline = baseline or rate
+        print(f"{workers:>3} workers: {rate:>10.1f} messages/s "
+              f"(x{rate / baseline:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Benchmark of draining a queued backlog through Chat.Subscribe.
+
+Compares the former delivery loop, which slept one second after every
+message and deleted messages one by one, with batched delivery at wire
+speed. Time the former loop spent sleeping is accounted, not waited for.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_subscribe_drain.py -n 10000
+"""
+
+import argparse
+import time
+from typing import List
+from unittest import mock
+
+import chat_pb2
+from chat_server import Chat
+from chat_storage import Message, Storage, User, attach_seq
+
+
+class BacklogStorage(Storage):
+
+    """In-process storage holding backlog of one user and counting
+    storage calls. Watch is closed once the backlog is read by pages.
+    """
+
+    def __init__(self, host=None, port=None):
+        self.messages = []
+        self.calls = 0
+        self.callback = None
+
+    def create_user(self, user: User):
+        """Users are not needed by the benchmark."""
+        pass
+
+    def get_users_list(self) -> List[User]:
+        """Users are not needed by the benchmark."""
+        return []
+
+    def create_message(self, message: Message):
+        """Queues message with its position as sequence number."""
+        self.messages.append(attach_seq(message, len(self.messages) + 1))
+
+    def get_user_messages(self, login: str) -> List[Message]:
+        """Returns whole backlog in one call."""
+        self.calls += 1
+        return list(self.messages)
+
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = 100) -> List[Message]:
+        """Returns one page of backlog, closes the watch after the last
+        one.
+        """
+        self.calls += 1
+        page = self.messages[after_seq:after_seq + limit]
+        if len(page) < limit and self.callback is not None:
+            self.callback(None)
+        return page
+
+    def delete_user_message(self, message: Message):
+        """Counts one round-trip per message."""
+        self.calls += 1
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Counts one round-trip per batch."""
+        self.calls += 1
+
+    def watch_user_messages(self, login, callback, with_pending=True):
+        """Passes whole backlog if it is asked for and closes the watch,
+        otherwise keeps callback to close the watch after the backlog is
+        read by pages.
+        """
+        self.calls += 1
+        if not with_pending:
+            self.callback = callback
+            return lambda: None
+        callback(list(self.messages))
+        callback(None)
+        return lambda: None
+
+
+def legacy_subscribe(storage: Storage, login: str, slept: List[float]):
+    """Former Subscribe loop: sleeps a second after every message."""
+    for message in storage.get_user_messages(login):
+        yield chat_pb2.Message(login_from=message.login_from,
+                               login_to=message.login_to,
+                               created_at=message.created_at,
+                               body=message.body)
+        storage.delete_user_message(message)
+        slept.append(1.0)
+
+
+def fill_storage(count: int) -> BacklogStorage:
+    """Creates storage with count queued messages."""
+    storage = BacklogStorage()
+    for x in range(count):
+        storage.create_message(Message("userA", "userB", f"message {x}", x))
+    return storage
+
+
+def run(count: int):
+    """Drains backlog of count messages in both modes and prints results."""
+    storage = fill_storage(count)
+    slept = []
+    start = time.perf_counter()
+    delivered = sum(1 for _ in legacy_subscribe(storage, "userB", slept))
+    legacy_time = time.perf_counter() - start + sum(slept)
+    print(f"before: {delivered} messages in {legacy_time:.1f}s "
+          f"({storage.calls} storage calls)")
+
+    storage = fill_storage(count)
+    start = time.perf_counter()
+    delivered = sum(1 for _ in Chat(storage).Subscribe(
+        mock.Mock(login="userB"), mock.Mock()))
+    batched_time = time.perf_counter() - start
+    print(f"after:  {delivered} messages in {batched_time:.3f}s "
+          f"({storage.calls} storage calls)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--count", type=int, default=10000,
+                        help="number of queued messages.")
+    run(parser.parse_args().count)
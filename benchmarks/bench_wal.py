@@ -0,0 +1,69 @@
+"""Benchmark of Chat.SendMessage latency with messages saved straight
+to EtcdStorage and with write-ahead log in front of it.
+
+Storage is EtcdStorage over in-process etcd stand-in with given
+round-trip latency, log is written to a temporary directory.
+
+Run from repository root:
+    PYTHONPATH=chat python benchmarks/bench_wal.py -n 2000 -t 8
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+from concurrent import futures
+from unittest import mock
+
+import chat_pb2
+from chat_server import Chat
+from chat_wal import WalStorage
+from fake_etcd import FakeEtcdClient
+from storages.etcd_storage import EtcdStorage
+
+
+def measure(storage, count: int, threads: int):
+    """Sends count messages from threads, returns latencies in seconds."""
+    chat = Chat(storage)
+
+    def send(x):
+        request = chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+            login_from="userA", login_to="userB", body=f"message {x}"))
+        start = time.perf_counter()
+        chat.SendMessage(request, None)
+        return time.perf_counter() - start
+
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(send, range(count)))
+
+
+def report(name: str, latencies):
+    """Prints p50 and p99 latencies in milliseconds."""
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:>6}: p50 {percentiles[49] * 1000:.2f} ms, "
+          f"p99 {percentiles[98] * 1000:.2f} ms")
+
+
+def run(count: int, threads: int, latency: float):
+    """Prints SendMessage latencies of both modes."""
+    client = FakeEtcdClient(latency)
+    with mock.patch("storages.etcd_storage.etcd3.client", return_value=client):
+        storage = EtcdStorage("localhost", 2379, pool_size=threads)
+    report("direct", measure(storage, count, threads))
+    with tempfile.TemporaryDirectory() as directory:
+        wal_storage = WalStorage(storage, directory)
+        report("wal", measure(wal_storage, count, threads))
+        wal_storage.flush()
+        wal_storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--count", type=int, default=2000,
+                        help="number of messages.")
+    parser.add_argument("-t", "--threads", type=int, default=8,
+                        help="number of concurrent senders.")
+    parser.add_argument("-l", "--latency", type=float, default=0.005,
+                        help="seconds of every etcd round-trip.")
+    args = parser.parse_args()
+    run(args.count, args.threads, args.latency)
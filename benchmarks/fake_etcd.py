@@ -0,0 +1,217 @@
+"""In-process stand-in for etcd3 client used by benchmarks.
+
+Implements the subset of etcd3.Etcd3Client used by EtcdStorage on top of
+a sorted key space, counts every call which would be a round-trip to
+etcd and optionally adds latency to each of them.
+"""
+
+import bisect
+import operator
+import threading
+import time
+from types import SimpleNamespace
+
+from etcd3 import etcdrpc, transactions
+from etcd3.client import Transactions
+from etcd3.events import PutEvent
+
+COMPARE_OPERATORS = {
+    etcdrpc.Compare.EQUAL: operator.eq,
+    etcdrpc.Compare.NOT_EQUAL: operator.ne,
+    etcdrpc.Compare.LESS: operator.lt,
+    etcdrpc.Compare.GREATER: operator.gt,
+}
+
+
+class FakeEtcdClient:
+
+    """Keeps keys in memory and behaves like etcd3 client for EtcdStorage.
+    Requests the client has no method for are served by kvstub.
+    """
+
+    timeout = None
+    call_credentials = None
+    metadata = None
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.transactions = Transactions()
+        self.kvstub = FakeKVStub(self)
+        self._keys = []
+        self._values = {}
+        self._mod_revisions = {}
+        self._revision = 0
+        self._watches = {}
+        self._watch_ids = 0
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        """Counts round-trip and waits for simulated latency."""
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _put(self, key: str, value):
+        """Saves key and notifies watches of its prefix."""
+        key = key.encode()
+        if isinstance(value, str):
+            value = value.encode()
+        with self._lock:
+            if key not in self._values:
+                bisect.insort(self._keys, key)
+            self._values[key] = value
+            self._revision += 1
+            self._mod_revisions[key] = self._revision
+            kv = self._kv(key)
+            watches = [callback for prefix, callback in self._watches.values()
+                       if key.startswith(prefix)]
+        for callback in watches:
+            event = PutEvent(SimpleNamespace(kv=kv))
+            callback(SimpleNamespace(events=[event]))
+
+    def _delete(self, key: str) -> bool:
+        """Deletes key if it exists."""
+        key = key.encode()
+        with self._lock:
+            if self._values.pop(key, None) is None:
+                return False
+            self._keys.remove(key)
+            del self._mod_revisions[key]
+            self._revision += 1
+            return True
+
+    def _kv(self, key: bytes):
+        """Returns key-value of existing key. Must be called under lock."""
+        return SimpleNamespace(key=key, value=self._values[key],
+                               mod_revision=self._mod_revisions[key])
+
+    def _range(self, prefix: str, range_end: bytes = None):
+        """Returns key-values of prefix, or from prefix up to range end,
+        in key order.
+        """
+        prefix = prefix.encode() if isinstance(prefix, str) else prefix
+        with self._lock:
+            start = bisect.bisect_left(self._keys, prefix)
+            kvs = []
+            for key in self._keys[start:]:
+                if (key >= range_end if range_end
+                        else not key.startswith(prefix)):
+                    break
+                kvs.append(self._kv(key))
+            return kvs, SimpleNamespace(revision=self._revision)
+
+    def _compare(self, compare) -> bool:
+        """Evaluates transaction compare of value, create or mod revision
+        of key, revisions of missing key are 0.
+        """
+        key = compare.key.encode()
+        with self._lock:
+            exists = key in self._values
+            if isinstance(compare, transactions.Value):
+                actual, expected = self._values.get(key), compare.value
+                if isinstance(expected, str):
+                    expected = expected.encode()
+                if not exists:
+                    return False
+            elif isinstance(compare, transactions.Mod):
+                actual = self._mod_revisions.get(key, 0)
+                expected = compare.value
+            else:
+                actual, expected = (1 if exists else 0), compare.value
+        return COMPARE_OPERATORS[compare.op](actual, expected)
+
+    def put(self, key, value, lease=None):
+        """Saves key in one round-trip."""
+        self._round_trip()
+        self._put(key, value)
+
+    def delete(self, key):
+        """Deletes key in one round-trip."""
+        self._round_trip()
+        return self._delete(key)
+
+    def get_prefix(self, prefix):
+        """Returns (value, metadata) tuples of prefix in one round-trip."""
+        self._round_trip()
+        kvs, header = self._range(prefix)
+        return [(kv.value, SimpleNamespace(key=kv.key, response_header=header))
+                for kv in kvs]
+
+    def get_prefix_response(self, prefix, sort_order=None, sort_target="key",
+                            **options):
+        """Returns range response of prefix in one round-trip, sorted by
+        mod revision if it is the sort target. Other options are ignored,
+        as etcd client drops some of them, e.g. count_only.
+        """
+        self._round_trip()
+        kvs, header = self._range(prefix)
+        if sort_target == "mod":
+            kvs.sort(key=lambda kv: kv.mod_revision)
+        return SimpleNamespace(kvs=kvs, count=len(kvs), header=header)
+
+    def transaction(self, compare, success=None, failure=None):
+        """Applies put and delete operations of success or failure
+        branch in one round-trip. Create revision is compared only with
+        0, as missing key.
+        """
+        self._round_trip()
+        succeeded = all(self._compare(item) for item in compare)
+        for op in (success if succeeded else failure) or []:
+            if isinstance(op, transactions.Put):
+                self._put(op.key, op.value)
+            elif isinstance(op, transactions.Delete):
+                self._delete(op.key)
+        return succeeded, []
+
+    def add_watch_prefix_callback(self, prefix, callback, start_revision=None):
+        """Registers watch callback in one round-trip."""
+        self._round_trip()
+        with self._lock:
+            self._watch_ids += 1
+            self._watches[self._watch_ids] = (prefix.encode(), callback)
+            return self._watch_ids
+
+    def cancel_watch(self, watch_id):
+        """Cancels watch in one round-trip."""
+        self._round_trip()
+        with self._lock:
+            self._watches.pop(watch_id, None)
+
+
+class FakeKVStub:
+
+    """KV service of FakeEtcdClient for requests built by EtcdStorage."""
+
+    def __init__(self, client: FakeEtcdClient):
+        self.client = client
+
+    def Range(self, request, timeout=None, credentials=None, metadata=None):
+        """Returns keys of request range in one round-trip, filtered by
+        mod revisions, sorted and limited.
+        """
+        self.client._round_trip()
+        kvs, header = self.client._range(request.key, request.range_end)
+        if request.min_mod_revision:
+            kvs = [kv for kv in kvs
+                   if kv.mod_revision >= request.min_mod_revision]
+        if request.max_mod_revision:
+            kvs = [kv for kv in kvs
+                   if kv.mod_revision <= request.max_mod_revision]
+        if request.sort_target == etcdrpc.RangeRequest.MOD:
+            kvs.sort(key=lambda kv: kv.mod_revision)
+        count = len(kvs)
+        if request.count_only:
+            kvs = []
+        elif request.limit:
+            kvs = kvs[:request.limit]
+        return SimpleNamespace(kvs=kvs, count=count, header=header)
+
+    def DeleteRange(self, request, timeout=None, credentials=None,
+                    metadata=None):
+        """Deletes keys of request range in one round-trip."""
+        self.client._round_trip()
+        kvs, header = self.client._range(request.key, request.range_end)
+        deleted = sum(self.client._delete(kv.key.decode()) for kv in kvs)
+        return SimpleNamespace(deleted=deleted, header=header)
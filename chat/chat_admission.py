@@ -0,0 +1,416 @@
+"""This module contains admission control of chat server: gRPC
+interceptors rejecting calls with RESOURCE_EXHAUSTED and retry-after
+trailing metadata when sender or server rate limit is exceeded, when
+too many calls of a method are in progress or when storage is too slow
+to take more messages.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import grpc
+from prometheus_client import Counter
+
+import chat_ext_grpc
+from chat_metrics import method_name, wrap_handler
+from chat_nodes import is_forwarded
+from chat_rate_limit import TokenBucket
+from chat_storage import Message, StorageWrapper
+
+# Methods whose requests carry messages counted by rate limits.
+MESSAGE_METHODS = ("SendMessage", "SendMessages")
+# Methods rejected while storage is overloaded, the ones reading messages
+# go on, as they drain storage.
+SHED_METHODS = ("SendMessage", "SendMessages")
+MAX_SENDERS = 100000
+LATENCY_WEIGHT = 0.2
+CONCURRENCY_RETRY_AFTER = 0.1
+SHED_RETRY_AFTER = 1.0
+
+REJECTED_CALLS = Counter(
+    "chat_rejected_calls_total", "Calls rejected by admission control.",
+    ("method", "reason"))
+
+
+def parse_method_limits(value: str) -> Dict[str, int]:
+    """Returns concurrency limits of methods from SERVER_METHOD_CONCURRENCY
+    value, e.g. "SendMessage=64,Subscribe=1000". Raises ValueError if it
+    is malformed.
+    """
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        method, separator, limit = item.partition("=")
+        if not separator or int(limit) <= 0:
+            raise ValueError(f"malformed method concurrency limit: {item}")
+        limits[method.strip()] = int(limit)
+    return limits
+
+
+class AdmissionError(Exception):
+
+    """Raised when call is not admitted, tells when to retry."""
+
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class StorageLatency:
+
+    """Moving average of storage write latency. Samples older than
+    max age are not trusted, so load shedding stops once there are no
+    fresh samples and writes go on to measure storage again.
+    """
+
+    def __init__(self, weight: float = LATENCY_WEIGHT):
+        self.weight = weight
+        self.average = 0.0
+        self._updated: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        """Adds latency sample to average."""
+        with self._lock:
+            if self._updated is None:
+                self.average = seconds
+            else:
+                self.average += self.weight * (seconds - self.average)
+            self._updated = time.monotonic()
+
+    def exceeds(self, threshold: float, max_age: float) -> bool:
+        """Checks if average of samples not older than max age exceeds
+        threshold.
+        """
+        with self._lock:
+            return (self._updated is not None
+                    and time.monotonic() - self._updated < max_age
+                    and self.average > threshold)
+
+
+class LatencyTrackingStorage(StorageWrapper):
+
+    """Measures latency of message writes of wrapped storage."""
+
+    def __init__(self, storage, latency: StorageLatency):
+        super().__init__(storage)
+        self.latency = latency
+
+    def create_message(self, message: Message):
+        """Saves message in wrapped storage, measuring latency."""
+        start = time.perf_counter()
+        self.storage.create_message(message)
+        self.latency.observe(time.perf_counter() - start)
+
+    def create_messages(self, messages: List[Message]):
+        """Saves batch of messages in wrapped storage, measuring latency."""
+        start = time.perf_counter()
+        self.storage.create_messages(messages)
+        self.latency.observe(time.perf_counter() - start)
+
+
+class AdmissionController:
+
+    """Admits calls and messages by limits left as None or empty when
+    they are not applied: messages per second of every sender and of the
+    whole server, calls of method in progress and storage write latency
+    over which sending is shed. Buckets of senders which were not seen
+    for long are dropped once there are MAX_SENDERS of them.
+    """
+
+    def __init__(self, sender_rate: float = None, global_rate: float = None,
+                 method_limits: Dict[str, int] = None,
+                 shed_latency: float = None,
+                 latency: StorageLatency = None):
+        self.sender_rate = sender_rate
+        self.method_limits = method_limits or {}
+        self.shed_latency = shed_latency
+        self.latency = latency or StorageLatency()
+        self._global = TokenBucket(global_rate) if global_rate else None
+        self._senders: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Tells if any limit is applied."""
+        return bool(self.sender_rate or self._global or self.method_limits
+                    or self.shed_latency)
+
+    def _sender_bucket(self, login: str) -> TokenBucket:
+        """Returns bucket of sender, creating it on the first message."""
+        with self._lock:
+            bucket = self._senders.get(login)
+            if bucket is None:
+                bucket = self._senders[login] = TokenBucket(self.sender_rate)
+                if len(self._senders) > MAX_SENDERS:
+                    self._senders.popitem(last=False)
+            else:
+                self._senders.move_to_end(login)
+            return bucket
+
+    def admit_message(self, login_from: str):
+        """Takes tokens of sender and server for message. Raises
+        AdmissionError if either of them has run out, token of sender is
+        given back if server rejects the message.
+        """
+        sender = self._sender_bucket(login_from) if self.sender_rate else None
+        if sender:
+            retry_after = sender.take()
+            if retry_after:
+                raise AdmissionError(
+                    f"rate limit of sender {login_from} is exceeded",
+                    retry_after, "sender_rate")
+        if self._global:
+            retry_after = self._global.take()
+            if retry_after:
+                if sender:
+                    sender.refund()
+                raise AdmissionError("rate limit of server is exceeded",
+                                     retry_after, "global_rate")
+
+    def enter(self, method: str):
+        """Counts call of method in progress. Raises AdmissionError if
+        sending is shed or the method has too many calls in progress.
+        """
+        if (self.shed_latency and method in SHED_METHODS
+                and self.latency.exceeds(self.shed_latency,
+                                         SHED_RETRY_AFTER)):
+            raise AdmissionError("storage is overloaded", SHED_RETRY_AFTER,
+                                 "overload")
+        limit = self.method_limits.get(method)
+        if limit is None:
+            return
+        with self._lock:
+            calls = self._calls.get(method, 0)
+            if calls >= limit:
+                raise AdmissionError(
+                    f"too many {method} calls in progress",
+                    CONCURRENCY_RETRY_AFTER, "concurrency")
+            self._calls[method] = calls + 1
+
+    def leave(self, method: str):
+        """Counts finished call of method."""
+        if method not in self.method_limits:
+            return
+        with self._lock:
+            self._calls[method] -= 1
+
+
+class StreamAdmission:
+
+    """Admission of request stream of messages: number of messages
+    admitted so far and error of the first message not admitted.
+    """
+
+    def __init__(self):
+        self.admitted = 0
+        self.error: Optional[AdmissionError] = None
+
+
+def rejection_metadata(error: AdmissionError,
+                       admission: StreamAdmission = None):
+    """Returns retry-after trailing metadata of rejected call, with number
+    of messages saved from request stream cut by the rejection.
+    """
+    return chat_ext_grpc.retry_after_metadata(
+        error.retry_after, admission.admitted if admission else None)
+
+
+def reject(method: str, error: AdmissionError, context,
+           admission: StreamAdmission = None):
+    """Sets retry-after trailing metadata and aborts call."""
+    REJECTED_CALLS.labels(method, error.reason).inc()
+    context.set_trailing_metadata(rejection_metadata(error, admission))
+    context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(error))
+
+
+async def reject_async(method: str, error: AdmissionError, context,
+                       admission: StreamAdmission = None):
+    """Sets retry-after trailing metadata and aborts asyncio call."""
+    REJECTED_CALLS.labels(method, error.reason).inc()
+    context.set_trailing_metadata(rejection_metadata(error, admission))
+    await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(error))
+
+
+class AdmissionInterceptor(grpc.ServerInterceptor):
+
+    """Admits every call by AdmissionController: calls are counted while
+    they are in progress and every message sent is taken from rate
+    limits. Request stream ends at the first message not admitted, so
+    the method saves messages admitted before it, then the call is
+    rejected with number of saved messages in trailing metadata. Calls
+    forwarded by other nodes are not admitted again, as their messages
+    were admitted by the node which received them.
+    """
+
+    def __init__(self, controller: AdmissionController):
+        self.controller = controller
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or is_forwarded(
+                handler_call_details.invocation_metadata):
+            return handler
+        streaming = handler.request_streaming
+        return wrap_handler(
+            handler, method_name(handler_call_details),
+            lambda method, behavior: self._unary(method, behavior, streaming),
+            lambda method, behavior: self._stream(method, behavior, streaming))
+
+    def _enter(self, method: str, context):
+        """Counts call in progress or rejects it."""
+        try:
+            self.controller.enter(method)
+        except AdmissionError as error:
+            reject(method, error, context)
+
+    def _admit(self, method: str, request, context, streaming: bool):
+        """Returns request whose messages are admitted, together with
+        admission of request stream, which is None for other requests.
+        """
+        if method not in MESSAGE_METHODS:
+            return request, None
+        if streaming:
+            admission = StreamAdmission()
+            return self._admit_stream(request, admission), admission
+        try:
+            self.controller.admit_message(request.message.login_from)
+        except AdmissionError as error:
+            reject(method, error, context)
+        return request, None
+
+    def _admit_stream(self, requests, admission: StreamAdmission):
+        """Yields requests of stream admitting their messages, ends at
+        the first message not admitted.
+        """
+        for request in requests:
+            try:
+                self.controller.admit_message(request.message.login_from)
+            except AdmissionError as error:
+                admission.error = error
+                return
+            admission.admitted += 1
+            yield request
+
+    def _finish(self, method: str, admission: StreamAdmission, context):
+        """Rejects call whose request stream was cut by admission."""
+        if admission is not None and admission.error is not None:
+            reject(method, admission.error, context, admission)
+
+    def _unary(self, method: str, behavior, streaming: bool):
+        def wrapper(request, context):
+            self._enter(method, context)
+            try:
+                request, admission = self._admit(method, request, context,
+                                                 streaming)
+                response = behavior(request, context)
+                self._finish(method, admission, context)
+                return response
+            finally:
+                self.controller.leave(method)
+        return wrapper
+
+    def _stream(self, method: str, behavior, streaming: bool):
+        def wrapper(request, context):
+            self._enter(method, context)
+            try:
+                request, admission = self._admit(method, request, context,
+                                                 streaming)
+                yield from behavior(request, context)
+                self._finish(method, admission, context)
+            finally:
+                self.controller.leave(method)
+        return wrapper
+
+
+class AsyncAdmissionInterceptor(grpc.aio.ServerInterceptor):
+
+    """Admits calls on asyncio server in the same way as
+    AdmissionInterceptor.
+    """
+
+    def __init__(self, controller: AdmissionController):
+        self.controller = controller
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or is_forwarded(
+                handler_call_details.invocation_metadata):
+            return handler
+        streaming = handler.request_streaming
+        return wrap_handler(
+            handler, method_name(handler_call_details),
+            lambda method, behavior: self._unary(method, behavior, streaming),
+            lambda method, behavior: self._stream(method, behavior, streaming))
+
+    async def _enter(self, method: str, context):
+        """Counts call in progress or rejects it."""
+        try:
+            self.controller.enter(method)
+        except AdmissionError as error:
+            await reject_async(method, error, context)
+
+    async def _admit(self, method: str, request, context, streaming: bool):
+        """Returns request whose messages are admitted, together with
+        admission of request stream, which is None for other requests.
+        """
+        if method not in MESSAGE_METHODS:
+            return request, None
+        if streaming:
+            admission = StreamAdmission()
+            return self._admit_stream(request, admission), admission
+        try:
+            self.controller.admit_message(request.message.login_from)
+        except AdmissionError as error:
+            await reject_async(method, error, context)
+        return request, None
+
+    async def _admit_stream(self, requests, admission: StreamAdmission):
+        """Yields requests of stream admitting their messages, ends at
+        the first message not admitted.
+        """
+        async for request in requests:
+            try:
+                self.controller.admit_message(request.message.login_from)
+            except AdmissionError as error:
+                admission.error = error
+                return
+            admission.admitted += 1
+            yield request
+
+    async def _finish(self, method: str, admission: StreamAdmission,
+                      context):
+        """Rejects call whose request stream was cut by admission."""
+        if admission is not None and admission.error is not None:
+            await reject_async(method, admission.error, context, admission)
+
+    def _unary(self, method: str, behavior, streaming: bool):
+        async def wrapper(request, context):
+            await self._enter(method, context)
+            try:
+                request, admission = await self._admit(method, request,
+                                                       context, streaming)
+                response = await behavior(request, context)
+                await self._finish(method, admission, context)
+                return response
+            finally:
+                self.controller.leave(method)
+        return wrapper
+
+    def _stream(self, method: str, behavior, streaming: bool):
+        async def wrapper(request, context):
+            await self._enter(method, context)
+            try:
+                request, admission = await self._admit(method, request,
+                                                       context, streaming)
+                async for response in behavior(request, context):
+                    yield response
+                await self._finish(method, admission, context)
+            finally:
+                self.controller.leave(method)
+        return wrapper
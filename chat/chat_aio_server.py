@@ -0,0 +1,358 @@
+"""The Python implementation of the asyncio gRPC chat server.
+Subscribe streams wait on storage watches without holding threads,
+so the number of subscribers is not limited by a thread pool.
+"""
+
+import asyncio
+import logging
+import signal
+from typing import List
+
+import grpc
+
+import chat_ext_grpc
+import chat_pb2_grpc
+from chat_aio_storage import AsyncMessageWatch, AsyncStorage, AsyncStorageAdapter
+from chat_convert import message_from_pb, message_to_pb, user_to_pb, users_reply
+from chat_metrics import BufferMetrics
+from chat_nodes import AsyncNodeForwarder, is_forwarded
+from chat_rate_limit import SubscriberRateLimiter
+from chat_server import (SEND_BATCH_SIZE, SHUTDOWN_GRACE,
+                         SUBSCRIBE_BATCH_SIZE, SUBSCRIBE_BUFFER_BYTES,
+                         USERS_PAGE_SIZE, StreamCursor,
+                         UsersReplyCache, ack_messages_reply, channel_reply,
+                         create_users_list, messages_without_seq,
+                         not_member_error, send_message_reply,
+                         send_messages_reply, split_batches,
+                         split_channel_messages)
+from chat_storage import (SLOW_CONSUMER_TIMEOUT, Channel, Message,
+                          SlowConsumerError, Storage, WatchBrokenError,
+                          channel_name, is_channel)
+
+
+class AsyncChat(chat_pb2_grpc.ChatServicer):
+
+    """Provides coroutines that implement functionality of chat server
+    in the same way as Chat servicer.
+    """
+
+    def __init__(self, storage: AsyncStorage,
+                 subscribe_batch_size: int = SUBSCRIBE_BATCH_SIZE,
+                 messages_per_second: float = None,
+                 bytes_per_second: float = None, node_address: str = None,
+                 max_buffered_bytes: int = SUBSCRIBE_BUFFER_BYTES,
+                 slow_consumer_policy: str = "pause",
+                 slow_consumer_timeout: float = SLOW_CONSUMER_TIMEOUT):
+        self.storage = storage
+        self.subscribe_batch_size = subscribe_batch_size
+        self.messages_per_second = messages_per_second
+        self.bytes_per_second = bytes_per_second
+        self.node_address = node_address
+        self.watch_options = {
+            "max_buffered_bytes": max_buffered_bytes,
+            "slow_consumer_policy": slow_consumer_policy,
+            "slow_consumer_timeout": slow_consumer_timeout,
+            "listener": BufferMetrics(),
+        }
+        self.forwarder = None
+        if node_address and not storage.watches_across_nodes:
+            self.forwarder = AsyncNodeForwarder(node_address)
+        self._users_reply = UsersReplyCache()
+
+    async def _route(self, messages: List[Message], context) -> List[Message]:
+        """Forwards messages whose recipients are subscribed on other
+        nodes, unless they were forwarded already. Returns messages to
+        be saved in storage of this node.
+        """
+        if self.forwarder is None or is_forwarded(
+                context.invocation_metadata()):
+            return messages
+        return await self.forwarder.forward(self.storage.get_subscriber_node,
+                                            messages)
+
+    async def _check_channels(self, messages: List[Message], context):
+        """Aborts call if message is sent to channel its sender is not
+        member of.
+        """
+        channels = {}
+        for message in messages:
+            if not is_channel(message.login_to):
+                continue
+            if message.login_from not in channels:
+                channels[message.login_from] = (
+                    await self.storage.get_user_channels(message.login_from))
+            if channel_name(message.login_to) not in channels[
+                    message.login_from]:
+                await context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                                    not_member_error(message))
+
+    async def GetUsers(self, request, context):
+        """Returns list of users from storage, reply is reused while
+        storage returns the same users list. If metadata asks for a page,
+        returns one page of users and token of the next page in trailing
+        metadata.
+        """
+        try:
+            page = chat_ext_grpc.read_users_page_metadata(
+                context.invocation_metadata())
+        except ValueError as error:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        if page is None:
+            return self._users_reply.get(await self.storage.get_users_list())
+        page_token, page_size, login_prefix = page
+        users = await self.storage.get_users_page(page_token, page_size,
+                                                  login_prefix)
+        context.set_trailing_metadata((
+            (chat_ext_grpc.NEXT_PAGE_TOKEN_KEY,
+             chat_ext_grpc.next_page_token(users, page_size)),))
+        return users_reply(users)
+
+    async def StreamUsers(self, request, context):
+        """Returns stream of all users with login prefix from metadata,
+        reading them from storage page by page.
+        """
+        login_prefix = dict(context.invocation_metadata()).get(
+            chat_ext_grpc.LOGIN_PREFIX_KEY, "")
+        after_login = ""
+        while True:
+            users = await self.storage.get_users_page(
+                after_login, USERS_PAGE_SIZE, login_prefix)
+            for user in users:
+                yield user_to_pb(user)
+            if len(users) < USERS_PAGE_SIZE:
+                return
+            after_login = users[-1].login
+
+    async def SendMessage(self, request, context):
+        """Gets message and saves it to storage. 
+        Returns simple string if the message from client is received.
+        """
+        message = message_from_pb(request.message)
+        await self._check_channels([message], context)
+        if await self._route([message], context):
+            await self.storage.create_message(message)
+        return send_message_reply(request.message)
+
+    async def SendMessages(self, request_iterator, context):
+        """Gets stream of messages and saves them to storage in batches.
+        Returns simple string with number of received messages.
+        """
+        count = 0
+        batch = []
+        async for request in request_iterator:
+            batch.append(message_from_pb(request.message))
+            if len(batch) == SEND_BATCH_SIZE:
+                await self._check_channels(batch, context)
+                await self.storage.create_messages(
+                    await self._route(batch, context))
+                count += len(batch)
+                batch = []
+        if batch:
+            await self._check_channels(batch, context)
+            await self.storage.create_messages(
+                await self._route(batch, context))
+            count += len(batch)
+        return send_messages_reply(count)
+
+    async def _stream_messages(self, request, context, on_batch,
+                               with_channels: bool = False):
+        """Yields messages of subscriber with their replies in the same
+        way as Chat does, awaiting on_batch with every written batch.
+        Watch is cancelled and subscriber node unregistered when the
+        stream is closed. Slow consumer which stopped reading is
+        aborted from a task of its own.
+        """
+        if is_channel(request.login):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                "channel can not be subscribed to")
+        channels = None
+        if with_channels:
+            channels = await self.storage.get_user_channels(request.login)
+        rate_limiter = SubscriberRateLimiter(self.messages_per_second,
+                                             self.bytes_per_second)
+        unregister = lambda: None
+        if self.node_address:
+            unregister = await self.storage.register_subscriber(
+                request.login, self.node_address)
+        try:
+            async with AsyncMessageWatch(
+                    self.storage, request.login, channels,
+                    on_disconnect=lambda: asyncio.ensure_future(
+                        abort_stalled(context)),
+                    **self.watch_options) as watch:
+                async for messages in watch:
+                    for batch in split_batches(messages,
+                                               self.subscribe_batch_size):
+                        for message in batch:
+                            reply = message_to_pb(message)
+                            delay = rate_limiter.reserve(reply.ByteSize())
+                            if delay:
+                                await asyncio.sleep(delay)
+                            yield message, reply
+                        await on_batch(batch)
+        except SlowConsumerError as error:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                                str(error))
+        except WatchBrokenError as error:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, str(error))
+        finally:
+            unregister()
+
+    async def _mark_read(self, login: str, messages: List[Message]):
+        """Deletes messages of user and moves cursors of user in channels
+        past messages read from them.
+        """
+        messages, cursors = split_channel_messages(messages)
+        if messages:
+            await self.storage.delete_user_messages(messages)
+        for name, cursor in cursors.items():
+            await self.storage.set_channel_cursor(name, login, cursor)
+
+    async def Subscribe(self, request, context):
+        """Returns stream of messages from storage by subscription merged
+        with messages of channels of the user, deleting messages and
+        moving channel cursors in batches once they are written to the
+        stream.
+        """
+        messages = self._stream_messages(
+            request, context,
+            lambda batch: self._mark_read(request.login, batch),
+            with_channels=True)
+        try:
+            async for message, reply in messages:
+                yield reply
+        finally:
+            await messages.aclose()
+
+    async def _delete_without_seq(self, messages: List[Message]):
+        """Deletes messages which can not be acknowledged by cursor."""
+        messages = messages_without_seq(messages)
+        if messages:
+            await self.storage.delete_user_messages(messages)
+
+    async def _ack_messages(self, login: str, cursor: str, context) -> int:
+        """Deletes messages of user up to cursor and moves cursors of
+        user in channels of the cursor, aborts call if cursor is
+        malformed. Returns number of deleted messages.
+        """
+        try:
+            position, channels = chat_ext_grpc.parse_cursor(cursor)
+        except ValueError as error:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        count = 0
+        if position is not None:
+            count = await self.storage.ack_user_messages(login, position)
+        for name, channel_position in channels.items():
+            await self.storage.set_channel_cursor(name, login,
+                                                  channel_position)
+        return count
+
+    async def SubscribeFrom(self, request, context):
+        """Returns stream of messages with cursors after cursor from
+        metadata merged with messages of channels of the user, messages
+        are kept until client acknowledges them.
+        """
+        cursor = chat_ext_grpc.read_cursor_metadata(
+            context.invocation_metadata())
+        if cursor and not is_channel(request.login):
+            await self._ack_messages(request.login, cursor, context)
+        stream_cursor = StreamCursor()
+        messages = self._stream_messages(request, context,
+                                         self._delete_without_seq,
+                                         with_channels=True)
+        try:
+            async for message, reply in messages:
+                yield reply, stream_cursor.advance(message)
+        finally:
+            await messages.aclose()
+
+    async def AckMessages(self, request, context):
+        """Deletes messages of user up to cursor from metadata and moves
+        cursors of user in channels of the cursor.
+        """
+        cursor = chat_ext_grpc.read_cursor_metadata(
+            context.invocation_metadata())
+        if not cursor:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                "cursor is required")
+        if is_channel(request.login):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                "channel messages can not be acknowledged")
+        return ack_messages_reply(
+            await self._ack_messages(request.login, cursor, context))
+
+    async def JoinChannel(self, request, context):
+        """Makes user member of channel from metadata, creating channel
+        if there is no such one.
+        """
+        name = chat_ext_grpc.read_channel_metadata(
+            context.invocation_metadata())
+        if not name:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                "channel is required")
+        try:
+            if await self.storage.get_channel(name) is None:
+                await self.storage.create_channel(Channel(name))
+            await self.storage.join_channel(name, request.login)
+        except NotImplementedError as error:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, str(error))
+        return channel_reply(request.login, "joined", name)
+
+    async def LeaveChannel(self, request, context):
+        """Removes user from members of channel from metadata."""
+        name = chat_ext_grpc.read_channel_metadata(
+            context.invocation_metadata())
+        if not name:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                "channel is required")
+        try:
+            await self.storage.leave_channel(name, request.login)
+        except NotImplementedError as error:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, str(error))
+        return channel_reply(request.login, "left", name)
+
+
+async def abort_stalled(context):
+    """Aborts call of subscriber which stopped reading with
+    RESOURCE_EXHAUSTED. It runs in a task of its own, as handler of the
+    call is blocked writing to the stream.
+    """
+    try:
+        await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                            "subscriber stopped reading")
+    except Exception:
+        # Abort raises error to end the handler, which is not this task.
+        pass
+
+
+def create_aio_server(storage: AsyncStorage, server_host: str,
+                      server_port: str, interceptors=(), options=(),
+                      **chat_options):
+    """Creates asyncio server on defined address and port with
+    interceptors and channel options. Chat options are passed to
+    AsyncChat servicer.
+    """
+    server = grpc.aio.server(interceptors=interceptors, options=options)
+    chat = AsyncChat(storage, **chat_options)
+    chat_pb2_grpc.add_ChatServicer_to_server(chat, server)
+    chat_ext_grpc.add_ChatExtServicer_to_server(chat, server)
+    server.add_insecure_port("{}:{}".format(server_host, server_port))
+    return server
+
+
+async def serve(storage: Storage, server_host: str, server_port: str,
+                interceptors=(), options=(), **chat_options):
+    """Runs asyncio server over synchronous storage until termination.
+    SIGTERM stops it, letting calls in progress finish within grace.
+    """
+    if not storage.get_users_list():
+        create_users_list(storage)
+    server = create_aio_server(AsyncStorageAdapter(storage), server_host,
+                               server_port, interceptors, options,
+                               **chat_options)
+    await server.start()
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM,
+        lambda: asyncio.ensure_future(server.stop(SHUTDOWN_GRACE)))
+    logging.info('Starting asyncio server..')
+    await server.wait_for_termination()
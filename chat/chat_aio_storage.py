@@ -0,0 +1,381 @@
+"""This module contains AsyncStorage interface used by asyncio chat server
+and adapter running any Storage in executor threads.
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional
+
+from chat_storage import (BACKLOG_PAGE_SIZE, SLOW_CONSUMER_TIMEOUT,
+                          BufferListener, Channel, DeliveryBuffer, Message,
+                          SlowConsumerError, Storage, User, WatchBrokenError,
+                          is_acknowledged, watched_mailboxes)
+
+
+class AsyncStorage(ABC):
+
+    """Base class for asyncio storages. Declares the same methods
+    as Storage, but as coroutines.
+    """
+
+    watches_across_nodes = False
+
+    @abstractmethod
+    async def create_user(self, user: User):
+        """Saves users in storage."""
+        pass
+
+    @abstractmethod
+    async def get_users_list(self) -> List[User]:
+        """Returns users list from storage."""
+        pass
+
+    @abstractmethod
+    async def get_users_page(self, after_login: str = "", limit: int = 100,
+                             login_prefix: str = "") -> List[User]:
+        """Returns up to limit users ordered by login, with login greater
+        than after_login and starting with login_prefix.
+        """
+        pass
+
+    @abstractmethod
+    async def create_message(self, message: Message):
+        """Saves messages in storage."""
+        pass
+
+    @abstractmethod
+    async def create_messages(self, messages: List[Message]):
+        """Saves batch of messages in storage."""
+        pass
+
+    @abstractmethod
+    async def get_user_messages(self, login: str) -> List[Message]:
+        """Returns list of messages from storage."""
+        pass
+
+    async def get_user_messages_page(self, login: str, after_seq: int = 0,
+                                     limit: int = BACKLOG_PAGE_SIZE
+                                     ) -> List[Message]:
+        """Returns up to limit messages of user with sequence numbers
+        greater than after_seq, in their order.
+        """
+        messages = [message for message in await self.get_user_messages(
+            login) if not is_acknowledged(message, after_seq)]
+        return messages[:limit]
+
+    @abstractmethod
+    async def delete_user_message(self, message: Message):
+        """Deletes user-read messages."""
+        pass
+
+    @abstractmethod
+    async def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of user-read messages."""
+        pass
+
+    @abstractmethod
+    async def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user with sequence numbers up to cursor
+        and returns their number.
+        """
+        pass
+
+    @abstractmethod
+    async def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Passes pending, unless with_pending is False, and then new
+        messages of user to callback, callback may be called from any
+        thread. Returns function cancelling the watch.
+        """
+        pass
+
+    async def create_channel(self, channel: Channel):
+        """Saves channel in storage."""
+        raise NotImplementedError("storage has no channels")
+
+    async def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel with name, if there is one."""
+        return None
+
+    async def join_channel(self, name: str, login: str):
+        """Makes user member of channel."""
+        raise NotImplementedError("storage has no channels")
+
+    async def leave_channel(self, name: str, login: str):
+        """Removes user from members of channel."""
+        raise NotImplementedError("storage has no channels")
+
+    async def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user with cursors of the user."""
+        return {}
+
+    async def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of channel member forward to sequence number."""
+        pass
+
+    async def register_subscriber(self, login: str,
+                                  node_address: str) -> Callable[[], None]:
+        """Records node serving subscription of user. Returns function
+        removing the record.
+        """
+        return lambda: None
+
+    async def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns node serving subscription of user, if it is known."""
+        return None
+
+
+class AsyncStorageAdapter(AsyncStorage):
+
+    """Runs calls of synchronous Storage in executor threads.
+    Watches do not occupy threads while waiting for messages.
+    """
+
+    def __init__(self, storage: Storage, executor=None):
+        self.storage = storage
+        self.executor = executor
+        self.watches_across_nodes = storage.watches_across_nodes
+
+    async def _run(self, method, *args):
+        """Runs storage method in executor and returns its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, method, *args)
+
+    async def create_user(self, user: User):
+        """Saves user in storage."""
+        await self._run(self.storage.create_user, user)
+
+    async def get_users_list(self) -> List[User]:
+        """Returns users list from storage."""
+        return await self._run(self.storage.get_users_list)
+
+    async def get_users_page(self, after_login: str = "", limit: int = 100,
+                             login_prefix: str = "") -> List[User]:
+        """Returns page of users from storage."""
+        return await self._run(self.storage.get_users_page, after_login,
+                               limit, login_prefix)
+
+    async def create_message(self, message: Message):
+        """Saves message in storage."""
+        await self._run(self.storage.create_message, message)
+
+    async def create_messages(self, messages: List[Message]):
+        """Saves batch of messages in storage."""
+        await self._run(self.storage.create_messages, messages)
+
+    async def get_user_messages(self, login: str) -> List[Message]:
+        """Returns list of messages from storage."""
+        return await self._run(self.storage.get_user_messages, login)
+
+    async def get_user_messages_page(self, login: str, after_seq: int = 0,
+                                     limit: int = BACKLOG_PAGE_SIZE
+                                     ) -> List[Message]:
+        """Returns page of messages of user from storage."""
+        return await self._run(self.storage.get_user_messages_page, login,
+                               after_seq, limit)
+
+    async def delete_user_message(self, message: Message):
+        """Deletes user-read message."""
+        await self._run(self.storage.delete_user_message, message)
+
+    async def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of user-read messages."""
+        await self._run(self.storage.delete_user_messages, messages)
+
+    async def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user up to cursor."""
+        return await self._run(self.storage.ack_user_messages, login, cursor)
+
+    async def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Starts storage watch in executor, as it reads pending messages."""
+        return await self._run(self.storage.watch_user_messages, login,
+                               callback, with_pending)
+
+    async def create_channel(self, channel: Channel):
+        """Saves channel in storage."""
+        await self._run(self.storage.create_channel, channel)
+
+    async def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel from storage."""
+        return await self._run(self.storage.get_channel, name)
+
+    async def join_channel(self, name: str, login: str):
+        """Adds channel member in storage."""
+        await self._run(self.storage.join_channel, name, login)
+
+    async def leave_channel(self, name: str, login: str):
+        """Removes channel member in storage."""
+        await self._run(self.storage.leave_channel, name, login)
+
+    async def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user from storage."""
+        return await self._run(self.storage.get_user_channels, login)
+
+    async def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of channel member in storage."""
+        await self._run(self.storage.set_channel_cursor, name, login, cursor)
+
+    async def register_subscriber(self, login: str,
+                                  node_address: str) -> Callable[[], None]:
+        """Registers subscriber node in storage."""
+        return await self._run(self.storage.register_subscriber, login,
+                               node_address)
+
+    async def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns subscriber node from storage."""
+        return await self._run(self.storage.get_subscriber_node, login)
+
+
+class AsyncMessageWatch:
+
+    """Asynchronous iterator over batches of user messages merged with
+    messages of channels after cursors of the user, used as async
+    context manager. Messages pushed while the consumer was busy are
+    merged into one batch. Messages are kept in DeliveryBuffer and read
+    page by page in the same way as MessageWatch does, subscriber
+    behind for timeout with "disconnect" policy is disconnected by
+    on_disconnect, iteration over watch broken by storage raises
+    WatchBrokenError.
+    """
+
+    def __init__(self, storage: AsyncStorage, login: str,
+                 channels: Dict[str, int] = None, max_buffered_bytes: int = 0,
+                 slow_consumer_policy: str = "pause",
+                 slow_consumer_timeout: float = SLOW_CONSUMER_TIMEOUT,
+                 listener: BufferListener = None,
+                 on_disconnect: Callable[[], None] = None):
+        self._storage = storage
+        self._login = login
+        self._buffer = DeliveryBuffer(
+            max_buffered_bytes, slow_consumer_policy, slow_consumer_timeout,
+            listener, watched_mailboxes(login, channels or {}))
+        self._on_disconnect = on_disconnect
+        self._ready = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._closed = False
+        self._disconnected = False
+        self._ended = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._cancels = []
+
+    def _put(self, batch: Optional[List[Message]]):
+        """Passes batch from any thread to event loop."""
+        self._loop.call_soon_threadsafe(self._push, batch)
+
+    def _push(self, batch: Optional[List[Message]]):
+        """Buffers batch pushed by storage watch, None ends iteration.
+        Starts disconnect timer once subscriber falls behind.
+        """
+        if self._closed:
+            return
+        if batch is None:
+            self._ended = True
+        else:
+            self._buffer.push(batch)
+            if (self._buffer.policy == "disconnect"
+                    and self._buffer.behind_since is not None
+                    and self._timer is None):
+                self._timer = self._loop.call_later(self._buffer.timeout,
+                                                    self._disconnect)
+        self._ready.set()
+
+    def _stop_timer(self):
+        """Cancels disconnect timer."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _disconnect(self):
+        """Disconnects subscriber still behind when timer expires."""
+        self._timer = None
+        if self._closed or self._buffer.behind_since is None:
+            return
+        self._disconnected = True
+        self._buffer.listener.slow_consumer("disconnected")
+        if self._on_disconnect is not None:
+            self._on_disconnect()
+        self._close()
+
+    async def _watch(self):
+        """Starts storage watches of new messages of user and channels,
+        messages saved before are read by pages.
+        """
+        try:
+            for login in self._buffer.positions:
+                self._cancels.append(await self._storage.watch_user_messages(
+                    login, self._put, with_pending=False))
+        except BaseException:
+            await self._cancel()
+            raise
+
+    async def _read_pages(self, logins: List[str]):
+        """Reads the next page of every lagging mailbox while buffer has
+        room.
+        """
+        for login in logins:
+            limit = self._buffer.page_limit()
+            if self._closed or not limit:
+                return
+            self._buffer.start_page(login)
+            messages = await self._storage.get_user_messages_page(
+                login, self._buffer.positions[login], limit)
+            if self._closed:
+                return
+            self._buffer.add_page(login, messages, limit)
+
+    def _cancel(self) -> asyncio.Future:
+        """Cancels storage watches in executor, as cancelling a watch may
+        call storage. Returns future of cancellation.
+        """
+        cancels, self._cancels = self._cancels, []
+        return self._loop.run_in_executor(
+            None, lambda: [cancel() for cancel in cancels])
+
+    def _close(self) -> asyncio.Future:
+        """Cancels storage watches and wakes up waiting iterator. Returns
+        future of watches cancellation.
+        """
+        self._closed = True
+        self._stop_timer()
+        self._buffer.clear()
+        self._ready.set()
+        return self._cancel()
+
+    async def __aenter__(self):
+        await self._watch()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._close()
+
+    async def __aiter__(self):
+        while True:
+            self._ready.clear()
+            if self._disconnected:
+                raise SlowConsumerError(
+                    f"subscriber is behind for {self._buffer.timeout}"
+                    " seconds")
+            if self._closed:
+                return
+            if not (self._buffer.messages or self._ended
+                    or self._buffer.lagging):
+                await self._ready.wait()
+                continue
+            if self._buffer.behind_since is not None:
+                self._stop_timer()
+                self._buffer.resume()
+            batch = self._buffer.take()
+            if batch:
+                yield batch
+            elif self._ended:
+                raise WatchBrokenError(
+                    f"storage watch of {self._login} is broken")
+            else:
+                await self._read_pages(self._buffer.lagging_mailboxes())
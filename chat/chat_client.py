@@ -1,12 +1,10 @@
 """The Python implementation of the gRPC chat client."""
 
 import argparse
-import time
-
-import grpc
+import sys
 
 import chat_pb2
-import chat_pb2_grpc
+from chat_client_lib import ChatClient
 
 
 class IncorrectDataError(Exception):
@@ -25,11 +23,17 @@ def create_parser():
         description='''Chat client provides such options:
                 users        - get list of all users,
                 message      - send message for another user,
+                messages     - send messages from file in one stream,
                 subscribe    - make a subscription.''')
-    parser.add_argument("action", choices=["users", "message", "subscribe"],
-                        help="get users, send message, to subscribe.")
+    parser.add_argument("action",
+                        choices=["users", "message", "messages", "subscribe"],
+                        help="get users, send message, send messages, to subscribe.")
     parser.add_argument('-m', '--message', nargs=3,
                         metavar=('login_from', 'login_to', 'text_body'))
+    parser.add_argument('-f', '--file', default='-',
+                        type=argparse.FileType('r'),
+                        help="file with 'login_from login_to text_body' " +
+                        "message per line, '-' for stdin.")
     parser.add_argument('-s', '--subscribe', metavar=('login'))
     parser.add_argument('-host', '--host', default='localhost',
                         help="define host for connection.")
@@ -52,58 +56,76 @@ def subscribe_data_valid_or_raiserror(args):
             "Incorrect input. Please, check if action 'subscribe' and input login.")
 
 
-def choose_action(args, stub):
+def parse_message_line(line):
+    """Creates message from 'login_from login_to text_body' line."""
+    fields = line.rstrip("\n").split(maxsplit=2)
+    if len(fields) != 3:
+        raise IncorrectDataError(
+            f"Incorrect input. Please, check message line: {line!r}.")
+    login_from, login_to, body = fields
+    return chat_pb2.Message(login_from=login_from, login_to=login_to,
+                            body=body)
+
+
+def choose_action(args, client: ChatClient):
     """Invokes one of the functions depending on the selected option."""
     if args.action == "users":
-        get_users_list(stub)
+        get_users_list(client)
     elif args.action == "message":
-        send_message(args, stub)
+        send_message(args, client)
+    elif args.action == "messages":
+        send_messages(args, client)
     else:
-        subscribe(args, stub)
+        subscribe(args, client)
 
 
-def get_users_list(stub):
+def get_users_list(client: ChatClient):
     """Gets list of users if data from client is correct."""
-    users_list = stub.GetUsers(chat_pb2.GetUsersRequest())
-    print(users_list.users)
+    print(client.get_users())
 
 
-def send_message(args, stub):
+def send_message(args, client: ChatClient):
     """Sends message contained sender's login,
     recipient's login, creation timestamp and body-content
     if data from client is correct.
     """
     message_data_valid_or_raiserror(args)
-    login_from = args.message[0]
-    login_to = args.message[1]
-    body = args.message[2]
-    message = chat_pb2.Message(login_from=login_from,
-                               login_to=login_to,
-                               body=body)
-    response = stub.SendMessage(
-        chat_pb2.SendMessageRequest(message=message))
-    print(response.status)
-
-
-def subscribe(args, stub):
+    login_from, login_to, body = args.message
+    print(client.send_message(login_from, login_to, body))
+
+
+def send_messages(args, client: ChatClient):
+    """Sends messages read line by line from file or stdin
+    in one client stream. Lines are read while sending, so
+    file of any size may be sent. File is opened by parser,
+    which reports file that can't be opened.
+    """
+    lines = args.file
+    try:
+        status = client.send_messages(parse_message_line(line)
+                                      for line in lines if line.strip())
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    print(status)
+
+
+def subscribe(args, client: ChatClient):
     """Gets and prints all messages, given in stream 
-    if data from client is correct.
+    if data from client is correct. Subscribes again if
+    connection is lost.
     """
     subscribe_data_valid_or_raiserror(args)
-    login = args.subscribe
-    messages = stub.Subscribe(chat_pb2.SubscribeRequest(login=login))
-    for message in messages:
+    for message in client.subscribe(args.subscribe):
         print(message)
 
 
 def run():
-    """Creates and runs channel."""
+    """Creates client and runs selected action."""
     parser = create_parser()
     args = parser.parse_args()
-    address = "{}:{}".format(args.host, args.port)
-    with grpc.insecure_channel(address) as channel:
-        stub = chat_pb2_grpc.ChatStub(channel)
-        choose_action(args, stub)
+    with ChatClient(args.host, args.port) as client:
+        choose_action(args, client)
 
 
 if __name__ == '__main__':
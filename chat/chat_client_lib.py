@@ -0,0 +1,311 @@
+"""This module contains chat client library: synchronous and asyncio
+clients keeping one long-lived channel for all calls.
+"""
+
+import asyncio
+import threading
+import time
+from typing import AsyncIterator, Iterable, Iterator, List
+
+import grpc
+
+import chat_ext_grpc
+import chat_pb2
+
+KEEPALIVE_TIME_MS = 30000
+KEEPALIVE_TIMEOUT_MS = 10000
+MAX_IN_FLIGHT = 100
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+ACK_BATCH_SIZE = 100
+RECONNECT_CODES = (grpc.StatusCode.UNAVAILABLE,
+                   grpc.StatusCode.DEADLINE_EXCEEDED,
+                   grpc.StatusCode.INTERNAL,
+                   grpc.StatusCode.UNKNOWN)
+
+
+def channel_options(keepalive_time_ms: int, keepalive_timeout_ms: int):
+    """Returns options of channel pinging idle server, so broken
+    connection is noticed even while subscription waits for messages.
+    """
+    return [("grpc.keepalive_time_ms", keepalive_time_ms),
+            ("grpc.keepalive_timeout_ms", keepalive_timeout_ms),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0)]
+
+
+def message_request(login_from: str, login_to: str,
+                    body: str) -> chat_pb2.SendMessageRequest:
+    """Returns SendMessage request of message."""
+    return chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+        login_from=login_from, login_to=login_to, body=body))
+
+
+def subscribe_metadata(cursor: str):
+    """Returns SubscribeFrom metadata resuming stream after cursor."""
+    return ((chat_ext_grpc.CURSOR_KEY, cursor),)
+
+
+def channel_metadata(name: str):
+    """Returns JoinChannel and LeaveChannel metadata of channel."""
+    return ((chat_ext_grpc.CHANNEL_KEY, name),)
+
+
+def should_reconnect(error: grpc.RpcError) -> bool:
+    """Checks if subscription broke because of connection."""
+    return error.code() in RECONNECT_CODES
+
+
+class ChatClient:
+
+    """Chat client over one channel kept open until client is closed.
+    Up to max_in_flight messages may be sent at once with
+    send_message_future. Used as context manager it closes the channel
+    on exit.
+    """
+
+    def __init__(self, host: str = "localhost", port=50051,
+                 keepalive_time_ms: int = KEEPALIVE_TIME_MS,
+                 keepalive_timeout_ms: int = KEEPALIVE_TIMEOUT_MS,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        self.address = "{}:{}".format(host, port)
+        self.channel = grpc.insecure_channel(
+            self.address, channel_options(keepalive_time_ms,
+                                          keepalive_timeout_ms))
+        self.stub = chat_ext_grpc.ChatExtStub(self.channel)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes channel, cancelling calls in progress."""
+        self.channel.close()
+
+    def get_users(self) -> List[chat_pb2.User]:
+        """Returns all users."""
+        return list(self.stub.GetUsers(chat_pb2.GetUsersRequest()).users)
+
+    def iter_users(self, login_prefix: str = "") -> Iterator[chat_pb2.User]:
+        """Yields users with login prefix as server streams them."""
+        return self.stub.StreamUsers(
+            chat_pb2.GetUsersRequest(),
+            metadata=((chat_ext_grpc.LOGIN_PREFIX_KEY, login_prefix),))
+
+    def send_message(self, login_from: str, login_to: str, body: str) -> str:
+        """Sends message and returns status of reply."""
+        return self.stub.SendMessage(
+            message_request(login_from, login_to, body)).status
+
+    def send_message_future(self, login_from: str, login_to: str,
+                            body: str) -> grpc.Future:
+        """Starts sending message and returns future of reply. Waits while
+        max_in_flight messages are being sent.
+        """
+        self._in_flight.acquire()
+        try:
+            future = self.stub.SendMessage.future(
+                message_request(login_from, login_to, body))
+        except Exception:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda future: self._in_flight.release())
+        return future
+
+    def send_messages(self, messages: Iterable[chat_pb2.Message]) -> str:
+        """Sends messages in one stream, they are read from iterable
+        while being sent. Returns status of reply.
+        """
+        return self.stub.SendMessages(
+            chat_pb2.SendMessageRequest(message=message)
+            for message in messages).status
+
+    def ack_messages(self, login: str, cursor: str) -> str:
+        """Acknowledges messages of user up to cursor, so server deletes
+        them. Returns status of reply.
+        """
+        return self.stub.AckMessages(chat_pb2.SubscribeRequest(login=login),
+                                     metadata=subscribe_metadata(cursor)).status
+
+    def join_channel(self, login: str, name: str) -> str:
+        """Makes user member of channel, messages sent to "#name" after
+        joining are merged into Subscribe stream of the user. Returns
+        status of reply.
+        """
+        return self.stub.JoinChannel(chat_pb2.SubscribeRequest(login=login),
+                                     metadata=channel_metadata(name)).status
+
+    def leave_channel(self, login: str, name: str) -> str:
+        """Removes user from members of channel. Returns status of reply."""
+        return self.stub.LeaveChannel(chat_pb2.SubscribeRequest(login=login),
+                                      metadata=channel_metadata(name)).status
+
+    def subscribe(self, login: str, cursor: str = "", reconnect: bool = True,
+                  reconnect_delay: float = RECONNECT_DELAY,
+                  ack_batch_size: int = ACK_BATCH_SIZE
+                  ) -> Iterator[chat_pb2.Message]:
+        """Yields messages of user after cursor until the caller stops
+        iteration. Message is received when the next one is asked for,
+        received messages are acknowledged in batches. If connection is
+        lost or server ends the stream subscribes again with growing
+        delay after the last received message, without reconnect the
+        iteration ends with the stream. Messages which are not
+        acknowledged when iteration is stopped are delivered again by the
+        next subscription.
+        """
+        delay = reconnect_delay
+        received = 0
+        while True:
+            call = self.stub.SubscribeFrom(
+                chat_pb2.SubscribeRequest(login=login),
+                metadata=subscribe_metadata(cursor))
+            try:
+                for message, message_id in call:
+                    delay = reconnect_delay
+                    yield message
+                    if not message_id:
+                        continue
+                    cursor = message_id
+                    received += 1
+                    if received == ack_batch_size:
+                        self.ack_messages(login, cursor)
+                        received = 0
+                if not reconnect:
+                    return
+            except grpc.RpcError as error:
+                if not reconnect or not should_reconnect(error):
+                    raise
+            finally:
+                call.cancel()
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            # Subscribing after cursor acknowledges received messages.
+            received = 0
+
+
+class AsyncChatClient:
+
+    """Asyncio chat client over one channel kept open until client is
+    closed. Up to max_in_flight messages are sent at once. Used as async
+    context manager it closes the channel on exit.
+    """
+
+    def __init__(self, host: str = "localhost", port=50051,
+                 keepalive_time_ms: int = KEEPALIVE_TIME_MS,
+                 keepalive_timeout_ms: int = KEEPALIVE_TIMEOUT_MS,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        self.address = "{}:{}".format(host, port)
+        self.channel = grpc.aio.insecure_channel(
+            self.address, channel_options(keepalive_time_ms,
+                                          keepalive_timeout_ms))
+        self.stub = chat_ext_grpc.ChatExtStub(self.channel)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Closes channel, cancelling calls in progress."""
+        await self.channel.close()
+
+    async def get_users(self) -> List[chat_pb2.User]:
+        """Returns all users."""
+        reply = await self.stub.GetUsers(chat_pb2.GetUsersRequest())
+        return list(reply.users)
+
+    async def iter_users(self,
+                         login_prefix: str = "") -> AsyncIterator[chat_pb2.User]:
+        """Yields users with login prefix as server streams them."""
+        call = self.stub.StreamUsers(
+            chat_pb2.GetUsersRequest(),
+            metadata=((chat_ext_grpc.LOGIN_PREFIX_KEY, login_prefix),))
+        async for user in call:
+            yield user
+
+    async def send_message(self, login_from: str, login_to: str,
+                           body: str) -> str:
+        """Sends message and returns status of reply. Waits while
+        max_in_flight messages are being sent.
+        """
+        async with self._in_flight:
+            reply = await self.stub.SendMessage(
+                message_request(login_from, login_to, body))
+        return reply.status
+
+    async def send_messages(self, messages) -> str:
+        """Sends messages of iterable or async iterable in one stream.
+        Returns status of reply.
+        """
+        if hasattr(messages, "__aiter__"):
+            requests = (chat_pb2.SendMessageRequest(message=message)
+                        async for message in messages)
+        else:
+            requests = iter([chat_pb2.SendMessageRequest(message=message)
+                             for message in messages])
+        reply = await self.stub.SendMessages(requests)
+        return reply.status
+
+    async def ack_messages(self, login: str, cursor: str) -> str:
+        """Acknowledges messages of user up to cursor, so server deletes
+        them. Returns status of reply.
+        """
+        reply = await self.stub.AckMessages(
+            chat_pb2.SubscribeRequest(login=login),
+            metadata=subscribe_metadata(cursor))
+        return reply.status
+
+    async def join_channel(self, login: str, name: str) -> str:
+        """Makes user member of channel. Returns status of reply."""
+        reply = await self.stub.JoinChannel(
+            chat_pb2.SubscribeRequest(login=login),
+            metadata=channel_metadata(name))
+        return reply.status
+
+    async def leave_channel(self, login: str, name: str) -> str:
+        """Removes user from members of channel. Returns status of reply."""
+        reply = await self.stub.LeaveChannel(
+            chat_pb2.SubscribeRequest(login=login),
+            metadata=channel_metadata(name))
+        return reply.status
+
+    async def subscribe(self, login: str, cursor: str = "",
+                        reconnect: bool = True,
+                        reconnect_delay: float = RECONNECT_DELAY,
+                        ack_batch_size: int = ACK_BATCH_SIZE
+                        ) -> AsyncIterator[chat_pb2.Message]:
+        """Yields messages of user after cursor, acknowledging and
+        resuming them in the same way as ChatClient does.
+        """
+        delay = reconnect_delay
+        received = 0
+        while True:
+            call = self.stub.SubscribeFrom(
+                chat_pb2.SubscribeRequest(login=login),
+                metadata=subscribe_metadata(cursor))
+            try:
+                async for message, message_id in call:
+                    delay = reconnect_delay
+                    yield message
+                    if not message_id:
+                        continue
+                    cursor = message_id
+                    received += 1
+                    if received == ack_batch_size:
+                        await self.ack_messages(login, cursor)
+                        received = 0
+                if not reconnect:
+                    return
+            except grpc.RpcError as error:
+                if not reconnect or not should_reconnect(error):
+                    raise
+            finally:
+                call.cancel()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            received = 0
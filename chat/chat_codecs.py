@@ -0,0 +1,184 @@
+"""This module contains codecs encoding users and messages into values
+saved by storages. Every encoded value starts with version of its codec,
+so values written by any codec, including JSON values written before
+codecs were introduced, are readable whatever codec is used for writing.
+"""
+
+import json
+from abc import ABC, abstractmethod
+from dataclasses import asdict
+
+import chat_pb2
+from chat_convert import attach_pb
+from chat_storage import Channel, Message, User
+
+
+class UnknownCodecError(Exception):
+
+    """Exception raised if unknown codec name or value version is used."""
+
+    pass
+
+
+class Codec(ABC):
+
+    """Base class for codecs. Version is the first byte of encoded value."""
+
+    version: bytes
+
+    @abstractmethod
+    def encode_user(self, user: User) -> bytes:
+        """Encodes user into value."""
+        pass
+
+    @abstractmethod
+    def decode_user(self, value: bytes) -> User:
+        """Decodes user from value."""
+        pass
+
+    @abstractmethod
+    def encode_message(self, message: Message) -> bytes:
+        """Encodes message into value."""
+        pass
+
+    @abstractmethod
+    def decode_message(self, value: bytes) -> Message:
+        """Decodes message from value."""
+        pass
+
+
+class JsonCodec(Codec):
+
+    """Encodes entities as JSON objects, version is the opening brace."""
+
+    version = b"{"
+
+    def encode_user(self, user: User) -> bytes:
+        """Encodes user as JSON object."""
+        return json.dumps(asdict(user)).encode()
+
+    def decode_user(self, value: bytes) -> User:
+        """Decodes user from JSON object."""
+        return User(**json.loads(value))
+
+    def encode_message(self, message: Message) -> bytes:
+        """Encodes message as JSON object."""
+        return json.dumps(asdict(message)).encode()
+
+    def decode_message(self, value: bytes) -> Message:
+        """Decodes message from JSON object.
+        Values saved before message ids were introduced have no id.
+        """
+        return Message(**{"message_id": None, **json.loads(value)})
+
+
+def encode_varint(number: int) -> bytes:
+    """Encodes non-negative number as protobuf varint: seven bits per
+    byte, the lowest first, high bit set on all bytes but the last.
+    """
+    encoded = bytearray()
+    while number > 0x7f:
+        encoded.append(number & 0x7f | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def decode_varint(value: bytes, position: int):
+    """Decodes varint starting at position of value. Returns number and
+    position after it.
+    """
+    number = shift = 0
+    while True:
+        byte = value[position]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+class ProtobufCodec(Codec):
+
+    """Encodes entities as chat_pb2 messages after version byte.
+    Message id, which chat_pb2.Message does not have, is put between
+    version and protobuf message, prefixed by its length as varint,
+    one byte for ids shorter than 128 bytes. Values are about half as
+    big as JSON ones; they are encoded and decoded faster than JSON
+    with C protobuf runtime only, with pure Python one they are slower.
+    """
+
+    version = b"\x01"
+
+    def encode_user(self, user: User) -> bytes:
+        """Encodes user as chat_pb2.User."""
+        return self.version + chat_pb2.User(
+            login=user.login, full_name=user.full_name).SerializeToString()
+
+    def decode_user(self, value: bytes) -> User:
+        """Decodes user from chat_pb2.User."""
+        user = chat_pb2.User.FromString(value[1:])
+        return User(user.login, user.full_name)
+
+    def encode_message(self, message: Message) -> bytes:
+        """Encodes message id and message as chat_pb2.Message."""
+        message_id = (message.message_id or "").encode()
+        return (self.version + encode_varint(len(message_id)) + message_id +
+                chat_pb2.Message(login_from=message.login_from,
+                                 login_to=message.login_to,
+                                 created_at=message.created_at,
+                                 body=message.body).SerializeToString())
+
+    def decode_message(self, value: bytes) -> Message:
+        """Decodes message id and message from chat_pb2.Message,
+        which is attached to message ready to be sent to client.
+        """
+        id_length, id_start = decode_varint(value, 1)
+        id_end = id_start + id_length
+        message_pb = chat_pb2.Message.FromString(value[id_end:])
+        return attach_pb(Message(message_pb.login_from, message_pb.login_to,
+                                 message_pb.body, message_pb.created_at,
+                                 value[id_start:id_end].decode() or None),
+                         message_pb)
+
+
+CODECS = {"json": JsonCodec(), "protobuf": ProtobufCodec()}
+CODEC_VERSIONS = {codec.version: codec for codec in CODECS.values()}
+
+
+def get_codec(name: str) -> Codec:
+    """Returns codec by name."""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise UnknownCodecError(f"Unknown codec: {name}")
+
+
+def get_value_codec(value: bytes) -> Codec:
+    """Returns codec which encoded value."""
+    try:
+        return CODEC_VERSIONS[value[:1]]
+    except KeyError:
+        raise UnknownCodecError(f"Unknown value version: {value[:1]!r}")
+
+
+def decode_user(value: bytes) -> User:
+    """Decodes user encoded by any codec."""
+    return get_value_codec(value).decode_user(value)
+
+
+def decode_message(value: bytes) -> Message:
+    """Decodes message encoded by any codec."""
+    return get_value_codec(value).decode_message(value)
+
+
+def encode_channel(channel: Channel) -> bytes:
+    """Encodes channel as JSON object, whatever codec is used for users
+    and messages, as chat_protos has no message for channel.
+    """
+    return json.dumps(asdict(channel)).encode()
+
+
+def decode_channel(value: bytes) -> Channel:
+    """Decodes channel from JSON object."""
+    return Channel(**json.loads(value))
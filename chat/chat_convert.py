@@ -0,0 +1,49 @@
+"""This module contains conversions between storage entities and
+chat_pb2 messages. Message converted for client is kept on the entity,
+so storages which decode protobuf values or keep messages received from
+clients hand back messages ready to be streamed without rebuilding them.
+"""
+
+from typing import List
+
+import chat_pb2
+from chat_storage import Message, User
+
+
+def attach_pb(message: Message, message_pb: chat_pb2.Message) -> Message:
+    """Keeps protobuf message equal to message on it and returns message."""
+    object.__setattr__(message, "_pb", message_pb)
+    return message
+
+
+def message_from_pb(message_pb: chat_pb2.Message) -> Message:
+    """Converts message from client to storage message. Protobuf message
+    is taken over, not copied: it gets creation time and is kept ready
+    to be streamed to recipient, so caller must not change it later.
+    """
+    message = Message(message_pb.login_from, message_pb.login_to,
+                      message_pb.body)
+    message_pb.created_at = message.created_at
+    return attach_pb(message, message_pb)
+
+
+def message_to_pb(message: Message) -> chat_pb2.Message:
+    """Returns protobuf message attached to storage message, building
+    and attaching it if there is none.
+    """
+    try:
+        return message._pb
+    except AttributeError:
+        return attach_pb(message, chat_pb2.Message(
+            login_from=message.login_from, login_to=message.login_to,
+            created_at=message.created_at, body=message.body))._pb
+
+
+def user_to_pb(user: User) -> chat_pb2.User:
+    """Converts storage user to protobuf user."""
+    return chat_pb2.User(login=user.login, full_name=user.full_name)
+
+
+def users_reply(users: List[User]) -> chat_pb2.GetUsersReply:
+    """Converts users from storage to GetUsers reply."""
+    return chat_pb2.GetUsersReply(users=[user_to_pb(user) for user in users])
@@ -0,0 +1,236 @@
+"""This module contains Chat service methods served in addition to
+the ones generated from chat_protos into chat_pb2_grpc. They are served
+under the same service name and reuse existing chat_pb2 messages, so
+clients built from chat_protos keep working unchanged. Parameters
+missing from existing messages are passed as call metadata.
+"""
+
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote, unquote
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+
+SERVICE_NAME = chat_pb2.DESCRIPTOR.services_by_name["Chat"].full_name
+
+PAGE_SIZE_KEY = "page-size"
+PAGE_TOKEN_KEY = "page-token"
+LOGIN_PREFIX_KEY = "login-prefix"
+NEXT_PAGE_TOKEN_KEY = "next-page-token"
+FORWARDED_BY_KEY = "forwarded-by"
+CURSOR_KEY = "cursor"
+CHANNEL_KEY = "channel"
+RETRY_AFTER_KEY = "retry-after"
+CURSOR_SEPARATOR = ";"
+SAVED_MESSAGES_KEY = "saved-messages"
+MAX_PAGE_SIZE = 1000
+# SubscribeFrom streams Message with id of message in field number
+# unused by Message, so the reply is parsed as Message as well.
+MESSAGE_ID_TAG = bytes([15 << 3 | 2])
+
+
+def users_page_metadata(page_size: int, page_token: str = "",
+                        login_prefix: str = ""):
+    """Returns GetUsers request metadata asking for one page of users."""
+    return ((PAGE_SIZE_KEY, str(page_size)), (PAGE_TOKEN_KEY, page_token),
+            (LOGIN_PREFIX_KEY, login_prefix))
+
+
+def read_users_page_metadata(metadata):
+    """Returns (page_token, page_size, login_prefix) of GetUsers request
+    metadata, or None if the whole list is requested. Raises ValueError
+    if page size is not a number from 1 to MAX_PAGE_SIZE.
+    """
+    values = dict(metadata or ())
+    if PAGE_SIZE_KEY not in values and LOGIN_PREFIX_KEY not in values:
+        return None
+    page_size = int(values.get(PAGE_SIZE_KEY) or MAX_PAGE_SIZE)
+    if not 0 < page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page size must be from 1 to {MAX_PAGE_SIZE}")
+    return (values.get(PAGE_TOKEN_KEY, ""), page_size,
+            values.get(LOGIN_PREFIX_KEY, ""))
+
+
+def next_page_token(users, page_size: int) -> str:
+    """Returns token of page following users, empty for the last page."""
+    return users[-1].login if len(users) == page_size else ""
+
+
+def read_cursor_metadata(metadata) -> str:
+    """Returns cursor of request metadata, empty if there is none."""
+    return dict(metadata or ()).get(CURSOR_KEY, "")
+
+
+def format_cursor(position: Optional[int], channels: Dict[str, int]) -> str:
+    """Returns SubscribeFrom cursor: sequence number of the last message
+    read from mailbox of user, empty if there is none, followed by
+    ";name=seq" for every channel read from, with percent-encoded
+    channel name.
+    """
+    return CURSOR_SEPARATOR.join(
+        ["" if position is None else str(position)]
+        + ["{}={}".format(quote(name, safe=""), channel_position)
+           for name, channel_position in channels.items()])
+
+
+def parse_cursor(cursor: str) -> Tuple[Optional[int], Dict[str, int]]:
+    """Returns position in mailbox of user, None if there is none, and
+    positions in channels of cursor made by format_cursor. Raises
+    ValueError if it is malformed.
+    """
+    position, *items = cursor.split(CURSOR_SEPARATOR)
+    channels = {}
+    try:
+        for item in items:
+            name, separator, channel_position = item.partition("=")
+            if not (name and separator):
+                raise ValueError(item)
+            channels[unquote(name)] = int(channel_position)
+        return int(position) if position else None, channels
+    except ValueError:
+        raise ValueError(f"malformed cursor: {cursor}") from None
+
+
+def read_channel_metadata(metadata) -> str:
+    """Returns channel name of request metadata, empty if there is none."""
+    return dict(metadata or ()).get(CHANNEL_KEY, "")
+
+
+def retry_after_metadata(seconds: float, saved_messages: int = None):
+    """Returns trailing metadata of rejected call telling client to retry
+    after seconds and, for rejected stream of messages, how many of its
+    messages were saved before the rejection.
+    """
+    metadata = ((RETRY_AFTER_KEY, "{:.3f}".format(seconds)),)
+    if saved_messages is not None:
+        metadata += ((SAVED_MESSAGES_KEY, str(saved_messages)),)
+    return metadata
+
+
+def read_retry_after_metadata(metadata) -> float:
+    """Returns seconds to wait before retry from trailing metadata of
+    rejected call, None if there are none.
+    """
+    value = dict(metadata or ()).get(RETRY_AFTER_KEY)
+    return float(value) if value else None
+
+
+def read_saved_messages_metadata(metadata) -> int:
+    """Returns number of messages saved from rejected stream from
+    trailing metadata of the call, None if there is none.
+    """
+    value = dict(metadata or ()).get(SAVED_MESSAGES_KEY)
+    return int(value) if value else None
+
+
+def _encode_varint(value: int) -> bytes:
+    """Returns protobuf varint encoding of value."""
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def serialize_message_with_id(reply) -> bytes:
+    """Serializes (message, message_id) pair of SubscribeFrom stream."""
+    message, message_id = reply
+    message_id = message_id.encode()
+    return (MESSAGE_ID_TAG + _encode_varint(len(message_id)) + message_id
+            + message.SerializeToString())
+
+
+def parse_message_with_id(data: bytes):
+    """Returns (message, message_id) pair of SubscribeFrom reply."""
+    if not data.startswith(MESSAGE_ID_TAG):
+        return chat_pb2.Message.FromString(data), ""
+    length, shift, position = 0, 0, len(MESSAGE_ID_TAG)
+    while True:
+        byte = data[position]
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        position += 1
+        if byte < 0x80:
+            break
+    message_id = data[position:position + length].decode()
+    return chat_pb2.Message.FromString(data[position + length:]), message_id
+
+
+class ChatExtStub(chat_pb2_grpc.ChatStub):
+
+    """Chat stub with additional methods of Chat service."""
+
+    def __init__(self, channel):
+        super().__init__(channel)
+        self.SendMessages = channel.stream_unary(
+            f"/{SERVICE_NAME}/SendMessages",
+            request_serializer=chat_pb2.SendMessageRequest.SerializeToString,
+            response_deserializer=chat_pb2.SendMessageReply.FromString,
+        )
+        self.StreamUsers = channel.unary_stream(
+            f"/{SERVICE_NAME}/StreamUsers",
+            request_serializer=chat_pb2.GetUsersRequest.SerializeToString,
+            response_deserializer=chat_pb2.User.FromString,
+        )
+        self.SubscribeFrom = channel.unary_stream(
+            f"/{SERVICE_NAME}/SubscribeFrom",
+            request_serializer=chat_pb2.SubscribeRequest.SerializeToString,
+            response_deserializer=parse_message_with_id,
+        )
+        self.AckMessages = channel.unary_unary(
+            f"/{SERVICE_NAME}/AckMessages",
+            request_serializer=chat_pb2.SubscribeRequest.SerializeToString,
+            response_deserializer=chat_pb2.SendMessageReply.FromString,
+        )
+        self.JoinChannel = channel.unary_unary(
+            f"/{SERVICE_NAME}/JoinChannel",
+            request_serializer=chat_pb2.SubscribeRequest.SerializeToString,
+            response_deserializer=chat_pb2.SendMessageReply.FromString,
+        )
+        self.LeaveChannel = channel.unary_unary(
+            f"/{SERVICE_NAME}/LeaveChannel",
+            request_serializer=chat_pb2.SubscribeRequest.SerializeToString,
+            response_deserializer=chat_pb2.SendMessageReply.FromString,
+        )
+
+
+def add_ChatExtServicer_to_server(servicer, server):
+    """Registers additional methods of Chat servicer on server."""
+    rpc_method_handlers = {
+        "SendMessages": grpc.stream_unary_rpc_method_handler(
+            servicer.SendMessages,
+            request_deserializer=chat_pb2.SendMessageRequest.FromString,
+            response_serializer=chat_pb2.SendMessageReply.SerializeToString,
+        ),
+        "StreamUsers": grpc.unary_stream_rpc_method_handler(
+            servicer.StreamUsers,
+            request_deserializer=chat_pb2.GetUsersRequest.FromString,
+            response_serializer=chat_pb2.User.SerializeToString,
+        ),
+        "SubscribeFrom": grpc.unary_stream_rpc_method_handler(
+            servicer.SubscribeFrom,
+            request_deserializer=chat_pb2.SubscribeRequest.FromString,
+            response_serializer=serialize_message_with_id,
+        ),
+        "AckMessages": grpc.unary_unary_rpc_method_handler(
+            servicer.AckMessages,
+            request_deserializer=chat_pb2.SubscribeRequest.FromString,
+            response_serializer=chat_pb2.SendMessageReply.SerializeToString,
+        ),
+        "JoinChannel": grpc.unary_unary_rpc_method_handler(
+            servicer.JoinChannel,
+            request_deserializer=chat_pb2.SubscribeRequest.FromString,
+            response_serializer=chat_pb2.SendMessageReply.SerializeToString,
+        ),
+        "LeaveChannel": grpc.unary_unary_rpc_method_handler(
+            servicer.LeaveChannel,
+            request_deserializer=chat_pb2.SubscribeRequest.FromString,
+            response_serializer=chat_pb2.SendMessageReply.SerializeToString,
+        ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+        SERVICE_NAME, rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
@@ -0,0 +1,394 @@
+"""This module contains server metrics exported in Prometheus text format
+over HTTP: gRPC interceptors timing every RPC and counting streamed
+messages, storage wrapper timing every storage call and listener of
+subscriber delivery buffers.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+import grpc
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from chat_storage import (BACKLOG_PAGE_SIZE, BufferListener, Channel, Message,
+                          Storage, StorageWrapper, User, is_channel,
+                          message_seq)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                 16777216)
+
+RPC_DURATION = Histogram(
+    "chat_rpc_duration_seconds", "Duration of served RPCs.",
+    ("method", "status"), buckets=LATENCY_BUCKETS)
+ACTIVE_STREAMS = Gauge(
+    "chat_active_streams", "Number of open response streams.", ("method",))
+STREAM_MESSAGES = Counter(
+    "chat_stream_messages_sent_total",
+    "Messages sent to clients in response streams.", ("method",))
+STORAGE_DURATION = Histogram(
+    "chat_storage_duration_seconds", "Duration of storage calls.",
+    ("method", "status"), buckets=LATENCY_BUCKETS)
+USER_QUEUE_DEPTH = Gauge(
+    "chat_user_queue_depth",
+    "Messages pushed to subscriber and not acknowledged yet.", ("login",))
+BUFFERED_BYTES = Gauge(
+    "chat_subscribe_buffered_bytes",
+    "Bytes of messages buffered for subscribers and not streamed yet.")
+STREAM_BUFFERED_BYTES = Histogram(
+    "chat_subscribe_stream_buffered_bytes",
+    "Bytes buffered for one subscriber stream, observed as messages "
+    "are buffered.", buckets=BYTES_BUCKETS)
+SLOW_CONSUMERS = Counter(
+    "chat_slow_consumers_total",
+    "Subscribers which fell behind their streams.", ("action",))
+
+
+def method_name(handler_call_details) -> str:
+    """Returns short RPC method name, e.g. SendMessage."""
+    return handler_call_details.method.rsplit("/", 1)[-1]
+
+
+def wrap_handler(handler: grpc.RpcMethodHandler, method: str,
+                 wrap_unary, wrap_stream) -> grpc.RpcMethodHandler:
+    """Returns handler with its behavior wrapped by wrap_stream if it
+    streams responses, otherwise by wrap_unary.
+    """
+    for kind in ("unary_unary", "unary_stream", "stream_unary",
+                 "stream_stream"):
+        behavior = getattr(handler, kind)
+        if behavior is not None:
+            break
+    wrap = wrap_stream if handler.response_streaming else wrap_unary
+    return handler._replace(**{kind: wrap(method, behavior)})
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+
+    """Times every RPC by method and status, for response streams counts
+    open streams and sent messages.
+    """
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        return wrap_handler(handler, method_name(handler_call_details),
+                            self._unary, self._stream)
+
+    @staticmethod
+    def _unary(method: str, behavior):
+        def wrapper(request, context):
+            start = time.perf_counter()
+            status = "error"
+            try:
+                response = behavior(request, context)
+                status = "ok"
+                return response
+            finally:
+                RPC_DURATION.labels(method, status).observe(
+                    time.perf_counter() - start)
+        return wrapper
+
+    @staticmethod
+    def _stream(method: str, behavior):
+        def wrapper(request, context):
+            start = time.perf_counter()
+            status = "error"
+            active = ACTIVE_STREAMS.labels(method)
+            sent = STREAM_MESSAGES.labels(method)
+            active.inc()
+            try:
+                for response in behavior(request, context):
+                    sent.inc()
+                    yield response
+                status = "ok"
+            finally:
+                active.dec()
+                RPC_DURATION.labels(method, status).observe(
+                    time.perf_counter() - start)
+        return wrapper
+
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+
+    """Records the same metrics as MetricsInterceptor on asyncio server."""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        return wrap_handler(handler, method_name(handler_call_details),
+                            self._unary, self._stream)
+
+    @staticmethod
+    def _unary(method: str, behavior):
+        async def wrapper(request, context):
+            start = time.perf_counter()
+            status = "error"
+            try:
+                response = await behavior(request, context)
+                status = "ok"
+                return response
+            finally:
+                RPC_DURATION.labels(method, status).observe(
+                    time.perf_counter() - start)
+        return wrapper
+
+    @staticmethod
+    def _stream(method: str, behavior):
+        async def wrapper(request, context):
+            start = time.perf_counter()
+            status = "error"
+            active = ACTIVE_STREAMS.labels(method)
+            sent = STREAM_MESSAGES.labels(method)
+            active.inc()
+            try:
+                async for response in behavior(request, context):
+                    sent.inc()
+                    yield response
+                status = "ok"
+            finally:
+                active.dec()
+                RPC_DURATION.labels(method, status).observe(
+                    time.perf_counter() - start)
+        return wrapper
+
+
+def queue_key(message: Message):
+    """Returns key of message in queue of its user: sequence number of
+    saved message, its id if it has none.
+    """
+    seq = message_seq(message)
+    return message.message_id if seq is None else seq
+
+
+class InstrumentedStorage(StorageWrapper):
+
+    """Times every call of wrapped storage by method and status and
+    tracks queue depth of every watched user: messages pushed to its
+    watches or read for them page by page and not deleted yet. Messages
+    are kept by their keys, so the ones pushed to several watches of
+    the user or read by pages too are counted once.
+    """
+
+    def __init__(self, storage: Storage):
+        super().__init__(storage)
+        self._lock = threading.Lock()
+        # Number of watches and keys of queued messages of every watched
+        # user.
+        self._watches: Dict[str, int] = {}
+        self._queued: Dict[str, Set] = {}
+
+    def _count(self, login: str, messages: List[Message]):
+        """Adds messages pushed to watch of user or read for it to its
+        queue depth.
+        """
+        with self._lock:
+            queued = self._queued.get(login)
+            if queued is None:
+                return
+            queued.update(map(queue_key, messages))
+            USER_QUEUE_DEPTH.labels(login).set(len(queued))
+
+    def _uncount(self, login: str, removed: Callable[[object], bool]):
+        """Takes messages of user removed from storage from its queue
+        depth.
+        """
+        with self._lock:
+            queued = self._queued.get(login)
+            if queued is None:
+                return
+            queued.difference_update([key for key in queued if removed(key)])
+            USER_QUEUE_DEPTH.labels(login).set(len(queued))
+
+    def _unwatch(self, login: str):
+        """Drops queue depth of user when the last of its watches ends."""
+        with self._lock:
+            self._watches[login] -= 1
+            if not self._watches[login]:
+                del self._watches[login]
+                del self._queued[login]
+                USER_QUEUE_DEPTH.remove(login)
+
+    def _timed(self, method: str, *args):
+        """Calls method of wrapped storage and records its duration."""
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = getattr(self.storage, method)(*args)
+            status = "ok"
+            return result
+        finally:
+            STORAGE_DURATION.labels(method, status).observe(
+                time.perf_counter() - start)
+
+    def create_user(self, user: User):
+        """Saves user in wrapped storage."""
+        self._timed("create_user", user)
+
+    def get_users_list(self) -> List[User]:
+        """Returns users list from wrapped storage."""
+        return self._timed("get_users_list")
+
+    def get_users_page(self, after_login: str = "", limit: int = 100,
+                       login_prefix: str = "") -> List[User]:
+        """Returns page of users from wrapped storage."""
+        return self._timed("get_users_page", after_login, limit, login_prefix)
+
+    def create_message(self, message: Message):
+        """Saves message in wrapped storage."""
+        self._timed("create_message", message)
+
+    def create_messages(self, messages: List[Message]):
+        """Saves batch of messages in wrapped storage."""
+        self._timed("create_messages", messages)
+
+    def get_user_messages(self, login: str) -> List[Message]:
+        """Returns list of messages from wrapped storage."""
+        return self._timed("get_user_messages", login)
+
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = BACKLOG_PAGE_SIZE
+                               ) -> List[Message]:
+        """Returns page of messages of user from wrapped storage, counting
+        them in queue depth of the user if it is watched, as they are
+        read for the watch.
+        """
+        messages = self._timed("get_user_messages_page", login, after_seq,
+                               limit)
+        self._count(login, messages)
+        return messages
+
+    def delete_user_message(self, message: Message):
+        """Deletes message in wrapped storage, taking it from queue depth."""
+        self.delete_user_messages([message])
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of messages in wrapped storage, taking them from
+        queue depth of watched users.
+        """
+        self._timed("delete_user_messages", messages)
+        deleted: Dict[str, Set] = {}
+        for message in messages:
+            deleted.setdefault(message.login_to, set()).add(
+                queue_key(message))
+        for login, keys in deleted.items():
+            self._uncount(login, keys.__contains__)
+
+    def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user up to cursor in wrapped storage,
+        taking them from queue depth of the user if it is watched.
+        """
+        count = self._timed("ack_user_messages", login, cursor)
+        self._uncount(login, lambda key: isinstance(key, int)
+                      and key <= cursor)
+        return count
+
+    def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Watches messages of user, counting pushed messages in user
+        queue depth until the last of its watches is cancelled. Channel
+        logs are not deleted by reading, so their watches are not
+        counted.
+        """
+        if is_channel(login):
+            return self._timed("watch_user_messages", login, callback,
+                               with_pending)
+        with self._lock:
+            self._watches[login] = self._watches.get(login, 0) + 1
+            queued = self._queued.setdefault(login, set())
+            USER_QUEUE_DEPTH.labels(login).set(len(queued))
+
+        def on_messages(messages: Optional[List[Message]]):
+            if messages:
+                self._count(login, messages)
+            callback(messages)
+
+        try:
+            cancel = self._timed("watch_user_messages", login, on_messages,
+                                 with_pending)
+        except Exception:
+            self._unwatch(login)
+            raise
+        cancelled = False
+
+        def cancel_watch():
+            nonlocal cancelled
+            cancel()
+            with self._lock:
+                if cancelled:
+                    return
+                cancelled = True
+            self._unwatch(login)
+
+        return cancel_watch
+
+    def compact_messages(self) -> int:
+        """Compacts messages of wrapped storage."""
+        return self._timed("compact_messages")
+
+    def create_channel(self, channel: Channel):
+        """Saves channel in wrapped storage."""
+        self._timed("create_channel", channel)
+
+    def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel from wrapped storage."""
+        return self._timed("get_channel", name)
+
+    def last_message_seq(self, login: str) -> int:
+        """Returns the last message seq of mailbox in wrapped storage."""
+        return self._timed("last_message_seq", login)
+
+    def join_channel(self, name: str, login: str,
+                     cursor: Optional[int] = None):
+        """Adds channel member in wrapped storage."""
+        self._timed("join_channel", name, login, cursor)
+
+    def leave_channel(self, name: str, login: str):
+        """Removes channel member in wrapped storage."""
+        self._timed("leave_channel", name, login)
+
+    def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user from wrapped storage."""
+        return self._timed("get_user_channels", login)
+
+    def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of channel member in wrapped storage."""
+        self._timed("set_channel_cursor", name, login, cursor)
+
+    def register_subscriber(self, login: str,
+                            node_address: str) -> Callable[[], None]:
+        """Registers subscriber node in wrapped storage."""
+        return self._timed("register_subscriber", login, node_address)
+
+    def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns subscriber node from wrapped storage."""
+        return self._timed("get_subscriber_node", login)
+
+
+class BufferMetrics(BufferListener):
+
+    """Records bytes buffered for subscriber streams and slow consumers."""
+
+    def buffered(self, delta: int, size: int):
+        """Adds delta to buffered bytes, observes size of stream buffer
+        as it grows.
+        """
+        BUFFERED_BYTES.inc(delta)
+        if delta > 0:
+            STREAM_BUFFERED_BYTES.observe(size)
+
+    def slow_consumer(self, action: str):
+        """Counts slow consumer by action."""
+        SLOW_CONSUMERS.labels(action).inc()
+
+
+def start_metrics_server(port: int, host: str = ""):
+    """Serves metrics of default registry over HTTP in daemon thread."""
+    start_http_server(port, host)
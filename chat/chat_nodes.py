@@ -0,0 +1,125 @@
+"""This module contains forwarding of messages between chat server
+nodes. Node saving message into storage whose watches don't reach other
+nodes passes it to the node serving recipient's subscription, which
+saves it into its own storage and pushes it to the stream.
+"""
+
+import logging
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import grpc
+
+import chat_ext_grpc
+import chat_pb2
+from chat_convert import message_to_pb
+from chat_storage import Message
+
+FORWARD_TIMEOUT = 5.0
+
+
+def is_forwarded(metadata) -> bool:
+    """Checks if request was forwarded by another node, such requests
+    are never forwarded again.
+    """
+    return chat_ext_grpc.FORWARDED_BY_KEY in dict(metadata or ())
+
+
+def group_by_node(
+        messages: List[Message], node_address: str,
+        get_node: Callable[[str], Optional[str]]
+) -> Tuple[List[Message], Dict[str, List[Message]]]:
+    """Splits messages into ones kept by this node and ones grouped by
+    other nodes serving subscriptions of their recipients. Node of every
+    recipient is looked up once.
+    """
+    nodes = {}
+    local = []
+    remote = defaultdict(list)
+    for message in messages:
+        if message.login_to not in nodes:
+            nodes[message.login_to] = get_node(message.login_to)
+        node = nodes[message.login_to]
+        if node is None or node == node_address:
+            local.append(message)
+        else:
+            remote[node].append(message)
+    return local, remote
+
+
+def forward_requests(messages: List[Message]):
+    """Returns SendMessages requests of messages."""
+    return [chat_pb2.SendMessageRequest(message=message_to_pb(message))
+            for message in messages]
+
+
+class NodeForwarder:
+
+    """Sends messages to other nodes over channels kept per node."""
+
+    def __init__(self, node_address: str, timeout: float = FORWARD_TIMEOUT):
+        self.node_address = node_address
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._stubs = {}
+
+    def _get_stub(self, node: str) -> chat_ext_grpc.ChatExtStub:
+        """Returns stub of node, opening channel on the first call."""
+        with self._lock:
+            if node not in self._stubs:
+                self._stubs[node] = chat_ext_grpc.ChatExtStub(
+                    grpc.insecure_channel(node))
+            return self._stubs[node]
+
+    def forward(self, get_node: Callable[[str], Optional[str]],
+                messages: List[Message]) -> List[Message]:
+        """Forwards messages to nodes serving their recipients. Returns
+        messages to be saved by this node, including ones whose node
+        could not be reached.
+        """
+        local, remote = group_by_node(messages, self.node_address, get_node)
+        for node, node_messages in remote.items():
+            try:
+                self._get_stub(node).SendMessages(
+                    iter(forward_requests(node_messages)),
+                    timeout=self.timeout,
+                    metadata=((chat_ext_grpc.FORWARDED_BY_KEY,
+                               self.node_address),))
+            except grpc.RpcError as error:
+                logging.warning("Forwarding to %s failed: %s", node, error)
+                local.extend(node_messages)
+        return local
+
+
+class AsyncNodeForwarder(NodeForwarder):
+
+    """Sends messages to other nodes over asyncio channels."""
+
+    def _get_stub(self, node: str) -> chat_ext_grpc.ChatExtStub:
+        """Returns stub of node, opening channel on the first call."""
+        if node not in self._stubs:
+            self._stubs[node] = chat_ext_grpc.ChatExtStub(
+                grpc.aio.insecure_channel(node))
+        return self._stubs[node]
+
+    async def forward(self, get_node, messages: List[Message]) -> List[Message]:
+        """Forwards messages to nodes serving their recipients, looking
+        nodes up with get_node coroutine. Returns messages to be saved
+        by this node.
+        """
+        nodes = {}
+        for login in {message.login_to for message in messages}:
+            nodes[login] = await get_node(login)
+        local, remote = group_by_node(messages, self.node_address, nodes.get)
+        for node, node_messages in remote.items():
+            try:
+                await self._get_stub(node).SendMessages(
+                    iter(forward_requests(node_messages)),
+                    timeout=self.timeout,
+                    metadata=((chat_ext_grpc.FORWARDED_BY_KEY,
+                               self.node_address),))
+            except grpc.RpcError as error:
+                logging.warning("Forwarding to %s failed: %s", node, error)
+                local.extend(node_messages)
+        return local
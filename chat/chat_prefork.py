@@ -0,0 +1,123 @@
+"""This module contains supervisor of prefork server mode: worker
+processes serve on the same port bound with SO_REUSEPORT, so requests
+are spread over all cores instead of one GIL-bound process.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import Callable, Dict
+
+WORKER_RESTART_DELAY = 1.0
+MAX_WORKER_RESTART_DELAY = 30.0
+SHUTDOWN_TIMEOUT = 10.0
+REUSEPORT_OPTIONS = (("grpc.so_reuseport", 1),)
+
+
+def get_workers_count(value: str = None) -> int:
+    """Returns number of worker processes from SERVER_WORKERS value,
+    one if it is not set and number of CPUs if it is zero.
+    """
+    workers = int(value or 1)
+    if workers < 0:
+        raise ValueError("number of workers must not be negative")
+    return workers or os.cpu_count() or 1
+
+
+def _run_worker(target: Callable[[int], None], index: int):
+    """Runs target in worker process. Interrupts go to supervisor,
+    which stops workers with SIGTERM.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(index)
+
+
+class Supervisor:
+
+    """Starts worker processes running target with worker number and
+    starts again the ones which exit. Worker exiting soon after start is
+    started again with growing delay. SIGTERM or SIGINT stops workers
+    with SIGTERM, workers not stopped within shutdown timeout are killed.
+    Workers are forked, so the supervisor must not open connections of
+    storage or gRPC before running them.
+    """
+
+    def __init__(self, target: Callable[[int], None], workers: int,
+                 restart_delay: float = WORKER_RESTART_DELAY,
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT):
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self._context = multiprocessing.get_context("fork")
+        self._started_at: Dict[int, float] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._delays: Dict[int, float] = {}
+        self._stopping = threading.Event()
+
+    def _start_worker(self, index: int):
+        """Forks worker process with number."""
+        process = self._context.Process(target=_run_worker,
+                                        args=(self.target, index),
+                                        name=f"chat-worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logging.info(f"Started worker {index} with pid {process.pid}")
+
+    def _restart_exited(self):
+        """Schedules start of workers which exited and starts the ones
+        whose delay has passed. Delay is doubled while workers exit soon
+        after start and dropped once a worker has run long enough.
+        """
+        now = time.monotonic()
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if index not in self._restart_at:
+                delay = 0.0
+                if now - self._started_at[index] < MAX_WORKER_RESTART_DELAY:
+                    delay = min(max(self._delays.get(index, 0.0) * 2,
+                                    self.restart_delay),
+                                MAX_WORKER_RESTART_DELAY)
+                self._delays[index] = delay
+                self._restart_at[index] = now + delay
+                logging.warning(f"Worker {index} exited with code "
+                                f"{process.exitcode}, starting it again "
+                                f"in {delay} seconds")
+            if now >= self._restart_at[index]:
+                del self._restart_at[index]
+                self._start_worker(index)
+
+    def stop(self, signum=None, frame=None):
+        """Asks supervisor to stop workers, may be used as signal handler."""
+        self._stopping.set()
+
+    def run(self):
+        """Runs workers until supervisor is stopped, then stops them."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self._start_worker(index)
+        while not self._stopping.wait(min(self.restart_delay, 0.1)):
+            self._restart_exited()
+        self.shutdown()
+
+    def shutdown(self):
+        """Stops workers with SIGTERM, kills ones not stopped in time."""
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+        for index, process in self.processes.items():
+            if process.is_alive():
+                logging.warning(f"Killing worker {index} not stopped in time")
+                process.kill()
+                process.join()
@@ -0,0 +1,85 @@
+"""This module contains token bucket rate limiting used by chat server
+to pace message delivery and to admit sent messages.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+
+    """Token bucket refilled with rate tokens per second up to capacity.
+    Capacity defaults to rate, but holds at least one token, so rates
+    below one per second still let single tokens be taken.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Adds tokens accumulated since the last update."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1) -> float:
+        """Takes amount of tokens, going into debt if there are not enough.
+        Returns seconds to wait until the debt is paid off.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def take(self, amount: float = 1) -> float:
+        """Takes amount of tokens if there are enough, never going into
+        debt. Returns zero if tokens were taken, otherwise seconds to wait
+        until there are enough.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def refund(self, amount: float = 1):
+        """Gives back amount of tokens taken for something not done."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class SubscriberRateLimiter:
+
+    """Paces delivery of one subscriber stream by messages per second
+    and/or bytes per second. Limits left as None are not applied.
+    """
+
+    def __init__(self, messages_per_second: float = None,
+                 bytes_per_second: float = None):
+        self._messages = (TokenBucket(messages_per_second)
+                          if messages_per_second else None)
+        self._bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+
+    def reserve(self, size: int) -> float:
+        """Accounts message of given size in bytes.
+        Returns seconds to wait before the message may be sent.
+        """
+        delay = 0.0
+        if self._messages:
+            delay = max(delay, self._messages.reserve(1))
+        if self._bytes:
+            delay = max(delay, self._bytes.reserve(size))
+        return delay
+
+    def wait(self, size: int):
+        """Blocks until message of given size in bytes may be sent."""
+        delay = self.reserve(size)
+        if delay:
+            time.sleep(delay)
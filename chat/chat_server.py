@@ -1,58 +1,431 @@
 """The Python implementation of the gRPC chat server."""
 
+import asyncio
 import logging
 import os
+import signal
 import sys
-import time
 from concurrent import futures
+from typing import Dict, List, Optional
 
 import grpc
 
+import chat_ext_grpc
 import chat_pb2
 import chat_pb2_grpc
-from chat_storage import Message, Storage, User
+from chat_admission import (AdmissionController, AdmissionInterceptor,
+                            AsyncAdmissionInterceptor, LatencyTrackingStorage,
+                            parse_method_limits)
+from chat_codecs import CODECS, UnknownCodecError
+from chat_convert import message_from_pb, message_to_pb, user_to_pb, users_reply
+from chat_metrics import (AsyncMetricsInterceptor, BufferMetrics,
+                          MetricsInterceptor, start_metrics_server)
+from chat_nodes import NodeForwarder, is_forwarded
+from chat_prefork import REUSEPORT_OPTIONS, Supervisor, get_workers_count
+from chat_rate_limit import SubscriberRateLimiter
+from chat_storage import (SLOW_CONSUMER_POLICIES, SLOW_CONSUMER_TIMEOUT,
+                          Channel, Message, MessageCompactor, MessageWatch,
+                          SlowConsumerError, Storage, User, WatchBrokenError,
+                          channel_name, is_channel, message_seq)
 from chat_storage_factory import StorageFactory, UnknownStorageError
+from chat_wal import WalStorage
+
+SUBSCRIBE_BATCH_SIZE = 100
+SEND_BATCH_SIZE = 500
+USERS_PAGE_SIZE = 500
+SUBSCRIBE_BUFFER_BYTES = 1 << 20
+SERVER_MODES = ("thread", "aio")
+MAX_WORKERS = 10
+SHUTDOWN_GRACE = 5.0
+WORKERS_STORAGES = ("etcd",)
+
+
+class UsersReplyCache:
+
+    """Keeps GetUsers reply built from the last users list."""
+
+    def __init__(self):
+        self._cached = (None, None)
+
+    def get(self, users: List[User]) -> chat_pb2.GetUsersReply:
+        """Returns cached reply if it was built from the same users list
+        object, otherwise builds and caches a new one.
+        """
+        cached_users, reply = self._cached
+        if users is not cached_users:
+            reply = users_reply(users)
+            self._cached = (users, reply)
+        return reply
 
 
 class Chat(chat_pb2_grpc.ChatServicer):
 
-    """Provides methods that implement functionality of chat server."""
+    """Provides methods that implement functionality of chat server.
+    Subscribe streams are optionally limited by messages or bytes
+    per second, delivered messages are acknowledged in batches.
+    Server node with address registers its subscribers in storage and,
+    if storage watches don't reach other nodes, forwards messages to
+    nodes serving their recipients. Message to "#name" is saved once in
+    log of channel, Subscribe merges it into streams of channel members.
+    Messages are buffered for every stream up to max_buffered_bytes,
+    subscriber falling behind is handled by slow consumer policy.
+    """
 
-    def __init__(self, storage):
+    def __init__(self, storage, subscribe_batch_size: int = SUBSCRIBE_BATCH_SIZE,
+                 messages_per_second: float = None,
+                 bytes_per_second: float = None, node_address: str = None,
+                 max_buffered_bytes: int = SUBSCRIBE_BUFFER_BYTES,
+                 slow_consumer_policy: str = "pause",
+                 slow_consumer_timeout: float = SLOW_CONSUMER_TIMEOUT):
         self.storage = storage
+        self.subscribe_batch_size = subscribe_batch_size
+        self.messages_per_second = messages_per_second
+        self.bytes_per_second = bytes_per_second
+        self.node_address = node_address
+        self.watch_options = {
+            "max_buffered_bytes": max_buffered_bytes,
+            "slow_consumer_policy": slow_consumer_policy,
+            "slow_consumer_timeout": slow_consumer_timeout,
+            "listener": BufferMetrics(),
+        }
+        self.forwarder = None
+        if node_address and not storage.watches_across_nodes:
+            self.forwarder = NodeForwarder(node_address)
+        self._users_reply = UsersReplyCache()
+
+    def _route(self, messages: List[Message], context) -> List[Message]:
+        """Forwards messages whose recipients are subscribed on other
+        nodes, unless they were forwarded already. Returns messages to
+        be saved in storage of this node.
+        """
+        if self.forwarder is None or is_forwarded(
+                context.invocation_metadata()):
+            return messages
+        return self.forwarder.forward(self.storage.get_subscriber_node,
+                                      messages)
+
+    def _check_channels(self, messages: List[Message], context):
+        """Aborts call if message is sent to channel its sender is not
+        member of.
+        """
+        channels = {}
+        for message in messages:
+            if not is_channel(message.login_to):
+                continue
+            if message.login_from not in channels:
+                channels[message.login_from] = self.storage.get_user_channels(
+                    message.login_from)
+            if channel_name(message.login_to) not in channels[
+                    message.login_from]:
+                context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                              not_member_error(message))
 
     def GetUsers(self, request, context):
-        """Returns list of users from storage."""
-        users = []
-        users_from_db = self.storage.get_users_list()
-        for user in users_from_db:
-            users.append(chat_pb2.User(
-                login=user.login, full_name=user.full_name))
-        return chat_pb2.GetUsersReply(users=users)
+        """Returns list of users from storage. Reply is built again only
+        if storage returned another users list than the last time.
+        If metadata asks for a page, returns one page of users and token
+        of the next page in trailing metadata.
+        """
+        try:
+            page = chat_ext_grpc.read_users_page_metadata(
+                context.invocation_metadata())
+        except ValueError as error:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        if page is None:
+            return self._users_reply.get(self.storage.get_users_list())
+        page_token, page_size, login_prefix = page
+        users = self.storage.get_users_page(page_token, page_size,
+                                            login_prefix)
+        context.set_trailing_metadata((
+            (chat_ext_grpc.NEXT_PAGE_TOKEN_KEY,
+             chat_ext_grpc.next_page_token(users, page_size)),))
+        return users_reply(users)
+
+    def StreamUsers(self, request, context):
+        """Returns stream of all users with login prefix from metadata,
+        reading them from storage page by page.
+        """
+        login_prefix = dict(context.invocation_metadata()).get(
+            chat_ext_grpc.LOGIN_PREFIX_KEY, "")
+        for users in iter_users_pages(self.storage, login_prefix):
+            for user in users:
+                yield user_to_pb(user)
 
     def SendMessage(self, request, context):
         """Gets message and saves it to storage. 
         Returns simple string if the message from client is received.
         """
-        self.storage.create_message(Message(request.message.login_from,
-                                            request.message.login_to,
-                                            request.message.body))
-        return chat_pb2.SendMessageReply(
-            status=f"Done! {request.message.login_to} received message " +
-            f"from {request.message.login_from}!"
-        )
+        message = message_from_pb(request.message)
+        self._check_channels([message], context)
+        if self._route([message], context):
+            self.storage.create_message(message)
+        return send_message_reply(request.message)
+
+    def SendMessages(self, request_iterator, context):
+        """Gets stream of messages and saves them to storage in batches.
+        Returns simple string with number of received messages.
+        """
+        count = 0
+        batch = []
+        for request in request_iterator:
+            batch.append(message_from_pb(request.message))
+            if len(batch) == SEND_BATCH_SIZE:
+                self._check_channels(batch, context)
+                self.storage.create_messages(self._route(batch, context))
+                count += len(batch)
+                batch = []
+        if batch:
+            self._check_channels(batch, context)
+            self.storage.create_messages(self._route(batch, context))
+            count += len(batch)
+        return send_messages_reply(count)
+
+    def _stream_messages(self, request, context, on_batch,
+                         with_channels: bool = False):
+        """Yields messages of subscriber with their replies, keeping to
+        rate limit. Waits on storage watch between batches instead of
+        polling, watch is cancelled when the stream is closed. Batch is
+        passed to on_batch only after gRPC asks for the next message,
+        that is when writing the last message of the batch to the stream
+        succeeded. With channels messages of channels the subscriber is
+        member of at the start of the stream are merged in. Subscriber
+        disconnected as slow consumer gets RESOURCE_EXHAUSTED, or has its
+        call cancelled if it stopped reading, the one whose storage watch
+        is broken gets UNAVAILABLE to subscribe again.
+        """
+        if is_channel(request.login):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "channel can not be subscribed to")
+        if self.node_address:
+            context.add_callback(self.storage.register_subscriber(
+                request.login, self.node_address))
+        channels = None
+        if with_channels:
+            channels = self.storage.get_user_channels(request.login)
+        watch = MessageWatch(self.storage, request.login, channels,
+                             on_disconnect=context.cancel,
+                             **self.watch_options)
+        context.add_callback(watch.close)
+        rate_limiter = SubscriberRateLimiter(self.messages_per_second,
+                                             self.bytes_per_second)
+        try:
+            for messages in watch:
+                for batch in split_batches(messages,
+                                           self.subscribe_batch_size):
+                    for message in batch:
+                        reply = message_to_pb(message)
+                        rate_limiter.wait(reply.ByteSize())
+                        yield message, reply
+                    on_batch(batch)
+        except SlowConsumerError as error:
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(error))
+        except WatchBrokenError as error:
+            context.abort(grpc.StatusCode.UNAVAILABLE, str(error))
+
+    def _mark_read(self, login: str, messages: List[Message]):
+        """Deletes messages of user and moves cursors of user in channels
+        past messages read from them.
+        """
+        messages, cursors = split_channel_messages(messages)
+        if messages:
+            self.storage.delete_user_messages(messages)
+        for name, cursor in cursors.items():
+            self.storage.set_channel_cursor(name, login, cursor)
 
     def Subscribe(self, request, context):
-        """Returns stream of messages from storage by subscription."""
-        while context.is_active():
-            messages = self.storage.get_user_messages(request.login)
-            for message in messages:
-                yield chat_pb2.Message(login_from=message.login_from,
-                                       login_to=message.login_to,
-                                       created_at=message.created_at,
-                                       body=message.body)
-                self.storage.delete_user_message(message)
-                time.sleep(1)
+        """Returns stream of messages from storage by subscription,
+        merged with messages of channels of the user. Messages are
+        deleted and channel cursors moved in batches once they are
+        written to the stream.
+        """
+        for message, reply in self._stream_messages(
+                request, context,
+                lambda batch: self._mark_read(request.login, batch),
+                with_channels=True):
+            yield reply
+
+    def _delete_without_seq(self, messages: List[Message]):
+        """Deletes messages which can not be acknowledged by cursor."""
+        messages = messages_without_seq(messages)
+        if messages:
+            self.storage.delete_user_messages(messages)
+
+    def _ack_messages(self, login: str, cursor: str, context) -> int:
+        """Deletes messages of user up to position of cursor in mailbox
+        of user and moves cursors of user in channels of cursor. Aborts
+        call if cursor is malformed. Returns number of deleted messages.
+        """
+        try:
+            position, channels = chat_ext_grpc.parse_cursor(cursor)
+        except ValueError as error:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        count = 0
+        if position is not None:
+            count = self.storage.ack_user_messages(login, position)
+        for name, channel_position in channels.items():
+            self.storage.set_channel_cursor(name, login, channel_position)
+        return count
+
+    def SubscribeFrom(self, request, context):
+        """Returns stream of messages merged with messages of channels of
+        the user, every message with cursor after it. Messages are kept
+        in storage until client acknowledges them. Messages up to cursor
+        from metadata, the one of the last message client received, are
+        acknowledged first, so the stream goes on after it.
+        """
+        cursor = chat_ext_grpc.read_cursor_metadata(
+            context.invocation_metadata())
+        if cursor and not is_channel(request.login):
+            self._ack_messages(request.login, cursor, context)
+        stream_cursor = StreamCursor()
+        for message, reply in self._stream_messages(
+                request, context, self._delete_without_seq,
+                with_channels=True):
+            yield reply, stream_cursor.advance(message)
+
+    def AckMessages(self, request, context):
+        """Deletes messages of user up to cursor from metadata and moves
+        cursors of user in channels of the cursor. Returns simple string
+        with number of deleted messages.
+        """
+        cursor = chat_ext_grpc.read_cursor_metadata(
+            context.invocation_metadata())
+        if not cursor:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "cursor is required")
+        if is_channel(request.login):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "channel messages can not be acknowledged")
+        return ack_messages_reply(
+            self._ack_messages(request.login, cursor, context))
+
+    def JoinChannel(self, request, context):
+        """Makes user member of channel from metadata, creating channel
+        if there is no such one. Member gets messages sent to channel
+        after joining. Returns simple string if user joined.
+        """
+        name = chat_ext_grpc.read_channel_metadata(
+            context.invocation_metadata())
+        if not name:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "channel is required")
+        try:
+            if self.storage.get_channel(name) is None:
+                self.storage.create_channel(Channel(name))
+            self.storage.join_channel(name, request.login)
+        except NotImplementedError as error:
+            context.abort(grpc.StatusCode.UNIMPLEMENTED, str(error))
+        return channel_reply(request.login, "joined", name)
+
+    def LeaveChannel(self, request, context):
+        """Removes user from members of channel from metadata.
+        Returns simple string if user left.
+        """
+        name = chat_ext_grpc.read_channel_metadata(
+            context.invocation_metadata())
+        if not name:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "channel is required")
+        try:
+            self.storage.leave_channel(name, request.login)
+        except NotImplementedError as error:
+            context.abort(grpc.StatusCode.UNIMPLEMENTED, str(error))
+        return channel_reply(request.login, "left", name)
+
+
+def iter_users_pages(storage: Storage, login_prefix: str = ""):
+    """Yields pages of users with login prefix until the last one."""
+    after_login = ""
+    while True:
+        users = storage.get_users_page(after_login, USERS_PAGE_SIZE,
+                                       login_prefix)
+        if users:
+            yield users
+        if len(users) < USERS_PAGE_SIZE:
+            return
+        after_login = users[-1].login
+
+
+def send_message_reply(message: chat_pb2.Message) -> chat_pb2.SendMessageReply:
+    """Returns reply confirming message from client is saved."""
+    return chat_pb2.SendMessageReply(
+        status=f"Done! {message.login_to} received message " +
+        f"from {message.login_from}!"
+    )
+
+
+def send_messages_reply(count: int) -> chat_pb2.SendMessageReply:
+    """Returns reply confirming stream of messages from client is saved."""
+    return chat_pb2.SendMessageReply(status=f"Done! {count} messages received.")
+
+
+def ack_messages_reply(count: int) -> chat_pb2.SendMessageReply:
+    """Returns reply confirming messages are acknowledged."""
+    return chat_pb2.SendMessageReply(
+        status=f"Done! {count} messages acknowledged.")
+
+
+def channel_reply(login: str, action: str,
+                  name: str) -> chat_pb2.SendMessageReply:
+    """Returns reply confirming user joined or left channel."""
+    return chat_pb2.SendMessageReply(status=f"Done! {login} {action} #{name}.")
+
+
+def not_member_error(message: Message) -> str:
+    """Returns error of message sent to channel by user not member of it."""
+    return f"{message.login_from} is not a member of {message.login_to}"
+
+
+def split_channel_messages(messages: List[Message]):
+    """Returns messages to user and dict of cursors of channels, sequence
+    numbers of the last messages from every channel.
+    """
+    direct = []
+    cursors = {}
+    for message in messages:
+        if not is_channel(message.login_to):
+            direct.append(message)
+            continue
+        seq = message_seq(message)
+        if seq is not None:
+            name = channel_name(message.login_to)
+            cursors[name] = max(cursors.get(name, 0), seq)
+    return direct, cursors
+
+
+class StreamCursor:
+
+    """Cursor of SubscribeFrom stream: positions of the last streamed
+    messages in mailbox of subscriber and in every channel.
+    """
+
+    def __init__(self):
+        self.position: Optional[int] = None
+        self.channels: Dict[str, int] = {}
+
+    def advance(self, message: Message) -> str:
+        """Moves cursor past message and returns it."""
+        seq = message_seq(message)
+        if seq is not None:
+            if is_channel(message.login_to):
+                self.channels[channel_name(message.login_to)] = seq
+            else:
+                self.position = seq
+        return chat_ext_grpc.format_cursor(self.position, self.channels)
+
+
+def messages_without_seq(messages: List[Message]) -> List[Message]:
+    """Returns messages storage gave no sequence numbers, they can not be
+    acknowledged by cursor.
+    """
+    return [message for message in messages
+            if message_seq(message) is None]
+
+
+def split_batches(messages: List[Message], batch_size: int):
+    """Yields consecutive slices of messages of at most batch size."""
+    for start in range(0, len(messages), batch_size):
+        yield messages[start:start + batch_size]
 
 
 def create_users_list(storage: Storage):
@@ -63,38 +436,185 @@ def create_users_list(storage: Storage):
         storage.create_user(user)
 
 
-def create_server(storage: Storage, server_host: str, server_port: str):
-    """Creates server on defined address and port."""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+def create_server(storage: Storage, server_host: str, server_port: str,
+                  interceptors=(), max_workers: int = MAX_WORKERS,
+                  options=(), **chat_options):
+    """Creates server on defined address and port with interceptors and
+    channel options, serving up to max_workers calls at once, every
+    Subscribe stream holds one of them. Chat options are passed to Chat
+    servicer.
+    """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers),
+                         interceptors=interceptors, options=options)
     if not storage.get_users_list():
         create_users_list(storage)
-    chat_pb2_grpc.add_ChatServicer_to_server(Chat(storage), server)
+    chat = Chat(storage, **chat_options)
+    chat_pb2_grpc.add_ChatServicer_to_server(chat, server)
+    chat_ext_grpc.add_ChatExtServicer_to_server(chat, server)
     server.add_insecure_port("{}:{}".format(server_host, server_port))
     return server
 
 
-def main():
-    """Gets environment variables, initializes storage and server. 
-    Starts the server.
+def get_env_float(name: str):
+    """Returns environment variable as float or None if it is not set."""
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def run_server(worker: int = None):
+    """Gets environment variables, initializes storage and server.
+    Starts the server and serves until SIGTERM stops it gracefully.
+    Worker of prefork mode binds port shared by all workers, keeps
+    write-ahead log in its own subdirectory and serves metrics on
+    METRICS_PORT plus worker number; only the first worker compacts
+    storage. Calls are admitted by limits of SERVER_* variables, limits
+    of workers are their own.
     """
-    logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("config_logger")
     storage_type = os.environ.get("STORAGE")
     storage_host = os.environ.get("STORAGE_HOST")
     storage_port = os.environ.get("STORAGE_PORT")
     server_host = os.environ.get("SERVER_HOST")
     server_port = os.environ.get("SERVER_PORT")
+    server_mode = os.environ.get("SERVER_MODE") or "thread"
+    chat_options = {
+        "subscribe_batch_size": int(os.environ.get(
+            "SERVER_SUBSCRIBE_BATCH_SIZE", SUBSCRIBE_BATCH_SIZE)),
+        "messages_per_second": get_env_float(
+            "SERVER_SUBSCRIBE_MESSAGES_PER_SECOND"),
+        "bytes_per_second": get_env_float("SERVER_SUBSCRIBE_BYTES_PER_SECOND"),
+        "node_address": os.environ.get("SERVER_NODE_ADDRESS") or None,
+        "max_buffered_bytes": int(os.environ.get(
+            "SERVER_SUBSCRIBE_BUFFER_BYTES", SUBSCRIBE_BUFFER_BYTES)),
+        "slow_consumer_policy": os.environ.get(
+            "SERVER_SLOW_CONSUMER_POLICY") or "pause",
+        "slow_consumer_timeout": get_env_float(
+            "SERVER_SLOW_CONSUMER_TIMEOUT") or SLOW_CONSUMER_TIMEOUT,
+        "options": REUSEPORT_OPTIONS if worker is not None else (),
+    }
+    try:
+        admission = AdmissionController(
+            sender_rate=get_env_float("SERVER_SENDER_MESSAGES_PER_SECOND"),
+            global_rate=get_env_float("SERVER_GLOBAL_MESSAGES_PER_SECOND"),
+            method_limits=parse_method_limits(
+                os.environ.get("SERVER_METHOD_CONCURRENCY", "")),
+            shed_latency=get_env_float("SERVER_SHED_STORAGE_LATENCY"))
+    except ValueError as error:
+        logger.error(f"{error}. Please, check config file if \
+SERVER_METHOD_CONCURRENCY is like SendMessage=64,Subscribe=1000.")
+        sys.exit(1)
+    storage_wrappers = [wrapper for wrapper in os.environ.get(
+        "STORAGE_WRAPPERS", "").split(",") if wrapper]
+    storage_options = {
+        "codec": os.environ.get("STORAGE_CODEC") or "json",
+        "pool_size": int(os.environ.get("STORAGE_POOL_SIZE") or 1),
+        "shard_storage": os.environ.get("STORAGE_SHARD_STORAGE") or "etcd",
+        "message_ttl": get_env_float("STORAGE_MESSAGE_TTL") or 0,
+        "mailbox_size": int(os.environ.get("STORAGE_MAILBOX_SIZE") or 0),
+        "compact_history": os.environ.get("STORAGE_COMPACT_HISTORY") == "1",
+    }
     try:
         storage = StorageFactory.create_storage(
-            storage_type, storage_host, storage_port)
+            storage_type, storage_host, storage_port, storage_wrappers,
+            **storage_options)
+    except UnknownCodecError as error:
+        logger.error(f"{error}. Please, check config file if STORAGE_CODEC \
+is one of {', '.join(CODECS)}.")
+        sys.exit(1)
     except UnknownStorageError as error:
         logger.error(f"{error}. Please, check config file if STORAGE name \
-is entered and correct.")
+and STORAGE_WRAPPERS are entered and correct.")
+        sys.exit(1)
+    if chat_options["node_address"] and not (
+            storage.watches_across_nodes or storage.subscribers_across_nodes):
+        logger.error(f"Server nodes don't reach each other's subscribers \
+with {storage_type} storage. Please, check config file if \
+SERVER_NODE_ADDRESS is set only with etcd or SQLite storage.")
+        sys.exit(1)
+    if admission.shed_latency:
+        storage = LatencyTrackingStorage(storage, admission.latency)
+    wal_dir = os.environ.get("SERVER_WAL_DIR")
+    if wal_dir:
+        if worker is not None:
+            wal_dir = os.path.join(wal_dir, f"worker-{worker}")
+        storage = WalStorage(storage, wal_dir)
+    compaction_interval = get_env_float("STORAGE_COMPACTION_INTERVAL")
+    compactor = None
+    if compaction_interval and not worker:
+        compactor = MessageCompactor(storage, compaction_interval)
+        compactor.start()
+    if server_mode not in SERVER_MODES:
+        logger.error(f"Unknown server mode: {server_mode}. Please, check \
+config file if SERVER_MODE is one of {', '.join(SERVER_MODES)}.")
+        sys.exit(1)
+    if chat_options["slow_consumer_policy"] not in SLOW_CONSUMER_POLICIES:
+        logger.error(f"Unknown slow consumer policy: \
+{chat_options['slow_consumer_policy']}. Please, check config file if \
+SERVER_SLOW_CONSUMER_POLICY is one of {', '.join(SLOW_CONSUMER_POLICIES)}.")
+        sys.exit(1)
+    metrics_port = os.environ.get("METRICS_PORT")
+    if metrics_port:
+        metrics_port = int(metrics_port) + (worker or 0)
+        start_metrics_server(metrics_port)
+        logging.info(f"Serving metrics on port {metrics_port}..")
+    if server_mode == "aio":
+        import chat_aio_server
+        interceptors = [AsyncMetricsInterceptor()] if metrics_port else []
+        if admission.enabled:
+            interceptors.append(AsyncAdmissionInterceptor(admission))
+        asyncio.run(chat_aio_server.serve(storage, server_host, server_port,
+                                          interceptors, **chat_options))
+    else:
+        interceptors = [MetricsInterceptor()] if metrics_port else []
+        if admission.enabled:
+            interceptors.append(AdmissionInterceptor(admission))
+        server = create_server(storage, server_host, server_port,
+                               interceptors, **chat_options)
+        server.start()
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: server.stop(SHUTDOWN_GRACE))
+        logging.info('Starting server..')
+        server.wait_for_termination()
+    if compactor is not None:
+        compactor.stop()
+    if wal_dir:
+        storage.close()
+
+
+def get_shared_storage_type() -> str:
+    """Returns type of storage, which messages go through, the one of
+    shards for sharded storage.
+    """
+    storage_type = os.environ.get("STORAGE")
+    if storage_type == "sharded":
+        return os.environ.get("STORAGE_SHARD_STORAGE") or "etcd"
+    return storage_type
+
+
+def main():
+    """Runs server in this process, or in SERVER_WORKERS worker
+    processes supervised by this one. Workers don't share memory, so
+    they are started only with storage watched by all of them.
+    """
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("config_logger")
+    try:
+        workers = get_workers_count(os.environ.get("SERVER_WORKERS"))
+    except ValueError as error:
+        logger.error(f"{error}. Please, check config file if SERVER_WORKERS \
+is a number.")
+        sys.exit(1)
+    if workers > 1 and get_shared_storage_type() not in WORKERS_STORAGES:
+        logger.error(f"{workers} server workers don't see messages sent to \
+each other with {get_shared_storage_type()} storage. Please, check config \
+file if SERVER_WORKERS is 1 or STORAGE is one of \
+{', '.join(WORKERS_STORAGES)}.")
         sys.exit(1)
-    server = create_server(storage, server_host, server_port)
-    server.start()
-    logging.info('Starting server..')
-    server.wait_for_termination()
+    if workers == 1:
+        run_server()
+        return
+    logging.info(f"Starting {workers} server workers..")
+    Supervisor(run_server, workers).run()
 
 
 if __name__ == '__main__':
@@ -3,55 +3,227 @@ interface declares a set of methods for different storage types.
 Also User and Message entities are using for server-storage interaction.
 """
 
+import logging
+import os
+import threading
 import time
+import uuid
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
-from typing import List
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, List, Optional, Set
 
 
 USER_PREFIX = "user."
 MESSAGE_PREFIX = "message."
+CHANNEL_PREFIX = "channel."
+MEMBER_PREFIX = "member."
+# Messages to channel have its name after the mark as recipient.
+CHANNEL_MARK = "#"
+NODE_ID = uuid.uuid4().hex[:8]
+COMPACTION_INTERVAL = 60.0
+SLOW_CONSUMER_POLICIES = ("pause", "disconnect")
+SLOW_CONSUMER_TIMEOUT = 30.0
+BACKLOG_PAGE_SIZE = 100
+# Message size assumed to fit backlog pages into free buffer space.
+ESTIMATED_MESSAGE_BYTES = 256
 
 
-@dataclass
+class MessageClock:
+
+    """Hybrid logical clock returning nanosecond timestamps, strictly
+    increasing even if wall clock stalls or goes back.
+    """
+
+    def __init__(self):
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def now(self) -> int:
+        """Returns next timestamp in nanoseconds."""
+        with self._lock:
+            self._last = max(time.time_ns(), self._last + 1)
+            return self._last
+
+
+message_clock = MessageClock()
+
+
+def _reset_node_id():
+    """Gives forked process its own node id, so processes forked from
+    one server create different message ids at the same time.
+    """
+    global NODE_ID
+    NODE_ID = uuid.uuid4().hex[:8]
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_node_id)
+
+
+def slotted(*extra_slots: str):
+    """Returns decorator giving dataclass __slots__ for its fields and
+    extra slots, as dataclass(slots=True) does since Python 3.10.
+    Extra slots are caches set with object.__setattr__.
+    """
+    def decorator(cls):
+        field_names = tuple(cls_field.name for cls_field in fields(cls))
+        cls_dict = dict(cls.__dict__)
+        cls_dict["__slots__"] = field_names + extra_slots
+        for name in field_names + ("__dict__", "__weakref__"):
+            cls_dict.pop(name, None)
+        slotted_cls = type(cls)(cls.__name__, cls.__bases__, cls_dict)
+        slotted_cls.__qualname__ = cls.__qualname__
+        return slotted_cls
+    return decorator
+
+
+def new_message_id() -> str:
+    """Creates unique message id ordered by creation time: zero-padded
+    clock timestamp followed by id of the node which created it.
+    """
+    return "{:020d}-{}".format(message_clock.now(), NODE_ID)
+
+
+@slotted("_key")
+@dataclass(frozen=True)
 class User:
 
-    """Class for user entity."""
+    """Class for immutable user entity."""
 
     login: str
     full_name: str
 
     def get_unique_key(self):
-        """Creates unique key for saving user."""
-        return "user.{}".format(self.login)
+        """Creates unique key for saving user, once per user."""
+        try:
+            return self._key
+        except AttributeError:
+            object.__setattr__(self, "_key", "user.{}".format(self.login))
+            return self._key
 
 
-@dataclass
+@slotted("_key", "_pb", "_seq")
+@dataclass(frozen=True)
 class Message:
 
-    """Class for message entity."""
+    """Class for immutable message entity. Storages may attach message
+    ready to be sent to client, see chat_convert module, and attach
+    sequence number of saved message, see attach_seq.
+    """
 
     login_from: str
     login_to: str
     body: str
     created_at: int = field(default_factory=lambda: int(time.time()))
+    message_id: Optional[str] = field(default_factory=new_message_id)
 
     def get_unique_key(self):
-        """Creates unique key for saving message."""
-        return "message.{}.{}.{}".format(self.login_to, self.login_from,
-                                         self.created_at)
+        """Creates unique key for saving message, once per message.
+        Keys of one user are ordered by creation time. Messages saved
+        before message ids were introduced have no id and keep their
+        former key.
+        """
+        try:
+            return self._key
+        except AttributeError:
+            pass
+        if self.message_id is None:
+            key = "message.{}.{}.{}".format(self.login_to, self.login_from,
+                                            self.created_at)
+        else:
+            key = "message.{}.{}".format(self.login_to, self.message_id)
+        object.__setattr__(self, "_key", key)
+        return key
+
+
+@slotted("_key")
+@dataclass(frozen=True)
+class Channel:
+
+    """Class for immutable channel entity. Messages sent to channel are
+    kept once in its log, the mailbox of "#name", and read by every
+    member after the member's cursor.
+    """
+
+    name: str
+    title: str = ""
+
+    def get_unique_key(self):
+        """Creates unique key for saving channel, once per channel."""
+        try:
+            return self._key
+        except AttributeError:
+            object.__setattr__(self, "_key", "channel.{}".format(self.name))
+            return self._key
+
+    @property
+    def login(self) -> str:
+        """Returns recipient of messages sent to channel."""
+        return channel_login(self.name)
+
+
+def channel_login(name: str) -> str:
+    """Returns recipient of messages sent to channel with name."""
+    return CHANNEL_MARK + name
+
+
+def is_channel(login: str) -> bool:
+    """Checks if recipient is a channel."""
+    return login.startswith(CHANNEL_MARK)
+
+
+def channel_name(login: str) -> str:
+    """Returns name of channel which is recipient."""
+    return login[len(CHANNEL_MARK):]
+
+
+def attach_seq(message: Message, seq: int) -> Message:
+    """Keeps sequence number of message in its mailbox on it and returns
+    message.
+    """
+    object.__setattr__(message, "_seq", seq)
+    return message
+
+
+def message_seq(message: Message) -> Optional[int]:
+    """Returns sequence number attached to message by storage, None if
+    there is none.
+    """
+    return getattr(message, "_seq", None)
+
+
+def is_acknowledged(message: Message, cursor: int) -> bool:
+    """Checks if message is acknowledged by cursor, the sequence number
+    of the last message received by subscriber. Messages without
+    sequence number are never acknowledged by cursor.
+    """
+    seq = message_seq(message)
+    return seq is not None and seq <= cursor
 
 
 class Storage(ABC):
 
     """Base class for creating storages.All subclasses need to provide methods 
     for initializing storage, creating users, getting all users, creating messages, 
-    getting all messages per user, removing specific message for specific user.
+    getting all messages per user, removing specific message for specific user,
+    watching new messages per user.
+    Messages read from storage carry sequence numbers growing in order
+    they are committed to mailbox of recipient, see message_seq, so
+    cursors made of them don't skip messages committed late.
     """
 
+    # Watches of storage shared by server nodes see messages saved by any
+    # of them, otherwise messages are forwarded to the subscriber's node,
+    # found by subscriber registry shared by the nodes.
+    watches_across_nodes = False
+    subscribers_across_nodes = False
+
     @abstractmethod
-    def __init__(self, host, port):
-        """Initializes Storage object."""
+    def __init__(self, host, port, **options):
+        """Initializes Storage object. Options are storage specific,
+        storages ignore options they do not know, so one configuration
+        suits every storage type.
+        """
         pass
 
     @abstractmethod
@@ -64,17 +236,643 @@ class Storage(ABC):
         """Returns users list from storage."""
         pass
 
+    def get_users_page(self, after_login: str = "", limit: int = 100,
+                       login_prefix: str = "") -> List[User]:
+        """Returns up to limit users ordered by login, with login greater
+        than after_login and starting with login_prefix. Storages should
+        override it to read only the requested range.
+        """
+        users = sorted((user for user in self.get_users_list()
+                        if user.login > after_login
+                        and user.login.startswith(login_prefix)),
+                       key=lambda user: user.login)
+        return users[:limit]
+
     @abstractmethod
     def create_message(self, message: Message):
         """Saves messages in storage."""
         pass
 
+    def create_messages(self, messages: List[Message]):
+        """Saves batch of messages in storage. Storages may override it
+        to save the whole batch in one round-trip.
+        """
+        for message in messages:
+            self.create_message(message)
+
     @abstractmethod
     def get_user_messages(self, login: str) -> List[Message]:
-        """Returns list of messages from storage."""
+        """Returns list of messages from storage in order of their
+        sequence numbers.
+        """
         pass
 
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = BACKLOG_PAGE_SIZE
+                               ) -> List[Message]:
+        """Returns up to limit messages of user with sequence numbers
+        greater than after_seq, in their order. Storages should override
+        it to read only the requested page.
+        """
+        messages = [message for message in self.get_user_messages(login)
+                    if not is_acknowledged(message, after_seq)]
+        return messages[:limit]
+
     @abstractmethod
     def delete_user_message(self, message: Message):
         """Deletes user-read messages."""
         pass
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of user-read messages. Storages may override it
+        to delete the whole batch in one round-trip.
+        """
+        for message in messages:
+            self.delete_user_message(message)
+
+    def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user with sequence numbers up to cursor,
+        which are received by subscriber, and returns their number.
+        Storages should override it to delete the range without reading
+        it.
+        """
+        messages = [message for message in self.get_user_messages(login)
+                    if is_acknowledged(message, cursor)]
+        self.delete_user_messages(messages)
+        return len(messages)
+
+    @abstractmethod
+    def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Passes pending messages of user to callback, then passes every
+        new batch of messages as soon as it is saved, all in order of
+        sequence numbers. With with_pending False only messages saved
+        after the watch starts are passed. Callback gets None if watch
+        is broken. Returns function cancelling the watch.
+        """
+        pass
+
+    def watch_users(
+            self, callback: Callable[[], None]
+    ) -> Optional[Callable[[], None]]:
+        """Calls callback every time users are changed or the watch is
+        broken. Returns function cancelling the watch, or None if
+        storage can not watch users.
+        """
+        return None
+
+    def compact_messages(self) -> int:
+        """Deletes messages past retention set by storage options:
+        messages older than message_ttl seconds and the oldest messages
+        of users having more than mailbox_size messages. Returns number
+        of deleted messages. Storages without retention keep messages
+        until they are read.
+        """
+        return 0
+
+    def create_channel(self, channel: Channel):
+        """Saves channel in storage. Storages without channels raise
+        NotImplementedError.
+        """
+        raise NotImplementedError("storage has no channels")
+
+    def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel with name, or None if there is no such one."""
+        return None
+
+    def last_message_seq(self, login: str) -> int:
+        """Returns sequence number of the last message saved to mailbox
+        of login, messages saved to it later get greater ones.
+        """
+        raise NotImplementedError("storage has no sequence numbers")
+
+    def join_channel(self, name: str, login: str,
+                     cursor: Optional[int] = None):
+        """Makes user member of channel, reading messages sent to it
+        after cursor, by default after joining: the last message seq of
+        channel log. Joining channel again keeps cursor of member.
+        """
+        raise NotImplementedError("storage has no channels")
+
+    def leave_channel(self, name: str, login: str):
+        """Removes user from members of channel."""
+        raise NotImplementedError("storage has no channels")
+
+    def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns names of channels user is member of with cursors of
+        the user, sequence numbers of the last messages read from them.
+        """
+        return {}
+
+    def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of channel member forward to sequence number,
+        cursor is left as it is if it is further already or user is not
+        member.
+        """
+        pass
+
+    def register_subscriber(self, login: str,
+                            node_address: str) -> Callable[[], None]:
+        """Records that stream of user subscription is served by server
+        node with address. Records of node are dropped if it stops
+        renewing them. Returns function removing the record. Storages
+        without subscriber registry ignore it.
+        """
+        return lambda: None
+
+    def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns address of server node serving subscription of user,
+        or None if user is not subscribed or storage has no registry.
+        """
+        return None
+
+
+class StorageWrapper(Storage):
+
+    """Base class for storages adding behaviour to another storage.
+    Every method is passed to wrapped storage unless overridden.
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    def create_user(self, user: User):
+        """Saves users in wrapped storage."""
+        self.storage.create_user(user)
+
+    def get_users_list(self) -> List[User]:
+        """Returns users list from wrapped storage."""
+        return self.storage.get_users_list()
+
+    def get_users_page(self, after_login: str = "", limit: int = 100,
+                       login_prefix: str = "") -> List[User]:
+        """Returns page of users from wrapped storage."""
+        return self.storage.get_users_page(after_login, limit, login_prefix)
+
+    def create_message(self, message: Message):
+        """Saves message in wrapped storage."""
+        self.storage.create_message(message)
+
+    def create_messages(self, messages: List[Message]):
+        """Saves batch of messages in wrapped storage."""
+        self.storage.create_messages(messages)
+
+    def get_user_messages(self, login: str) -> List[Message]:
+        """Returns list of messages from wrapped storage."""
+        return self.storage.get_user_messages(login)
+
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = BACKLOG_PAGE_SIZE
+                               ) -> List[Message]:
+        """Returns page of messages of user from wrapped storage."""
+        return self.storage.get_user_messages_page(login, after_seq, limit)
+
+    def delete_user_message(self, message: Message):
+        """Deletes user-read message in wrapped storage."""
+        self.storage.delete_user_message(message)
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of user-read messages in wrapped storage."""
+        self.storage.delete_user_messages(messages)
+
+    def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user up to cursor in wrapped storage."""
+        return self.storage.ack_user_messages(login, cursor)
+
+    def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Watches messages of user in wrapped storage."""
+        return self.storage.watch_user_messages(login, callback,
+                                                with_pending)
+
+    def watch_users(
+            self, callback: Callable[[], None]
+    ) -> Optional[Callable[[], None]]:
+        """Watches users in wrapped storage."""
+        return self.storage.watch_users(callback)
+
+    def compact_messages(self) -> int:
+        """Deletes messages past retention in wrapped storage."""
+        return self.storage.compact_messages()
+
+    def create_channel(self, channel: Channel):
+        """Saves channel in wrapped storage."""
+        self.storage.create_channel(channel)
+
+    def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel from wrapped storage."""
+        return self.storage.get_channel(name)
+
+    def last_message_seq(self, login: str) -> int:
+        """Returns the last message seq of mailbox in wrapped storage."""
+        return self.storage.last_message_seq(login)
+
+    def join_channel(self, name: str, login: str,
+                     cursor: Optional[int] = None):
+        """Adds channel member in wrapped storage."""
+        self.storage.join_channel(name, login, cursor)
+
+    def leave_channel(self, name: str, login: str):
+        """Removes channel member in wrapped storage."""
+        self.storage.leave_channel(name, login)
+
+    def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user from wrapped storage."""
+        return self.storage.get_user_channels(login)
+
+    def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of channel member in wrapped storage."""
+        self.storage.set_channel_cursor(name, login, cursor)
+
+    @property
+    def watches_across_nodes(self) -> bool:
+        """Tells if watches of wrapped storage see messages saved by
+        other server nodes.
+        """
+        return self.storage.watches_across_nodes
+
+    @property
+    def subscribers_across_nodes(self) -> bool:
+        """Tells if subscriber registry of wrapped storage is shared by
+        server nodes.
+        """
+        return self.storage.subscribers_across_nodes
+
+    def register_subscriber(self, login: str,
+                            node_address: str) -> Callable[[], None]:
+        """Registers subscriber node in wrapped storage."""
+        return self.storage.register_subscriber(login, node_address)
+
+    def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns subscriber node from wrapped storage."""
+        return self.storage.get_subscriber_node(login)
+
+
+def message_size(message: Message) -> int:
+    """Returns approximate size of message kept in memory: lengths of
+    its strings.
+    """
+    return (len(message.login_from) + len(message.login_to)
+            + len(message.body) + len(message.message_id or ""))
+
+
+class SlowConsumerError(Exception):
+
+    """Raised when subscriber stays behind its stream longer than slow
+    consumer timeout.
+    """
+
+
+class WatchBrokenError(Exception):
+
+    """Raised when storage watch of subscriber is broken, so messages
+    saved later would not reach the stream.
+    """
+
+
+class BufferListener:
+
+    """Receives events of delivery buffers, ignores them by default."""
+
+    def buffered(self, delta: int, size: int):
+        """Called when bytes buffered for stream change by delta."""
+
+    def slow_consumer(self, action: str):
+        """Called when subscriber is "paused" as it fell behind or
+        "disconnected" as it stayed behind too long.
+        """
+
+
+class DeliveryBuffer:
+
+    """Messages of subscriber's mailboxes not taken by its stream yet.
+    Stream takes messages only after writing the ones taken before,
+    which waits for gRPC flow control. Messages saved before the stream
+    started are read from storage page by page after position of every
+    mailbox, once the stream took the buffer, so with max_bytes set
+    messages are read ahead of client by max_bytes at most. Messages
+    pushed by storage watches are buffered while they fit, mailbox
+    whose messages did not fit is lagging: its pushed messages are
+    ignored and read by pages again, and subscriber is behind until the
+    stream asks for more. With "disconnect" policy subscriber which was
+    behind longer than timeout is disconnected. Buffer is not thread
+    safe.
+    """
+
+    def __init__(self, max_bytes: int = 0, policy: str = "pause",
+                 timeout: float = SLOW_CONSUMER_TIMEOUT,
+                 listener: BufferListener = None,
+                 positions: Dict[str, int] = None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"unknown slow consumer policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.timeout = timeout
+        self.listener = listener or BufferListener()
+        self.messages: List[Message] = []
+        self.size = 0
+        self.behind_since: Optional[float] = None
+        # Sequence numbers of the last messages buffered from every
+        # mailbox, the next page of mailbox is read after it.
+        self.positions: Dict[str, int] = dict(positions or {})
+        # Mailboxes with messages in storage not buffered yet, messages
+        # saved before the stream started are read by pages too.
+        self.lagging: Set[str] = set(self.positions)
+        # Lagging mailboxes whose messages were pushed while their page
+        # was read, so the page may have missed them.
+        self._missed: Set[str] = set()
+
+    def _unread(self, messages: List[Message]) -> List[Message]:
+        """Returns messages after position of their mailbox."""
+        return [message for message in messages
+                if not is_acknowledged(message, self.positions.get(
+                    message.login_to, 0))]
+
+    def _fill(self, messages: List[Message]) -> List[Message]:
+        """Buffers messages while they fit in max_bytes, at least one
+        into empty buffer, so stream makes progress. Returns messages
+        which did not fit.
+        """
+        count = 0
+        size = 0
+        for message in messages:
+            added = message_size(message)
+            if (self.max_bytes and (self.messages or count)
+                    and self.size + size + added > self.max_bytes):
+                break
+            count += 1
+            size += added
+        for message in messages[:count]:
+            seq = message_seq(message)
+            if seq is not None:
+                self.positions[message.login_to] = seq
+        self.messages.extend(messages[:count])
+        if size:
+            self.size += size
+            self.listener.buffered(size, self.size)
+        return messages[count:]
+
+    def push(self, messages: List[Message]):
+        """Buffers messages pushed by storage watch of one mailbox while
+        they fit. Messages of lagging mailbox are ignored, as they are
+        read by pages. Mailbox whose messages did not fit is lagging and
+        subscriber is behind.
+        """
+        login = messages[0].login_to
+        if login in self.lagging:
+            self._missed.add(login)
+            return
+        if self._fill(self._unread(messages)):
+            self.lagging.add(login)
+            if self.behind_since is None:
+                self.behind_since = time.monotonic()
+                self.listener.slow_consumer("paused")
+
+    def lagging_mailboxes(self) -> List[str]:
+        """Returns lagging mailboxes in order they are watched in."""
+        return [login for login in self.positions if login in self.lagging]
+
+    def page_limit(self) -> int:
+        """Returns number of messages to read by the next page, enough
+        to fill buffer by estimate, 0 if buffer is full.
+        """
+        if not self.max_bytes:
+            return BACKLOG_PAGE_SIZE
+        room = self.max_bytes - self.size
+        if room <= 0:
+            return 0
+        return max(1, min(BACKLOG_PAGE_SIZE,
+                          room // ESTIMATED_MESSAGE_BYTES))
+
+    def start_page(self, login: str):
+        """Marks the start of page read of lagging mailbox."""
+        self._missed.discard(login)
+
+    def add_page(self, login: str, messages: List[Message], limit: int):
+        """Buffers messages of page read with limit while they fit.
+        Mailbox is caught up once its whole page fits, the page is the
+        last one and no messages were pushed meanwhile, from then on
+        pushed messages are buffered.
+        """
+        rest = self._fill(self._unread(messages))
+        if not rest and len(messages) < limit and login not in self._missed:
+            self.lagging.discard(login)
+
+    def take(self) -> List[Message]:
+        """Returns buffered messages and empties buffer."""
+        messages = self.messages
+        self.clear()
+        return messages
+
+    def resume(self):
+        """Ends the time subscriber is behind, raises SlowConsumerError
+        with "disconnect" policy if it was behind longer than timeout.
+        """
+        behind = time.monotonic() - self.behind_since
+        self.behind_since = None
+        if self.policy == "disconnect" and behind > self.timeout:
+            self.listener.slow_consumer("disconnected")
+            raise SlowConsumerError(
+                f"subscriber is behind for {behind:.1f} seconds")
+
+    def clear(self):
+        """Drops buffered messages."""
+        self.messages = []
+        if self.size:
+            self.listener.buffered(-self.size, 0)
+            self.size = 0
+
+
+class MessageWatch:
+
+    """Blocking iterator over batches of user messages merged with
+    messages of channels after cursors of the user. Messages pushed
+    while the consumer was busy are merged into one batch. Messages are
+    kept in DeliveryBuffer, messages saved before the watch started or
+    not fitting in the buffer are read page by page as the consumer
+    takes batches. With "disconnect" policy subscriber which stays
+    behind for timeout is disconnected by timer even if it stopped
+    taking batches: on_disconnect is called and the watch is closed.
+    Closing the watch cancels it and stops iteration, iteration over
+    watch broken by storage raises WatchBrokenError.
+    """
+
+    def __init__(self, storage: Storage, login: str,
+                 channels: Dict[str, int] = None, max_buffered_bytes: int = 0,
+                 slow_consumer_policy: str = "pause",
+                 slow_consumer_timeout: float = SLOW_CONSUMER_TIMEOUT,
+                 listener: BufferListener = None,
+                 on_disconnect: Callable[[], None] = None):
+        self._storage = storage
+        self._login = login
+        self._buffer = DeliveryBuffer(
+            max_buffered_bytes, slow_consumer_policy, slow_consumer_timeout,
+            listener, watched_mailboxes(login, channels or {}))
+        self._on_disconnect = on_disconnect
+        self._condition = threading.Condition()
+        self._closed = False
+        self._disconnected = False
+        self._ended = False
+        self._timer: Optional[threading.Timer] = None
+        self._cancels = []
+        self._watch()
+
+    def _watch(self):
+        """Starts storage watches of new messages of user and channels,
+        messages saved before are read by pages.
+        """
+        try:
+            for login in self._buffer.positions:
+                self._cancels.append(self._storage.watch_user_messages(
+                    login, self._push, with_pending=False))
+        except Exception:
+            self._cancel()
+            raise
+
+    def _push(self, batch: Optional[List[Message]]):
+        """Buffers batch pushed by storage watch, None ends iteration.
+        Starts disconnect timer once subscriber falls behind.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            if batch is None:
+                self._ended = True
+            else:
+                self._buffer.push(batch)
+                if (self._buffer.policy == "disconnect"
+                        and self._buffer.behind_since is not None
+                        and self._timer is None):
+                    self._timer = threading.Timer(self._buffer.timeout,
+                                                  self._disconnect)
+                    self._timer.daemon = True
+                    self._timer.start()
+            self._condition.notify()
+
+    def _stop_timer(self):
+        """Cancels disconnect timer. Must be called under condition."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _disconnect(self):
+        """Disconnects subscriber still behind when timer expires."""
+        with self._condition:
+            if self._closed or self._buffer.behind_since is None:
+                return
+            self._disconnected = True
+            self._buffer.listener.slow_consumer("disconnected")
+        if self._on_disconnect is not None:
+            self._on_disconnect()
+        self.close()
+
+    def _read_pages(self, logins: List[str]):
+        """Reads the next page of every lagging mailbox while buffer has
+        room.
+        """
+        for login in logins:
+            with self._condition:
+                limit = self._buffer.page_limit()
+                if self._closed or not limit:
+                    return
+                self._buffer.start_page(login)
+                after_seq = self._buffer.positions[login]
+            messages = self._storage.get_user_messages_page(login, after_seq,
+                                                            limit)
+            with self._condition:
+                if self._closed:
+                    return
+                self._buffer.add_page(login, messages, limit)
+
+    def _cancel(self):
+        """Cancels storage watches."""
+        with self._condition:
+            cancels, self._cancels = self._cancels, []
+        for cancel in cancels:
+            cancel()
+
+    def __iter__(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or self._buffer.messages
+                    or self._ended or self._buffer.lagging)
+                if self._disconnected:
+                    raise SlowConsumerError(
+                        f"subscriber is behind for {self._buffer.timeout}"
+                        " seconds")
+                if self._closed:
+                    return
+                if self._buffer.behind_since is not None:
+                    self._stop_timer()
+                    self._buffer.resume()
+                batch = self._buffer.take()
+                lagging = self._buffer.lagging_mailboxes()
+            if batch:
+                yield batch
+            elif self._ended:
+                raise WatchBrokenError(
+                    f"storage watch of {self._login} is broken")
+            else:
+                self._read_pages(lagging)
+
+    def close(self):
+        """Cancels storage watch and wakes up waiting iterator."""
+        with self._condition:
+            self._closed = True
+            self._stop_timer()
+            self._buffer.clear()
+            self._condition.notify()
+        self._cancel()
+
+
+def watched_mailboxes(login: str, channels: Dict[str, int]) -> Dict[str, int]:
+    """Returns mailboxes of user and channels to watch with positions
+    their messages are read after.
+    """
+    mailboxes = {login: 0}
+    for name, cursor in channels.items():
+        mailboxes[channel_login(name)] = cursor
+    return mailboxes
+
+
+class MessageCompactor:
+
+    """Background thread compacting messages of storage every interval
+    seconds until it is stopped. Failed compaction is retried on the
+    next interval.
+    """
+
+    def __init__(self, storage: Storage,
+                 interval: float = COMPACTION_INTERVAL):
+        self.storage = storage
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Starts compacting in background."""
+        self._thread.start()
+
+    def _run(self):
+        """Compacts messages every interval until stopped."""
+        while not self._stopped.wait(self.interval):
+            try:
+                deleted = self.storage.compact_messages()
+            except Exception:
+                logging.exception("Compacting messages failed")
+                continue
+            if deleted:
+                logging.info(f"Compaction deleted {deleted} messages")
+
+    def stop(self):
+        """Stops compacting and waits for running compaction."""
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
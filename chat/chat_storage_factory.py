@@ -3,8 +3,15 @@ new storage types and to create new storage instances if
 they are already registered.
 """
 
-from chat_storage import Storage
+from typing import Iterable
+
+from chat_metrics import InstrumentedStorage
+from chat_storage import Storage, StorageWrapper
 from storages.etcd_storage import EtcdStorage
+from storages.memory_storage import MemoryStorage
+from storages.sharded_storage import ShardedStorage
+from storages.sqlite_storage import SqliteStorage
+from storages.user_cache_storage import UserCacheStorage
 
 
 class UnknownStorageError(Exception):
@@ -17,23 +24,45 @@ class UnknownStorageError(Exception):
 class StorageFactory:
 
     """StorageFactory class provides methods for adding new 
-    storage types and initializing an object of a Storage class.
+    storage types and storage wrappers, initializing an object
+    of a Storage class wrapped with chosen wrappers.
     """
 
     storage_registry = {}
+    wrapper_registry = {}
 
     @classmethod
     def register_storage(cls, name: str, storage_class: Storage):
         """Registers Storage subclass in storage_registry."""
         cls.storage_registry[name] = storage_class
 
+    @classmethod
+    def register_wrapper(cls, name: str, wrapper_class: StorageWrapper):
+        """Registers StorageWrapper subclass in wrapper_registry."""
+        cls.wrapper_registry[name] = wrapper_class
+
     @staticmethod
-    def create_storage(storage_type: str, host: str, port: str):
-        """Returns storage object according to storage type."""
+    def create_storage(storage_type: str, host: str, port: str,
+                       wrappers: Iterable[str] = (), **options):
+        """Returns storage object according to storage type and options,
+        wrapped with wrappers in the given order.
+        """
         try:
-            return StorageFactory.storage_registry[storage_type](host, port)
+            storage_class = StorageFactory.storage_registry[storage_type]
         except KeyError:
             raise UnknownStorageError(f"Unknown storage type: {storage_type}")
+        storage = storage_class(host, port, **options)
+        for wrapper in wrappers:
+            try:
+                storage = StorageFactory.wrapper_registry[wrapper](storage)
+            except KeyError:
+                raise UnknownStorageError(f"Unknown storage wrapper: {wrapper}")
+        return storage
 
 
 StorageFactory.register_storage("etcd", EtcdStorage)
+StorageFactory.register_storage("memory", MemoryStorage)
+StorageFactory.register_storage("sharded", ShardedStorage)
+StorageFactory.register_storage("sqlite", SqliteStorage)
+StorageFactory.register_wrapper("user_cache", UserCacheStorage)
+StorageFactory.register_wrapper("metrics", InstrumentedStorage)
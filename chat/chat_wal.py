@@ -0,0 +1,302 @@
+"""This module contains write-ahead log of sent messages kept by server
+in local memory-mapped segment files. Messages are acknowledged to
+client once they are synced to the log and are saved to storage in
+batches by background thread, messages not saved before restart are
+saved after it.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import List, Tuple
+
+from chat_codecs import decode_message, get_codec
+from chat_storage import Message, Storage, StorageWrapper
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_SUFFIX = ".wal"
+CHECKPOINT_FILE = "checkpoint"
+DRAIN_BATCH_SIZE = 500
+DRAIN_RETRY_DELAY = 0.1
+DRAIN_MAX_RETRY_DELAY = 5.0
+# Every record is payload length and its crc32 followed by message encoded
+# by codec, zero length marks unused rest of segment.
+RECORD_HEADER = struct.Struct("<II")
+
+Position = Tuple[int, int]
+
+
+class WriteAheadLog:
+
+    """Append-only log of messages in numbered segment files of fixed
+    size mapped to memory. Appending threads wait for sync of the log,
+    writes of threads appending meanwhile are synced together. Log is
+    read from checkpoint, segments before checkpoint are removed.
+    Positions are (segment number, offset) pairs.
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE,
+                 codec: str = "protobuf"):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.codec = get_codec(codec)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._synced_changed = threading.Condition(self._lock)
+        self._segments = {}
+        self.checkpoint = self._read_checkpoint()
+        for segment in self._list_segments():
+            if segment < self.checkpoint[0]:
+                os.remove(self._segment_path(segment))
+            else:
+                self._open_segment(segment)
+        if not self._segments:
+            self._open_segment(self.checkpoint[0])
+        self._position = self._recover()
+        self.synced = self._position
+
+    def _segment_path(self, segment: int) -> str:
+        """Returns path of segment file with number."""
+        return os.path.join(self.directory,
+                            "{:020d}{}".format(segment, SEGMENT_SUFFIX))
+
+    def _list_segments(self) -> List[int]:
+        """Returns numbers of segment files in order."""
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _open_segment(self, segment: int):
+        """Maps segment file to memory, creating it of segment size."""
+        path = self._segment_path(segment)
+        created = not os.path.exists(path)
+        with open(path, "a+b") as segment_file:
+            if created:
+                segment_file.truncate(self.segment_size)
+                os.fsync(segment_file.fileno())
+            self._segments[segment] = mmap.mmap(segment_file.fileno(), 0)
+        if created:
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def _read_checkpoint(self) -> Position:
+        """Returns position saved in checkpoint file or the log start."""
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as file:
+                segment, offset = file.read().split()
+                return int(segment), int(offset)
+        except FileNotFoundError:
+            segments = self._list_segments()
+            return (segments[0] if segments else 0), 0
+
+    def _read_record(self, position: Position):
+        """Returns payload of valid record at position and position after
+        it, or (None, position) if there is no record.
+        """
+        segment, offset = position
+        data = self._segments[segment]
+        if offset + RECORD_HEADER.size > len(data):
+            return None, position
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        if not length or start + length > len(data):
+            return None, position
+        payload = data[start:start + length]
+        if zlib.crc32(payload) != crc:
+            return None, position
+        return payload, (segment, start + length)
+
+    def _recover(self) -> Position:
+        """Returns position after the last valid record of the last
+        segment. Torn record written before crash and anything after it
+        are cleared, as they were never acknowledged.
+        """
+        segment = max(self._segments)
+        position = self.checkpoint if segment == self.checkpoint[0] \
+            else (segment, 0)
+        while True:
+            payload, next_position = self._read_record(position)
+            if payload is None:
+                break
+            position = next_position
+        data = self._segments[segment]
+        data[position[1]:] = bytes(len(data) - position[1])
+        data.flush()
+        return position
+
+    def _write(self, payload: bytes):
+        """Writes record at log end, starting new segment if it doesn't
+        fit into the current one. Must be called under lock.
+        """
+        size = RECORD_HEADER.size + len(payload)
+        if size > self.segment_size:
+            raise ValueError(f"Message of {len(payload)} bytes doesn't fit "
+                             f"log segment of {self.segment_size} bytes")
+        segment, offset = self._position
+        if offset + size > self.segment_size:
+            segment, offset = segment + 1, 0
+            self._open_segment(segment)
+        data = self._segments[segment]
+        data[offset:offset + size] = (
+            RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._position = (segment, offset + size)
+
+    def _sync(self, position: Position):
+        """Returns when log is synced up to position. Thread syncing the
+        log syncs writes of all threads waiting for it.
+        """
+        with self._sync_lock:
+            if self.synced >= position:
+                return
+            with self._lock:
+                target = self._position
+                segments = [data for segment, data in self._segments.items()
+                            if segment >= self.synced[0]]
+            for data in segments:
+                data.flush()
+            with self._lock:
+                self.synced = target
+                self._synced_changed.notify_all()
+
+    def append(self, messages: List[Message]):
+        """Writes messages to log and returns once they are synced."""
+        payloads = [self.codec.encode_message(message) for message in messages]
+        with self._lock:
+            for payload in payloads:
+                self._write(payload)
+            position = self._position
+        self._sync(position)
+
+    def read(self, position: Position, limit: int,
+             timeout: float = None) -> Tuple[List[Message], Position]:
+        """Returns up to limit synced messages after position and position
+        after them. Waits up to timeout for messages if there are none.
+        """
+        with self._lock:
+            if position >= self.synced:
+                self._synced_changed.wait(timeout)
+            synced = self.synced
+        messages = []
+        while len(messages) < limit and position < synced:
+            payload, next_position = self._read_record(position)
+            if payload is None:
+                position = (position[0] + 1, 0)
+                continue
+            messages.append(decode_message(payload))
+            position = next_position
+        return messages, position
+
+    def set_checkpoint(self, position: Position):
+        """Saves position messages before which are no longer needed and
+        removes segments before it.
+        """
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as file:
+            file.write("{} {}".format(*position))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self.checkpoint = position
+            removed = [segment for segment in self._segments
+                       if segment < position[0]]
+            for segment in removed:
+                self._segments.pop(segment).close()
+        for segment in removed:
+            os.remove(self._segment_path(segment))
+
+    def wake_readers(self):
+        """Wakes up threads waiting for new messages."""
+        with self._lock:
+            self._synced_changed.notify_all()
+
+    def close(self):
+        """Syncs and unmaps segments."""
+        with self._lock:
+            for data in self._segments.values():
+                data.flush()
+                data.close()
+            self._segments.clear()
+
+
+class WalStorage(StorageWrapper):
+
+    """Saves sent messages to write-ahead log and returns, background
+    thread saves them from the log to wrapped storage in batches,
+    retrying while storage fails. Messages left in the log by previous
+    run are saved first. Messages become visible to reads and watches
+    of storage once they are saved there.
+    """
+
+    def __init__(self, storage: Storage, directory: str,
+                 segment_size: int = SEGMENT_SIZE,
+                 batch_size: int = DRAIN_BATCH_SIZE):
+        super().__init__(storage)
+        self.wal = WriteAheadLog(directory, segment_size)
+        self.batch_size = batch_size
+        self._closed = threading.Event()
+        self._drainer = threading.Thread(target=self._drain, daemon=True)
+        self._drainer.start()
+
+    def create_message(self, message: Message):
+        """Writes message to log."""
+        self.wal.append([message])
+
+    def create_messages(self, messages: List[Message]):
+        """Writes batch of messages to log."""
+        self.wal.append(messages)
+
+    def _save(self, messages: List[Message]) -> bool:
+        """Saves messages to wrapped storage, retrying with growing delay
+        until it succeeds or storage is closed.
+        """
+        delay = DRAIN_RETRY_DELAY
+        while not self._closed.is_set():
+            try:
+                self.storage.create_messages(messages)
+                return True
+            except Exception:
+                logging.exception("Saving messages from write-ahead log failed")
+                self._closed.wait(delay)
+                delay = min(delay * 2, DRAIN_MAX_RETRY_DELAY)
+        return False
+
+    def _drain(self):
+        """Saves messages from log checkpoint on until storage is closed."""
+        position = self.wal.checkpoint
+        while not self._closed.is_set():
+            messages, next_position = self.wal.read(position, self.batch_size,
+                                                    timeout=1.0)
+            if messages and not self._save(messages):
+                return
+            if next_position != position:
+                self.wal.set_checkpoint(next_position)
+                position = next_position
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits until all synced messages are saved to wrapped storage.
+        Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.wal.checkpoint < self.wal.synced:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def close(self):
+        """Stops saving messages and closes log, messages which are not
+        saved yet will be saved after restart.
+        """
+        self._closed.set()
+        self.wal.wake_readers()
+        self._drainer.join()
+        self.wal.close()
@@ -0,0 +1,130 @@
+"""This module contains pool of etcd clients shared by server threads.
+Calls go to the least loaded client, clients whose connection failed
+are reconnected to the next etcd endpoint and the call is retried.
+"""
+
+import threading
+import time
+from typing import Callable, List, Tuple
+
+import grpc
+from etcd3.exceptions import ConnectionFailedError, ConnectionTimeoutError
+
+POOL_SIZE = 1
+RETRIES = 3
+RETRY_BACKOFF = 0.05
+TRANSIENT_ERRORS = (ConnectionFailedError, ConnectionTimeoutError)
+TRANSIENT_CODES = (grpc.StatusCode.UNAVAILABLE,
+                   grpc.StatusCode.DEADLINE_EXCEEDED)
+
+
+def parse_endpoints(host: str, port) -> List[Tuple[str, int]]:
+    """Returns endpoints from comma separated hosts, hosts without
+    port use the given one, e.g. "etcd1,etcd2:2380".
+    """
+    endpoints = []
+    for endpoint in host.split(","):
+        endpoint_host, _, endpoint_port = endpoint.strip().partition(":")
+        endpoints.append((endpoint_host, int(endpoint_port or port)))
+    return endpoints
+
+
+def is_transient(error: Exception) -> bool:
+    """Checks if error is lost or timed out connection worth retrying.
+    Raw gRPC errors come from calls made on etcd stubs directly.
+    """
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    return (isinstance(error, grpc.RpcError)
+            and error.code() in TRANSIENT_CODES)
+
+
+class PooledClient:
+
+    """Etcd client of the pool with its endpoint and number of calls
+    in flight.
+    """
+
+    def __init__(self, client, endpoint: int):
+        self.client = client
+        self.endpoint = endpoint
+        self.in_flight = 0
+
+
+class EtcdClientPool:
+
+    """Keeps size clients spread over etcd endpoints. Every call runs
+    on the client with the fewest calls in flight, ties are broken
+    round-robin. Transient errors reconnect the client to the next
+    endpoint and the call is retried with exponential backoff.
+    """
+
+    def __init__(self, endpoints: List[Tuple[str, int]],
+                 client_factory: Callable, size: int = POOL_SIZE,
+                 retries: int = RETRIES, backoff: float = RETRY_BACKOFF):
+        self.endpoints = endpoints
+        self.retries = retries
+        self.backoff = backoff
+        self._client_factory = client_factory
+        self._lock = threading.Lock()
+        self._next = 0
+        self.clients = [self._connect(index % len(endpoints))
+                        for index in range(max(size, 1))]
+
+    def _connect(self, endpoint: int) -> PooledClient:
+        """Creates client of endpoint with given index."""
+        host, port = self.endpoints[endpoint]
+        return PooledClient(self._client_factory(host=host, port=port),
+                            endpoint)
+
+    def _acquire(self) -> PooledClient:
+        """Returns least loaded client and counts call started on it."""
+        with self._lock:
+            count = len(self.clients)
+            start = self._next
+            self._next = (start + 1) % count
+            pooled = min((self.clients[(start + shift) % count]
+                          for shift in range(count)),
+                         key=lambda pooled: pooled.in_flight)
+            pooled.in_flight += 1
+            return pooled
+
+    def _release(self, pooled: PooledClient):
+        """Counts call finished on client."""
+        with self._lock:
+            pooled.in_flight -= 1
+
+    def _reconnect(self, pooled: PooledClient, client):
+        """Replaces failed client with client of the next endpoint,
+        unless another call has already replaced it.
+        """
+        with self._lock:
+            if pooled.client is not client:
+                return
+            pooled.endpoint = (pooled.endpoint + 1) % len(self.endpoints)
+            host, port = self.endpoints[pooled.endpoint]
+            pooled.client = self._client_factory(host=host, port=port)
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def call(self, function: Callable):
+        """Returns result of function called with pooled client.
+        Function is called again with another connection if it failed
+        with transient error, the last error is raised after retries.
+        """
+        attempt = 0
+        while True:
+            pooled = self._acquire()
+            client = pooled.client
+            try:
+                return function(client)
+            except Exception as error:
+                if not is_transient(error) or attempt >= self.retries:
+                    raise
+                self._reconnect(pooled, client)
+            finally:
+                self._release(pooled)
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
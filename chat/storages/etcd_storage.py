@@ -1,59 +1,519 @@
 """This is Python implementation of etcd client to store data."""
 
-import json
-from dataclasses import asdict
-from typing import List
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional
 
 import etcd3
-from chat_storage import Message, Storage, User
+from etcd3 import etcdrpc
+from etcd3.events import PutEvent
+from etcd3.utils import increment_last_byte
+from chat_codecs import (decode_channel, decode_message, decode_user,
+                         encode_channel, get_codec)
+from chat_storage import (BACKLOG_PAGE_SIZE, Channel, Message, Storage, User,
+                          attach_seq, channel_login)
+from storages.etcd_pool import POOL_SIZE, EtcdClientPool, parse_endpoints
 
 USER_PREFIX = "user."
 MESSAGE_PREFIX = "message."
+SUBSCRIBER_PREFIX = "subscriber."
+CHANNEL_PREFIX = "channel."
+MEMBER_PREFIX = "member."
+SUBSCRIBER_TTL = 10
+WATCH_RETRY_DELAY = 1.0
+MAX_TXN_OPS = 128
+# Revisions kept as cursors of channel members are zero-padded, as etcd
+# compares values bytewise.
+CURSOR_FORMAT = "{:020d}"
+# Messages expiring within the same bucket of seconds share one lease.
+MESSAGE_LEASE_BUCKET = 60
 
 
 class EtcdStorage(Storage):
 
     """Provides methods for creating users, getting all users, 
     creating messages, getting all messages per user, removing specific
-    message for specific user.
+    message for specific user, watching new messages per user.
+    Values are written by chosen codec and read by the codec which
+    wrote them. Calls are spread over pool of clients connected to
+    comma separated etcd hosts and retried on connection errors.
+    Subscribers registered by this server node are kept under one etcd
+    lease, so they disappear when the node stops renewing it.
+    With message_ttl set messages are saved under leases expiring them,
+    one lease per bucket of expiry time. Compaction trims mailboxes and
+    channel logs to mailbox_size, with compact_history set it also
+    compacts etcd history of deleted keys, which is cluster-wide, so it
+    is left to etcd auto-compaction by default. Sequence number of
+    message is mod revision of its key, which etcd assigns in order of
+    commits. Cursor of channel member is the value of member key, keys of
+    user's memberships share prefix, so they are read with one range.
     """
 
-    def __init__(self, host, port):
-        """Initializes storage client via etcd."""
-        self.client = etcd3.client(host=host, port=port)
+    watches_across_nodes = True
+    subscribers_across_nodes = True
+
+    def __init__(self, host, port, codec: str = "json",
+                 pool_size: int = POOL_SIZE, message_ttl: float = 0,
+                 mailbox_size: int = 0, compact_history: bool = False,
+                 **options):
+        """Initializes pool of storage clients via etcd."""
+        self.pool = EtcdClientPool(parse_endpoints(host, port), etcd3.client,
+                                   pool_size)
+        self.codec = get_codec(codec)
+        self.message_ttl = message_ttl
+        self.mailbox_size = mailbox_size
+        self.compact_history = compact_history
+        self._subscribers_lock = threading.Lock()
+        self._subscribers: Dict[str, List] = {}
+        self._lease = None
+        self._message_leases_lock = threading.Lock()
+        self._message_leases = {}
+        self._compacted_revision = None
+
+    def _kv(self, method: str, request):
+        """Calls etcd KV service method with request, for requests the
+        client has no method for.
+        """
+        return self.pool.call(lambda client: getattr(client.kvstub, method)(
+            request, client.timeout, credentials=client.call_credentials,
+            metadata=client.metadata))
+
+    def _get_message_lease(self):
+        """Returns lease expiring at the end of bucket message TTL ends
+        in, granting it for the first message of the bucket. Returns None
+        if messages don't expire.
+        """
+        if not self.message_ttl:
+            return None
+        now = time.time()
+        bucket = MESSAGE_LEASE_BUCKET
+        expires_at = (int(now + self.message_ttl) // bucket + 1) * bucket
+        with self._message_leases_lock:
+            lease = self._message_leases.get(expires_at)
+            if lease is None:
+                lease = self.pool.call(lambda client: client.lease(
+                    math.ceil(expires_at - now)))
+                self._message_leases = {
+                    bucket_end: bucket_lease for bucket_end, bucket_lease
+                    in self._message_leases.items() if bucket_end > now}
+                self._message_leases[expires_at] = lease
+            return lease
 
     def create_user(self, user: User):
         """Saves user object into etcd using user key."""
         user_key = user.get_unique_key()
-        user_value = json.dumps(asdict(user))
-        self.client.put(user_key, user_value)
+        user_value = self.codec.encode_user(user)
+        self.pool.call(lambda client: client.put(user_key, user_value))
 
     def get_users_list(self) -> List[User]:
         """Returns list of users."""
         users = []
-        for value, key in self.client.get_prefix(USER_PREFIX):
-            user = json.loads(value.decode())
-            users.append(User(**user))
+        for value, key in self.pool.call(
+                lambda client: client.get_prefix(USER_PREFIX)):
+            users.append(decode_user(value))
         return users
 
+    def get_users_page(self, after_login: str = "", limit: int = 100,
+                       login_prefix: str = "") -> List[User]:
+        """Returns page of users with one etcd range read limited by
+        number of keys, starting right after key of after_login.
+        """
+        prefix_key = "{}{}".format(USER_PREFIX, login_prefix).encode()
+        start_key = prefix_key
+        if after_login:
+            start_key = max(start_key,
+                            "{}{}\0".format(USER_PREFIX, after_login).encode())
+        range_request = etcdrpc.RangeRequest(
+            key=start_key, range_end=increment_last_byte(prefix_key),
+            limit=limit, sort_order=etcdrpc.RangeRequest.ASCEND)
+        range_response = self._kv("Range", range_request)
+        return [decode_user(kv.value) for kv in range_response.kvs]
+
     def create_message(self, message: Message):
         """Saves message object into etcd using message key.
-        Message key includes user login and timestamp created_at to be unique.
+        Message key includes user login and message id to be unique.
         """
         message_key = message.get_unique_key()
-        message_value = json.dumps(asdict(message))
-        self.client.put(message_key, message_value)
+        message_value = self.codec.encode_message(message)
+        lease = self._get_message_lease()
+        self.pool.call(lambda client: client.put(message_key, message_value,
+                                                 lease=lease))
+
+    def create_messages(self, messages: List[Message]):
+        """Saves batch of messages, every etcd transaction puts up to
+        MAX_TXN_OPS messages in one round-trip.
+        """
+        lease = self._get_message_lease()
+        for start in range(0, len(messages), MAX_TXN_OPS):
+            batch = messages[start:start + MAX_TXN_OPS]
+            self.pool.call(lambda client: client.transaction(
+                compare=[], failure=[],
+                success=[client.transactions.put(
+                    message.get_unique_key(),
+                    self.codec.encode_message(message), lease=lease)
+                    for message in batch]))
 
     def get_user_messages(self, login: str) -> List[Message]:
-        """Returns list of messages for specific user."""
-        messages = []
+        """Returns list of messages for specific user in order of their
+        mod revisions.
+        """
         message_key = "{}{}.".format(MESSAGE_PREFIX, login)
-        messages_from_db = self.client.get_prefix(message_key)
-        for value, key in messages_from_db:
-            message = json.loads(value.decode())
-            messages.append(Message(**message))
-        return messages
+        response = self.pool.call(lambda client: client.get_prefix_response(
+            message_key, sort_order="ascend", sort_target="mod"))
+        return [attach_seq(decode_message(kv.value), kv.mod_revision)
+                for kv in response.kvs]
+
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = BACKLOG_PAGE_SIZE
+                               ) -> List[Message]:
+        """Returns up to limit messages of user modified after after_seq
+        revision, in order of mod revisions. Etcd filters, sorts and
+        limits the range itself, so only the page is sent over network.
+        """
+        prefix_key = "{}{}.".format(MESSAGE_PREFIX, login).encode()
+        response = self._kv("Range", etcdrpc.RangeRequest(
+            key=prefix_key, range_end=increment_last_byte(prefix_key),
+            min_mod_revision=after_seq + 1, limit=limit,
+            sort_order=etcdrpc.RangeRequest.ASCEND,
+            sort_target=etcdrpc.RangeRequest.MOD))
+        return [attach_seq(decode_message(kv.value), kv.mod_revision)
+                for kv in response.kvs]
 
     def delete_user_message(self, message: Message):
         """Deletes message from storage after sending it for user."""
-        self.client.delete(message.get_unique_key())
+        message_key = message.get_unique_key()
+        self.pool.call(lambda client: client.delete(message_key))
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of messages after sending them for user.
+        Every etcd transaction deletes up to MAX_TXN_OPS keys in one
+        round-trip, as etcd limits number of operations per transaction.
+        """
+        for start in range(0, len(messages), MAX_TXN_OPS):
+            batch = messages[start:start + MAX_TXN_OPS]
+            self.pool.call(lambda client: client.transaction(
+                compare=[], failure=[],
+                success=[client.transactions.delete(message.get_unique_key())
+                         for message in batch]))
+
+    def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user up to cursor: keys of user modified
+        up to cursor revision are read with one range, then deleted by
+        transactions of up to MAX_TXN_OPS keys, each key only if it is
+        not modified since. Keys of failed transaction are deleted one by
+        one. Returns number of deleted messages.
+        """
+        prefix_key = "{}{}.".format(MESSAGE_PREFIX, login).encode()
+        keys = [kv.key for kv in self._kv("Range", etcdrpc.RangeRequest(
+            key=prefix_key, range_end=increment_last_byte(prefix_key),
+            keys_only=True, max_mod_revision=cursor)).kvs]
+        deleted = 0
+        for start in range(0, len(keys), MAX_TXN_OPS):
+            batch = keys[start:start + MAX_TXN_OPS]
+            if self._delete_unmodified(batch, cursor):
+                deleted += len(batch)
+                continue
+            for key in batch:
+                deleted += self._delete_unmodified([key], cursor)
+        return deleted
+
+    def _delete_unmodified(self, keys: List[bytes], revision: int) -> bool:
+        """Deletes keys in one transaction if none of them is modified
+        after revision, returns if they are deleted.
+        """
+        succeeded, responses = self.pool.call(
+            lambda client: client.transaction(
+                compare=[client.transactions.mod(key) < revision + 1
+                         for key in keys],
+                success=[client.transactions.delete(key) for key in keys],
+                failure=[]))
+        return succeeded
+
+    def _trim_mailbox(self, login: str) -> int:
+        """Deletes the oldest messages of user over mailbox size with one
+        range delete up to the last of them, returns their number.
+        """
+        prefix_key = "{}{}.".format(MESSAGE_PREFIX, login).encode()
+        range_end = increment_last_byte(prefix_key)
+        count = self._kv("Range", etcdrpc.RangeRequest(
+            key=prefix_key, range_end=range_end, count_only=True)).count
+        excess = count - self.mailbox_size
+        if excess <= 0:
+            return 0
+        oldest = self._kv("Range", etcdrpc.RangeRequest(
+            key=prefix_key, range_end=range_end, limit=excess,
+            keys_only=True, sort_order=etcdrpc.RangeRequest.ASCEND)).kvs
+        return self._kv("DeleteRange", etcdrpc.DeleteRangeRequest(
+            key=prefix_key, range_end=oldest[-1].key + b"\0")).deleted
+
+    def _iter_mailboxes(self):
+        """Yields recipients having messages, users and channels alike,
+        registered or not. One message is read per recipient, the next
+        read starts right after keys of the recipient found.
+        """
+        range_end = increment_last_byte(MESSAGE_PREFIX.encode())
+        start_key = MESSAGE_PREFIX.encode()
+        while True:
+            kvs = self._kv("Range", etcdrpc.RangeRequest(
+                key=start_key, range_end=range_end, limit=1)).kvs
+            if not kvs:
+                return
+            login = decode_message(kvs[0].value).login_to
+            yield login
+            start_key = increment_last_byte(
+                "{}{}.".format(MESSAGE_PREFIX, login).encode())
+
+    def _compact_history(self):
+        """Compacts etcd history up to revision of the previous call, so
+        watches started since then still get their events.
+        """
+        revision = self._kv("Range", etcdrpc.RangeRequest(
+            key=MESSAGE_PREFIX.encode(), count_only=True)).header.revision
+        if self._compacted_revision is not None:
+            try:
+                self.pool.call(lambda client: client.compact(
+                    self._compacted_revision))
+            except Exception as error:
+                logging.info(f"Etcd history is not compacted: {error}")
+        self._compacted_revision = revision
+
+    def compact_messages(self) -> int:
+        """Trims every mailbox to mailbox size and compacts etcd history
+        if it is enabled. Expired messages are deleted by etcd with their
+        leases. Returns number of deleted messages.
+        """
+        deleted = 0
+        if self.mailbox_size:
+            for login in self._iter_mailboxes():
+                deleted += self._trim_mailbox(login)
+        if self.compact_history:
+            self._compact_history()
+        return deleted
+
+    def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Reads pending messages of user and starts etcd prefix watch
+        right after the revision of that read, so no message is missed
+        or passed twice. With with_pending False only the revision is
+        read, by a range counting keys. Watch stays on the client which
+        started it. Returns function cancelling the watch.
+        """
+        message_key = "{}{}.".format(MESSAGE_PREFIX, login)
+        if with_pending:
+            client, response = self.pool.call(
+                lambda client: (client, client.get_prefix_response(
+                    message_key, sort_order="ascend", sort_target="mod")))
+        else:
+            # Etcd client drops count_only of get_prefix_response, so the
+            # range without keys is requested by KV service directly.
+            prefix_key = message_key.encode()
+            client, response = self.pool.call(
+                lambda client: (client, client.kvstub.Range(
+                    etcdrpc.RangeRequest(
+                        key=prefix_key,
+                        range_end=increment_last_byte(prefix_key),
+                        count_only=True),
+                    client.timeout, credentials=client.call_credentials,
+                    metadata=client.metadata)))
+        messages = [attach_seq(decode_message(kv.value), kv.mod_revision)
+                    for kv in response.kvs]
+        if messages:
+            callback(messages)
+
+        def on_watch_response(watch_response):
+            if isinstance(watch_response, Exception):
+                callback(None)
+                return
+            messages = [attach_seq(decode_message(event.value),
+                                   event.mod_revision)
+                        for event in watch_response.events
+                        if isinstance(event, PutEvent)]
+            if messages:
+                callback(messages)
+
+        watch_id = client.add_watch_prefix_callback(
+            message_key, on_watch_response,
+            start_revision=response.header.revision + 1)
+        return lambda: client.cancel_watch(watch_id)
+
+    def watch_users(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Calls callback on every change of users prefix in etcd or if
+        the watch is broken. Etcd client drops callbacks of broken watch
+        stream, so the watch is started again in background, retrying
+        every WATCH_RETRY_DELAY seconds, and callback is called once more
+        when it is back, as changes made meanwhile were missed. Returns
+        function cancelling the watch.
+        """
+        lock = threading.Lock()
+        cancelled = threading.Event()
+        # Client and id of the current watch.
+        current = {}
+
+        def on_watch_response(watch_response):
+            callback()
+            if isinstance(watch_response, Exception):
+                threading.Thread(target=rewatch, daemon=True).start()
+
+        def start_watch() -> bool:
+            client, watch_id = self.pool.call(
+                lambda client: (client, client.add_watch_prefix_callback(
+                    USER_PREFIX, on_watch_response)))
+            with lock:
+                if not cancelled.is_set():
+                    current.update(client=client, watch_id=watch_id)
+                    return True
+            client.cancel_watch(watch_id)
+            return False
+
+        def rewatch():
+            while not cancelled.is_set():
+                try:
+                    if start_watch():
+                        callback()
+                    return
+                except Exception:
+                    logging.exception("Watching users failed")
+                cancelled.wait(WATCH_RETRY_DELAY)
+
+        def cancel():
+            with lock:
+                cancelled.set()
+                client, watch_id = current["client"], current["watch_id"]
+            client.cancel_watch(watch_id)
+
+        start_watch()
+        return cancel
+
+    def create_channel(self, channel: Channel):
+        """Saves channel into etcd using channel key."""
+        channel_key = channel.get_unique_key()
+        channel_value = encode_channel(channel)
+        self.pool.call(lambda client: client.put(channel_key, channel_value))
+
+    def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel by name."""
+        channel_key = "{}{}".format(CHANNEL_PREFIX, name)
+        value, metadata = self.pool.call(lambda client: client.get(channel_key))
+        return decode_channel(value) if value is not None else None
+
+    def last_message_seq(self, login: str) -> int:
+        """Returns the current revision of etcd, messages saved after it
+        get greater mod revisions.
+        """
+        return self._kv("Range", etcdrpc.RangeRequest(
+            key=MESSAGE_PREFIX.encode(), count_only=True)).header.revision
+
+    def join_channel(self, name: str, login: str,
+                     cursor: Optional[int] = None):
+        """Puts member key with cursor, by default at the current
+        revision, unless the key exists already.
+        """
+        member_key = "{}{}.{}".format(MEMBER_PREFIX, login, name)
+        if cursor is None:
+            cursor = self.last_message_seq(channel_login(name))
+        cursor = CURSOR_FORMAT.format(cursor)
+        self.pool.call(lambda client: client.transaction(
+            compare=[client.transactions.create(member_key) == 0],
+            success=[client.transactions.put(member_key, cursor)],
+            failure=[]))
+
+    def leave_channel(self, name: str, login: str):
+        """Deletes member key."""
+        member_key = "{}{}.{}".format(MEMBER_PREFIX, login, name)
+        self.pool.call(lambda client: client.delete(member_key))
+
+    def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user with cursors by one prefix read."""
+        prefix = "{}{}.".format(MEMBER_PREFIX, login)
+        members = self.pool.call(lambda client: client.get_prefix(prefix))
+        return {metadata.key.decode()[len(prefix):]: int(value)
+                for value, metadata in members}
+
+    def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Puts cursor if member key has cursor before it, etcd fails
+        the comparison if key doesn't exist.
+        """
+        member_key = "{}{}.{}".format(MEMBER_PREFIX, login, name)
+        cursor = CURSOR_FORMAT.format(cursor)
+        self.pool.call(lambda client: client.transaction(
+            compare=[client.transactions.value(member_key) < cursor],
+            success=[client.transactions.put(member_key, cursor)],
+            failure=[]))
+
+    def _put_subscriber(self, login: str, node_address: str, lease):
+        """Saves subscriber node of user under lease."""
+        subscriber_key = "{}{}".format(SUBSCRIBER_PREFIX, login)
+        self.pool.call(lambda client: client.put(subscriber_key, node_address,
+                                                 lease=lease))
+
+    def _get_lease(self):
+        """Returns lease of this node, granting it and starting its
+        renewal on the first call. Must be called under subscribers lock.
+        """
+        if self._lease is None:
+            self._lease = self.pool.call(
+                lambda client: client.lease(SUBSCRIBER_TTL))
+            threading.Thread(target=self._keep_lease_alive,
+                             daemon=True).start()
+        return self._lease
+
+    def _keep_lease_alive(self):
+        """Renews lease of this node, if the lease has expired, grants
+        a new one and saves registered subscribers again.
+        """
+        while True:
+            time.sleep(SUBSCRIBER_TTL / 3)
+            try:
+                if self._lease.refresh()[0].TTL > 0:
+                    continue
+            except Exception:
+                logging.exception("Renewing subscribers lease failed")
+            try:
+                with self._subscribers_lock:
+                    self._lease = self.pool.call(
+                        lambda client: client.lease(SUBSCRIBER_TTL))
+                    subscribers = dict(self._subscribers)
+                for login, (node_address, count) in subscribers.items():
+                    self._put_subscriber(login, node_address, self._lease)
+            except Exception:
+                logging.exception("Granting subscribers lease failed")
+
+    def register_subscriber(self, login: str,
+                            node_address: str) -> Callable[[], None]:
+        """Saves node serving subscription of user under node lease.
+        Returns function deleting the key when the last subscription of
+        user on this node ends, unless another node has taken it over.
+        """
+        with self._subscribers_lock:
+            count = self._subscribers.get(login, (node_address, 0))[1]
+            self._subscribers[login] = [node_address, count + 1]
+            lease = self._get_lease()
+        self._put_subscriber(login, node_address, lease)
+
+        def cancel():
+            with self._subscribers_lock:
+                subscriber = self._subscribers[login]
+                subscriber[1] -= 1
+                if subscriber[1]:
+                    return
+                del self._subscribers[login]
+            subscriber_key = "{}{}".format(SUBSCRIBER_PREFIX, login)
+            self.pool.call(lambda client: client.transaction(
+                compare=[client.transactions.value(subscriber_key)
+                         == node_address],
+                success=[client.transactions.delete(subscriber_key)],
+                failure=[]))
+
+        return cancel
+
+    def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns node serving subscription of user."""
+        subscriber_key = "{}{}".format(SUBSCRIBER_PREFIX, login)
+        value, metadata = self.pool.call(
+            lambda client: client.get(subscriber_key))
+        return value.decode() if value is not None else None
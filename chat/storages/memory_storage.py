@@ -0,0 +1,290 @@
+"""This is Python implementation of in-process storage keeping users
+and messages in memory, it needs no external services.
+"""
+
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, Dict, List, Optional
+
+from chat_storage import (BACKLOG_PAGE_SIZE, Channel, Message, Storage, User,
+                          attach_seq, channel_login, message_seq)
+
+
+class MemoryStorage(Storage):
+
+    """Keeps users in dict and messages in per-recipient deques.
+    All methods are thread-safe. New messages are pushed to watch
+    callbacks of recipient, callbacks are called under storage lock
+    and should only hand messages over. Sequence numbers of messages are
+    counted per mailbox under the same lock. Channel members are kept
+    with their cursors per user. With mailbox_size set the oldest
+    messages of user are dropped as soon as new ones exceed it, messages
+    older than message_ttl seconds are dropped by compaction.
+    """
+
+    def __init__(self, host=None, port=None, message_ttl: float = 0,
+                 mailbox_size: int = 0, **options):
+        """Initializes empty storage, host, port and other options are
+        not used.
+        """
+        self.message_ttl = message_ttl
+        self.mailbox_size = mailbox_size
+        self._lock = threading.Lock()
+        self._users: Dict[str, User] = {}
+        self._messages: Dict[str, deque] = defaultdict(deque)
+        self._seqs: Dict[str, int] = defaultdict(int)
+        self._watches: Dict[str, Dict[int, Callable]] = defaultdict(dict)
+        self._user_watches: Dict[int, Callable] = {}
+        self._watch_ids = 0
+        self._subscribers: Dict[str, Dict[int, str]] = defaultdict(dict)
+        self._channels: Dict[str, Channel] = {}
+        self._members: Dict[str, Dict[str, int]] = defaultdict(dict)
+
+    def create_user(self, user: User):
+        """Saves user by login."""
+        with self._lock:
+            self._users[user.login] = user
+            for callback in self._user_watches.values():
+                callback()
+
+    def get_users_list(self) -> List[User]:
+        """Returns list of users."""
+        with self._lock:
+            return list(self._users.values())
+
+    def create_message(self, message: Message):
+        """Appends message to recipient's queue and pushes it to watches."""
+        with self._lock:
+            self._append(message)
+            self._trim_mailbox(message.login_to)
+            for callback in self._watches.get(message.login_to, {}).values():
+                callback([message])
+
+    def create_messages(self, messages: List[Message]):
+        """Appends batch of messages under one lock, every watch gets
+        messages of its recipient as one batch.
+        """
+        batches = defaultdict(list)
+        for message in messages:
+            batches[message.login_to].append(message)
+        with self._lock:
+            for login, batch in batches.items():
+                for message in batch:
+                    self._append(message)
+                self._trim_mailbox(login)
+                for callback in self._watches.get(login, {}).values():
+                    callback(batch)
+
+    def _append(self, message: Message):
+        """Appends message to queue of recipient with the next sequence
+        number of the mailbox. Must be called under lock.
+        """
+        self._seqs[message.login_to] += 1
+        attach_seq(message, self._seqs[message.login_to])
+        self._messages[message.login_to].append(message)
+
+    def _trim_mailbox(self, login: str) -> int:
+        """Drops the oldest messages of user over mailbox size and returns
+        their number. Must be called under lock.
+        """
+        messages = self._messages[login]
+        excess = len(messages) - self.mailbox_size
+        if not self.mailbox_size or excess <= 0:
+            return 0
+        for x in range(excess):
+            messages.popleft()
+        return excess
+
+    def compact_messages(self) -> int:
+        """Drops messages older than message TTL, returns their number."""
+        if not self.message_ttl:
+            return 0
+        expired_before = time.time() - self.message_ttl
+        deleted = 0
+        with self._lock:
+            for login in list(self._messages):
+                messages = self._messages[login]
+                remaining = deque(message for message in messages
+                                  if message.created_at >= expired_before)
+                deleted += len(messages) - len(remaining)
+                if remaining:
+                    self._messages[login] = remaining
+                else:
+                    del self._messages[login]
+        return deleted
+
+    def get_user_messages(self, login: str) -> List[Message]:
+        """Returns list of messages for specific user."""
+        with self._lock:
+            return list(self._messages.get(login, ()))
+
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = BACKLOG_PAGE_SIZE
+                               ) -> List[Message]:
+        """Returns up to limit messages of user after after_seq, skipping
+        the head of queue up to it.
+        """
+        with self._lock:
+            page = []
+            for message in self._messages.get(login, ()):
+                if len(page) == limit:
+                    break
+                if message_seq(message) > after_seq:
+                    page.append(message)
+            return page
+
+    def delete_user_message(self, message: Message):
+        """Deletes message from recipient's queue, it is usually
+        the first one as messages are read in order.
+        """
+        with self._lock:
+            self._remove_message(message)
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of messages under one lock."""
+        with self._lock:
+            for message in messages:
+                self._remove_message(message)
+
+    def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user up to cursor from the head of queue
+        under one lock, as queue is kept in order of sequence numbers.
+        """
+        with self._lock:
+            messages = self._messages.get(login)
+            if not messages:
+                return 0
+            deleted = 0
+            while messages and message_seq(messages[0]) <= cursor:
+                messages.popleft()
+                deleted += 1
+            if not messages:
+                del self._messages[login]
+            return deleted
+
+    def _remove_message(self, message: Message):
+        """Removes message from queue, in O(1) for the head of queue."""
+        messages = self._messages.get(message.login_to)
+        if not messages:
+            return
+        if messages[0] == message:
+            messages.popleft()
+        else:
+            try:
+                messages.remove(message)
+            except ValueError:
+                pass
+        if not messages:
+            del self._messages[message.login_to]
+
+    def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Passes queued messages of user to callback, unless with_pending
+        is False, and registers it for new ones under the same lock, so no
+        message is missed. Returns function cancelling the watch.
+        """
+        with self._lock:
+            messages = list(self._messages.get(login, ()))
+            if messages and with_pending:
+                callback(messages)
+            self._watch_ids += 1
+            watch_id = self._watch_ids
+            self._watches[login][watch_id] = callback
+
+        def cancel():
+            with self._lock:
+                self._watches[login].pop(watch_id, None)
+                if not self._watches[login]:
+                    del self._watches[login]
+
+        return cancel
+
+    def watch_users(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Calls callback every time user is saved.
+        Returns function cancelling the watch.
+        """
+        with self._lock:
+            self._watch_ids += 1
+            watch_id = self._watch_ids
+            self._user_watches[watch_id] = callback
+
+        def cancel():
+            with self._lock:
+                self._user_watches.pop(watch_id, None)
+
+        return cancel
+
+    def create_channel(self, channel: Channel):
+        """Saves channel by name."""
+        with self._lock:
+            self._channels[channel.name] = channel
+
+    def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel by name."""
+        with self._lock:
+            return self._channels.get(name)
+
+    def last_message_seq(self, login: str) -> int:
+        """Returns the last seq counted for mailbox, 0 if there is none."""
+        with self._lock:
+            return self._seqs.get(login, 0)
+
+    def join_channel(self, name: str, login: str,
+                     cursor: Optional[int] = None):
+        """Adds member with cursor, by default at the last message of
+        channel.
+        """
+        with self._lock:
+            if cursor is None:
+                cursor = self._seqs.get(channel_login(name), 0)
+            self._members[login].setdefault(name, cursor)
+
+    def leave_channel(self, name: str, login: str):
+        """Removes member with its cursor."""
+        with self._lock:
+            channels = self._members.get(login)
+            if channels is None:
+                return
+            channels.pop(name, None)
+            if not channels:
+                del self._members[login]
+
+    def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user with cursors."""
+        with self._lock:
+            return dict(self._members.get(login, {}))
+
+    def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of member forward."""
+        with self._lock:
+            channels = self._members.get(login)
+            if channels is not None and channels.get(name, cursor) < cursor:
+                channels[name] = cursor
+
+    def register_subscriber(self, login: str,
+                            node_address: str) -> Callable[[], None]:
+        """Records node of subscription, the latest one is returned
+        while several are registered. Returns function removing it.
+        """
+        with self._lock:
+            self._watch_ids += 1
+            subscriber_id = self._watch_ids
+            self._subscribers[login][subscriber_id] = node_address
+
+        def cancel():
+            with self._lock:
+                self._subscribers[login].pop(subscriber_id, None)
+                if not self._subscribers[login]:
+                    del self._subscribers[login]
+
+        return cancel
+
+    def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns node of the latest subscription of user."""
+        with self._lock:
+            nodes = self._subscribers.get(login)
+            return nodes[max(nodes)] if nodes else None
@@ -0,0 +1,215 @@
+"""This is Python implementation of storage partitioning users and their
+messages across several storages by consistent hashing of logins.
+"""
+
+import bisect
+import hashlib
+import heapq
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional
+
+from chat_storage import (BACKLOG_PAGE_SIZE, Channel, Message, Storage, User,
+                          channel_login)
+
+SHARD_SEPARATOR = ";"
+SHARD_STORAGE = "etcd"
+VIRTUAL_NODES = 128
+
+
+def ring_hash(key: str) -> int:
+    """Returns hash of key which is the same in every process."""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+
+    """Consistent hash ring of named nodes. Every node is placed on the
+    ring as virtual nodes, key belongs to the first virtual node after
+    its hash. Adding node moves only keys which the new node takes over.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (),
+                 virtual_nodes: int = VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node: str):
+        """Places virtual nodes of node on the ring."""
+        for replica in range(self.virtual_nodes):
+            point = ring_hash("{}#{}".format(node, replica))
+            index = bisect.bisect(self._hashes, point)
+            self._hashes.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def get_node(self, key: str) -> str:
+        """Returns node which key belongs to."""
+        index = bisect.bisect(self._hashes, ring_hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class ShardedStorage(Storage):
+
+    """Keeps every user and messages sent to the user on one shard chosen
+    by login. Shards are storages of shard_storage type, one per host
+    group of STORAGE_HOST separated by semicolons, e.g.
+    "etcd1,etcd2;etcd3" makes two shards. Users list is gathered from
+    all shards. Channel and its log are kept in shard of "#name",
+    memberships of user in shard of the user.
+    """
+
+    def __init__(self, host, port, shard_storage: str = SHARD_STORAGE,
+                 virtual_nodes: int = VIRTUAL_NODES, **options):
+        """Initializes shard storages with the same options."""
+        from chat_storage_factory import StorageFactory
+        shard_hosts = [shard_host.strip()
+                       for shard_host in host.split(SHARD_SEPARATOR)]
+        self.shards: Dict[str, Storage] = {
+            shard_host: StorageFactory.create_storage(
+                shard_storage, shard_host, port, **options)
+            for shard_host in shard_hosts}
+        self.ring = HashRing(shard_hosts, virtual_nodes)
+        self.watches_across_nodes = all(
+            shard.watches_across_nodes for shard in self.shards.values())
+        self.subscribers_across_nodes = all(
+            shard.subscribers_across_nodes for shard in self.shards.values())
+
+    def get_shard(self, login: str) -> Storage:
+        """Returns shard keeping user with login and messages to the user."""
+        return self.shards[self.ring.get_node(login)]
+
+    def _group_by_shard(self, messages: List[Message]):
+        """Returns messages grouped by shard of their recipients."""
+        groups = defaultdict(list)
+        for message in messages:
+            groups[self.ring.get_node(message.login_to)].append(message)
+        return [(self.shards[node], group) for node, group in groups.items()]
+
+    def create_user(self, user: User):
+        """Saves user in shard of its login."""
+        self.get_shard(user.login).create_user(user)
+
+    def get_users_list(self) -> List[User]:
+        """Returns users of all shards."""
+        users = []
+        for shard in self.shards.values():
+            users.extend(shard.get_users_list())
+        return users
+
+    def get_users_page(self, after_login: str = "", limit: int = 100,
+                       login_prefix: str = "") -> List[User]:
+        """Returns page merged from pages of the same size of every shard."""
+        pages = [shard.get_users_page(after_login, limit, login_prefix)
+                 for shard in self.shards.values()]
+        merged = heapq.merge(*pages, key=lambda user: user.login)
+        return [user for user, x in zip(merged, range(limit))]
+
+    def create_message(self, message: Message):
+        """Saves message in shard of its recipient."""
+        self.get_shard(message.login_to).create_message(message)
+
+    def create_messages(self, messages: List[Message]):
+        """Saves batch of messages, one batch per shard."""
+        for shard, group in self._group_by_shard(messages):
+            shard.create_messages(group)
+
+    def get_user_messages(self, login: str) -> List[Message]:
+        """Returns messages of user from its shard."""
+        return self.get_shard(login).get_user_messages(login)
+
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = BACKLOG_PAGE_SIZE
+                               ) -> List[Message]:
+        """Returns page of messages of user from its shard."""
+        return self.get_shard(login).get_user_messages_page(login, after_seq,
+                                                            limit)
+
+    def delete_user_message(self, message: Message):
+        """Deletes message from shard of its recipient."""
+        self.get_shard(message.login_to).delete_user_message(message)
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of messages, one batch per shard."""
+        for shard, group in self._group_by_shard(messages):
+            shard.delete_user_messages(group)
+
+    def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user up to cursor in its shard."""
+        return self.get_shard(login).ack_user_messages(login, cursor)
+
+    def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Watches messages of user in its shard."""
+        return self.get_shard(login).watch_user_messages(login, callback,
+                                                         with_pending)
+
+    def compact_messages(self) -> int:
+        """Compacts messages of every shard."""
+        return sum(shard.compact_messages() for shard in self.shards.values())
+
+    def create_channel(self, channel: Channel):
+        """Saves channel in shard of its log."""
+        self.get_shard(channel.login).create_channel(channel)
+
+    def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel from shard of its log."""
+        return self.get_shard(channel_login(name)).get_channel(name)
+
+    def last_message_seq(self, login: str) -> int:
+        """Returns the last message seq of mailbox in its shard."""
+        return self.get_shard(login).last_message_seq(login)
+
+    def join_channel(self, name: str, login: str,
+                     cursor: Optional[int] = None):
+        """Adds channel member in shard of user, with cursor at the last
+        message seq of channel log in its own shard by default.
+        """
+        if cursor is None:
+            cursor = self.last_message_seq(channel_login(name))
+        self.get_shard(login).join_channel(name, login, cursor)
+
+    def leave_channel(self, name: str, login: str):
+        """Removes channel member in shard of user."""
+        self.get_shard(login).leave_channel(name, login)
+
+    def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user from shard of user."""
+        return self.get_shard(login).get_user_channels(login)
+
+    def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of channel member in shard of user."""
+        self.get_shard(login).set_channel_cursor(name, login, cursor)
+
+    def register_subscriber(self, login: str,
+                            node_address: str) -> Callable[[], None]:
+        """Registers subscriber node in shard of user."""
+        return self.get_shard(login).register_subscriber(login, node_address)
+
+    def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns subscriber node from shard of user."""
+        return self.get_shard(login).get_subscriber_node(login)
+
+    def watch_users(
+            self, callback: Callable[[], None]
+    ) -> Optional[Callable[[], None]]:
+        """Watches users of every shard. Returns None if any shard
+        doesn't support users watch.
+        """
+        cancels = []
+        for shard in self.shards.values():
+            cancel = shard.watch_users(callback)
+            if cancel is None:
+                for cancel in cancels:
+                    cancel()
+                return None
+            cancels.append(cancel)
+
+        def cancel_watches():
+            for cancel in cancels:
+                cancel()
+        return cancel_watches
@@ -0,0 +1,398 @@
+"""This is Python implementation of storage keeping users and messages
+in embedded SQLite database file, it needs no external services.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from chat_codecs import (decode_channel, decode_message, decode_user,
+                         encode_channel, get_codec)
+from chat_storage import (BACKLOG_PAGE_SIZE, Channel, Message, Storage, User,
+                          attach_seq, channel_login)
+
+DATABASE_PATH = "chat.db"
+BUSY_TIMEOUT = 10.0
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    login TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_key TEXT NOT NULL UNIQUE,
+    login_to TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_login
+    ON messages (login_to, seq);
+CREATE TABLE IF NOT EXISTS channels (
+    name TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channel_members (
+    login TEXT NOT NULL,
+    name TEXT NOT NULL,
+    cursor INTEGER NOT NULL,
+    PRIMARY KEY (login, name)
+);
+CREATE TABLE IF NOT EXISTS subscribers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    login TEXT NOT NULL,
+    node_address TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subscribers_by_login
+    ON subscribers (login, id);
+"""
+
+
+class _PendingBatch:
+
+    """Messages of create_message calls saved in one transaction."""
+
+    __slots__ = ("messages", "saved", "error")
+
+    def __init__(self):
+        self.messages: List[Message] = []
+        self.saved = False
+        self.error: Optional[Exception] = None
+
+
+class SqliteStorage(Storage):
+
+    """Keeps users and messages in SQLite database file at host path,
+    port is not used. Database is in WAL mode, so reads go on while
+    messages are written. Every thread uses connection of its own.
+    Messages of user are read in order of saving by (login_to, seq)
+    index and acknowledged with one range delete by seq, which database
+    assigns in order of commits as writes take database lock.
+    Messages saved by concurrent create_message calls are written in one
+    transaction. Watches are notified by this process only, so server
+    nodes sharing the database file forward messages to subscriber's node
+    registered in the database. Messages sent to channel are kept once
+    in its log, members are kept with their cursors. With message_ttl
+    and mailbox_size set compaction deletes expired messages and the
+    oldest messages of users over mailbox size.
+    """
+
+    subscribers_across_nodes = True
+
+    def __init__(self, host=None, port=None, codec: str = "json",
+                 message_ttl: float = 0, mailbox_size: int = 0, **options):
+        """Opens database at host path, creating its tables."""
+        self.path = host or DATABASE_PATH
+        self.codec = get_codec(codec)
+        self.message_ttl = message_ttl
+        self.mailbox_size = mailbox_size
+        self._local = threading.local()
+        # Connections of all threads, closed together by close.
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        # Writes of this process are serialized, so they don't wait for
+        # each other on database lock; notifications are sent under it.
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = _PendingBatch()
+        self._watches: Dict[str, Dict[int, Callable]] = defaultdict(dict)
+        self._user_watches: Dict[int, Callable] = {}
+        self._watch_ids = 0
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns connection of current thread, opening it on the
+        first call.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Used by this thread only, but closed by the one calling close.
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        """Closes connections of all threads."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    def _write(self, statement: str, parameters=()) -> int:
+        """Executes statement in transaction, returns number of changed
+        rows. Must be called under lock.
+        """
+        connection = self._connection()
+        with connection:
+            return connection.execute(statement, parameters).rowcount
+
+    def create_user(self, user: User):
+        """Saves user by login and calls users watches."""
+        with self._lock:
+            self._write("INSERT OR REPLACE INTO users (login, value) "
+                        "VALUES (?, ?)",
+                        (user.login, self.codec.encode_user(user)))
+            for callback in self._user_watches.values():
+                callback()
+
+    def get_users_list(self) -> List[User]:
+        """Returns list of users."""
+        rows = self._connection().execute(
+            "SELECT value FROM users ORDER BY login")
+        return [decode_user(value) for value, in rows]
+
+    def get_users_page(self, after_login: str = "", limit: int = 100,
+                       login_prefix: str = "") -> List[User]:
+        """Returns page of users with one range read of logins after
+        after_login within login_prefix.
+        """
+        query = "SELECT value FROM users WHERE login > ? AND login >= ?"
+        parameters = [after_login, login_prefix]
+        if login_prefix:
+            # UTF-8 of strings compares in order of their code points.
+            query += " AND login < ?"
+            parameters.append(login_prefix[:-1]
+                              + chr(ord(login_prefix[-1]) + 1))
+        rows = self._connection().execute(
+            query + " ORDER BY login LIMIT ?", parameters + [limit])
+        return [decode_user(value) for value, in rows]
+
+    def create_message(self, message: Message):
+        """Saves message together with messages of other threads waiting
+        for the same transaction: the first of them to take the lock saves
+        the whole batch, while the next batch is gathered.
+        """
+        with self._pending_lock:
+            batch = self._pending
+            batch.messages.append(message)
+        with self._lock:
+            if not batch.saved:
+                with self._pending_lock:
+                    self._pending = _PendingBatch()
+                try:
+                    self._insert(batch.messages)
+                except Exception as error:
+                    batch.error = error
+                batch.saved = True
+        if batch.error is not None:
+            raise batch.error
+
+    def create_messages(self, messages: List[Message]):
+        """Saves batch of messages in one transaction."""
+        with self._lock:
+            self._insert(messages)
+
+    def _insert(self, messages: List[Message]):
+        """Inserts messages in one transaction and pushes them to watches
+        of their recipients with their seqs. Message saved again replaces
+        the former one. Must be called under lock.
+        """
+        connection = self._connection()
+        with connection:
+            seqs = [connection.execute(
+                "INSERT OR REPLACE INTO messages (message_key, login_to, "
+                "created_at, value) VALUES (?, ?, ?, ?)",
+                (message.get_unique_key(), message.login_to,
+                 message.created_at,
+                 self.codec.encode_message(message))).lastrowid
+                for message in messages]
+        for message, seq in zip(messages, seqs):
+            attach_seq(message, seq)
+        batches = defaultdict(list)
+        for message in messages:
+            batches[message.login_to].append(message)
+        for login, batch in batches.items():
+            for callback in self._watches.get(login, {}).values():
+                callback(batch)
+
+    def get_user_messages(self, login: str) -> List[Message]:
+        """Returns list of messages for specific user in order of saving."""
+        rows = self._connection().execute(
+            "SELECT seq, value FROM messages WHERE login_to = ? "
+            "ORDER BY seq", (login,))
+        return [attach_seq(decode_message(value), seq)
+                for seq, value in rows]
+
+    def get_user_messages_page(self, login: str, after_seq: int = 0,
+                               limit: int = BACKLOG_PAGE_SIZE
+                               ) -> List[Message]:
+        """Returns up to limit messages of user after after_seq read by
+        (login_to, seq) index range.
+        """
+        rows = self._connection().execute(
+            "SELECT seq, value FROM messages WHERE login_to = ? AND seq > ? "
+            "ORDER BY seq LIMIT ?", (login, after_seq, limit))
+        return [attach_seq(decode_message(value), seq)
+                for seq, value in rows]
+
+    def delete_user_message(self, message: Message):
+        """Deletes message by its key."""
+        with self._lock:
+            self._write("DELETE FROM messages WHERE message_key = ?",
+                        (message.get_unique_key(),))
+
+    def delete_user_messages(self, messages: List[Message]):
+        """Deletes batch of messages in one transaction."""
+        connection = self._connection()
+        with self._lock, connection:
+            connection.executemany(
+                "DELETE FROM messages WHERE message_key = ?",
+                [(message.get_unique_key(),) for message in messages])
+
+    def ack_user_messages(self, login: str, cursor: int) -> int:
+        """Deletes messages of user up to cursor with one range delete by
+        (login_to, seq) index.
+        """
+        with self._lock:
+            return self._write("DELETE FROM messages WHERE login_to = ? "
+                               "AND seq <= ?", (login, cursor))
+
+    def compact_messages(self) -> int:
+        """Deletes messages older than message TTL and the oldest
+        messages of users over mailbox size, every mailbox is trimmed by
+        one range delete. Returns number of deleted messages.
+        """
+        deleted = 0
+        with self._lock:
+            if self.message_ttl:
+                deleted += self._write(
+                    "DELETE FROM messages WHERE created_at < ?",
+                    (time.time() - self.message_ttl,))
+            if self.mailbox_size:
+                logins = self._connection().execute(
+                    "SELECT login_to FROM messages GROUP BY login_to "
+                    "HAVING count(*) > ?", (self.mailbox_size,)).fetchall()
+                for login, in logins:
+                    deleted += self._write(
+                        "DELETE FROM messages WHERE login_to = ? AND seq <= "
+                        "(SELECT seq FROM messages WHERE login_to = ? "
+                        "ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                        (login, login, self.mailbox_size))
+        return deleted
+
+    def watch_user_messages(
+            self, login: str,
+            callback: Callable[[Optional[List[Message]]], None],
+            with_pending: bool = True
+    ) -> Callable[[], None]:
+        """Passes saved messages of user to callback, unless with_pending
+        is False, and registers it for new ones under the lock messages
+        are saved under, so no message is missed. Returns function
+        cancelling the watch.
+        """
+        with self._lock:
+            if with_pending:
+                messages = self.get_user_messages(login)
+                if messages:
+                    callback(messages)
+            self._watch_ids += 1
+            watch_id = self._watch_ids
+            self._watches[login][watch_id] = callback
+
+        def cancel():
+            with self._lock:
+                self._watches[login].pop(watch_id, None)
+                if not self._watches[login]:
+                    del self._watches[login]
+
+        return cancel
+
+    def watch_users(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Calls callback every time user is saved by this process.
+        Returns function cancelling the watch.
+        """
+        with self._lock:
+            self._watch_ids += 1
+            watch_id = self._watch_ids
+            self._user_watches[watch_id] = callback
+
+        def cancel():
+            with self._lock:
+                self._user_watches.pop(watch_id, None)
+
+        return cancel
+
+    def create_channel(self, channel: Channel):
+        """Saves channel by name."""
+        with self._lock:
+            self._write("INSERT OR REPLACE INTO channels (name, value) "
+                        "VALUES (?, ?)",
+                        (channel.name, encode_channel(channel)))
+
+    def get_channel(self, name: str) -> Optional[Channel]:
+        """Returns channel by name."""
+        row = self._connection().execute(
+            "SELECT value FROM channels WHERE name = ?", (name,)).fetchone()
+        return decode_channel(row[0]) if row else None
+
+    def last_message_seq(self, login: str) -> int:
+        """Returns the last seq given to messages, which mailboxes share."""
+        row = self._connection().execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'messages'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    def join_channel(self, name: str, login: str,
+                     cursor: Optional[int] = None):
+        """Adds member with cursor, by default at the last seq given to
+        messages, unless the user is member already.
+        """
+        with self._lock:
+            if cursor is None:
+                cursor = self.last_message_seq(channel_login(name))
+            self._write("INSERT OR IGNORE INTO channel_members "
+                        "(login, name, cursor) VALUES (?, ?, ?)",
+                        (login, name, cursor))
+
+    def leave_channel(self, name: str, login: str):
+        """Removes member with its cursor."""
+        with self._lock:
+            self._write("DELETE FROM channel_members WHERE login = ? "
+                        "AND name = ?", (login, name))
+
+    def get_user_channels(self, login: str) -> Dict[str, int]:
+        """Returns channels of user with cursors."""
+        return dict(self._connection().execute(
+            "SELECT name, cursor FROM channel_members WHERE login = ?",
+            (login,)))
+
+    def set_channel_cursor(self, name: str, login: str, cursor: int):
+        """Moves cursor of member forward."""
+        with self._lock:
+            self._write("UPDATE channel_members SET cursor = ? WHERE "
+                        "login = ? AND name = ? AND cursor < ?",
+                        (cursor, login, name, cursor))
+
+    def register_subscriber(self, login: str,
+                            node_address: str) -> Callable[[], None]:
+        """Records node of subscription, the latest one is returned
+        while several are registered. Returns function removing it.
+        Records of node stopped without removing them are kept until the
+        user subscribes again.
+        """
+        connection = self._connection()
+        with self._lock, connection:
+            subscriber_id = connection.execute(
+                "INSERT INTO subscribers (login, node_address) VALUES (?, ?)",
+                (login, node_address)).lastrowid
+
+        def cancel():
+            with self._lock:
+                self._write("DELETE FROM subscribers WHERE id = ?",
+                            (subscriber_id,))
+
+        return cancel
+
+    def get_subscriber_node(self, login: str) -> Optional[str]:
+        """Returns node of the latest subscription of user."""
+        row = self._connection().execute(
+            "SELECT node_address FROM subscribers WHERE login = ? "
+            "ORDER BY id DESC LIMIT 1", (login,)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,83 @@
+"""This is Python implementation of user directory cache which can be
+layered over any storage.
+"""
+
+import bisect
+import threading
+import time
+from typing import List
+
+from chat_storage import Storage, StorageWrapper, User
+
+USER_CACHE_TTL = 30.0
+
+
+class UserCacheStorage(StorageWrapper):
+
+    """Serves users list from memory. Cache is dropped on every change
+    reported by storage users watch and is read again when it is older
+    than ttl seconds in any case, so storages which can not watch users
+    and changes missed while the watch was broken are seen after ttl at
+    most. The same list object is returned until users change or cache
+    expires, so callers may reuse anything built from it.
+    """
+
+    def __init__(self, storage: Storage, ttl: float = USER_CACHE_TTL):
+        super().__init__(storage)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._users = None
+        self._expires_at = 0.0
+        self._version = 0
+        self._sorted = (None, [], [])
+        self._cancel_watch = storage.watch_users(self._invalidate)
+
+    def _invalidate(self):
+        """Drops cached users."""
+        with self._lock:
+            self._users = None
+            self._version += 1
+
+    def _is_fresh(self) -> bool:
+        """Checks if cached users may be returned."""
+        return self._users is not None and time.monotonic() < self._expires_at
+
+    def create_user(self, user: User):
+        """Saves user in wrapped storage and drops cached users."""
+        self.storage.create_user(user)
+        self._invalidate()
+
+    def get_users_list(self) -> List[User]:
+        """Returns cached users, reading them from wrapped storage only
+        if cache is empty or expired.
+        """
+        with self._lock:
+            if self._is_fresh():
+                return self._users
+            version = self._version
+        users = self.storage.get_users_list()
+        with self._lock:
+            if version == self._version:
+                self._users = users
+                self._expires_at = time.monotonic() + self.ttl
+        return users
+
+    def get_users_page(self, after_login: str = "", limit: int = 100,
+                       login_prefix: str = "") -> List[User]:
+        """Returns page of cached users found by binary search over
+        users sorted by login, sorting is done once per users list.
+        """
+        users = self.get_users_list()
+        sorted_from, sorted_users, logins = self._sorted
+        if users is not sorted_from:
+            sorted_users = sorted(users, key=lambda user: user.login)
+            logins = [user.login for user in sorted_users]
+            self._sorted = (users, sorted_users, logins)
+        start = max(bisect.bisect_right(logins, after_login),
+                    bisect.bisect_left(logins, login_prefix))
+        page = []
+        for user in sorted_users[start:start + limit]:
+            if not user.login.startswith(login_prefix):
+                break
+            page.append(user)
+        return page
@@ -0,0 +1,246 @@
+"""Python module for testing chat_admission module."""
+
+import socket
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+
+import grpc
+
+import chat_admission
+import chat_ext_grpc
+import chat_pb2
+from chat_admission import (AdmissionController, AdmissionError,
+                            AdmissionInterceptor, AsyncAdmissionInterceptor,
+                            LatencyTrackingStorage, StorageLatency,
+                            parse_method_limits)
+from chat_aio_server import create_aio_server
+from chat_aio_storage import AsyncStorageAdapter
+from chat_server import create_server
+from chat_storage import Message
+from storages.memory_storage import MemoryStorage
+
+
+def send_request(login_from: str, body: str = "Hi"):
+    """Returns SendMessage request from login to userB."""
+    return chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+        login_from=login_from, login_to="userB", body=body))
+
+
+class TestParseMethodLimits(TestCase):
+    """Tests parse_method_limits function."""
+
+    def test_parse_method_limits(self):
+        """Tests limits are read by method, malformed ones are refused."""
+        self.assertEqual({}, parse_method_limits(""))
+        self.assertEqual({"SendMessage": 64, "Subscribe": 1000},
+                         parse_method_limits("SendMessage=64, Subscribe=1000"))
+        for value in ("SendMessage", "SendMessage=0", "SendMessage=x"):
+            with self.assertRaises(ValueError):
+                parse_method_limits(value)
+
+
+class TestAdmissionController(TestCase):
+    """Tests AdmissionController class."""
+
+    @mock.patch("chat_rate_limit.time.monotonic", return_value=100.0)
+    def test_admit_message(self, mock_monotonic):
+        """Tests senders are limited each on their own and together by
+        server limit, sender keeps its token if server rejects message.
+        """
+        controller = AdmissionController(sender_rate=2, global_rate=3)
+        controller.admit_message("userA")
+        controller.admit_message("userA")
+        with self.assertRaises(AdmissionError) as error:
+            controller.admit_message("userA")
+        self.assertEqual(("sender_rate", 0.5),
+                         (error.exception.reason, error.exception.retry_after))
+        controller.admit_message("userB")
+        with self.assertRaises(AdmissionError) as error:
+            controller.admit_message("userC")
+        self.assertEqual("global_rate", error.exception.reason)
+        self.assertEqual(0.0, controller._sender_bucket("userC").take(2))
+
+    def test_senders_dropped(self):
+        """Tests buckets of the least recently seen senders are dropped."""
+        controller = AdmissionController(sender_rate=1)
+        with mock.patch("chat_admission.MAX_SENDERS", 2):
+            for login in ("userA", "userB", "userA", "userC"):
+                controller._sender_bucket(login)
+        self.assertListEqual(["userA", "userC"], list(controller._senders))
+
+    def test_method_concurrency(self):
+        """Tests calls of limited method in progress are counted."""
+        controller = AdmissionController(method_limits={"Subscribe": 1})
+        controller.enter("Subscribe")
+        controller.enter("GetUsers")
+        with self.assertRaises(AdmissionError):
+            controller.enter("Subscribe")
+        controller.leave("Subscribe")
+        controller.leave("GetUsers")
+        controller.enter("Subscribe")
+
+    def test_shed_sending(self):
+        """Tests sending is shed while fresh storage latency is over
+        threshold.
+        """
+        latency = mock.Mock()
+        latency.exceeds.return_value = True
+        controller = AdmissionController(shed_latency=0.1, latency=latency)
+        controller.enter("Subscribe")
+        with self.assertRaises(AdmissionError) as error:
+            controller.enter("SendMessage")
+        self.assertEqual("overload", error.exception.reason)
+        latency.exceeds.assert_called_once_with(
+            0.1, chat_admission.SHED_RETRY_AFTER)
+        self.assertTrue(controller.enabled)
+        self.assertFalse(AdmissionController().enabled)
+
+
+class TestStorageLatency(TestCase):
+    """Tests StorageLatency and LatencyTrackingStorage classes."""
+
+    @mock.patch("chat_admission.time.monotonic", return_value=100.0)
+    def test_exceeds(self, mock_monotonic):
+        """Tests moving average is compared only while it is fresh."""
+        latency = StorageLatency(weight=0.5)
+        self.assertFalse(latency.exceeds(0.1, 1.0))
+        latency.observe(0.4)
+        latency.observe(0.0)
+        self.assertEqual(0.2, latency.average)
+        self.assertTrue(latency.exceeds(0.1, 1.0))
+        mock_monotonic.return_value = 101.0
+        self.assertFalse(latency.exceeds(0.1, 1.0))
+
+    def test_writes_measured(self):
+        """Tests every message write of wrapped storage is measured."""
+        latency = mock.Mock()
+        storage = LatencyTrackingStorage(MemoryStorage(), latency)
+        messages = [Message("userA", "userB", str(x)) for x in range(2)]
+        storage.create_message(messages[0])
+        storage.create_messages(messages[1:])
+        self.assertEqual(2, latency.observe.call_count)
+        self.assertListEqual(messages, storage.get_user_messages("userB"))
+
+
+class TestAdmissionInterceptor(TestCase):
+    """Tests AdmissionInterceptor on server over memory storage."""
+
+    def setUp(self):
+        """Starts server admitting one message per sender and one
+        subscriber.
+        """
+        self.storage = MemoryStorage()
+        controller = AdmissionController(sender_rate=1,
+                                         method_limits={"Subscribe": 1})
+        self.server = create_server(self.storage, "localhost", 0,
+                                    [AdmissionInterceptor(controller)])
+        port = self.server.add_insecure_port("localhost:0")
+        self.server.start()
+        self.addCleanup(self.server.stop, None)
+        self.channel = grpc.insecure_channel(f"localhost:{port}")
+        self.addCleanup(self.channel.close)
+        self.stub = chat_ext_grpc.ChatExtStub(self.channel)
+
+    def test_sender_rate(self):
+        """Tests message over sender limit is rejected with retry-after,
+        other senders are admitted.
+        """
+        self.stub.SendMessage(send_request("userA"))
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.SendMessage(send_request("userA"))
+        self.assertEqual(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                         error.exception.code())
+        self.assertGreater(chat_ext_grpc.read_retry_after_metadata(
+            error.exception.trailing_metadata()), 0)
+        self.stub.SendMessage(send_request("userC"))
+        self.assertEqual(2, len(self.storage.get_user_messages("userB")))
+
+    def test_forwarded_not_admitted(self):
+        """Tests messages forwarded by another node are not taken from
+        limits again.
+        """
+        self.stub.SendMessage(send_request("userA"))
+        self.stub.SendMessages(
+            iter([send_request("userA", "1"), send_request("userA", "2")]),
+            metadata=((chat_ext_grpc.FORWARDED_BY_KEY, "localhost:1"),))
+        self.assertEqual(3, len(self.storage.get_user_messages("userB")))
+
+    def test_message_stream(self):
+        """Tests stream of messages is rejected on message over limit,
+        messages admitted before it are saved and counted in trailing
+        metadata.
+        """
+        with self.assertRaises(grpc.RpcError) as error:
+            self.stub.SendMessages(iter([send_request("userA", "1"),
+                                         send_request("userA", "2"),
+                                         send_request("userA", "3")]))
+        self.assertEqual(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                         error.exception.code())
+        self.assertEqual(1, chat_ext_grpc.read_saved_messages_metadata(
+            error.exception.trailing_metadata()))
+        messages = self.storage.get_user_messages("userB")
+        self.assertListEqual(["1"], [message.body for message in messages])
+
+    def test_method_concurrency(self):
+        """Tests the second subscriber is rejected while the first one is
+        subscribed.
+        """
+        self.stub.SendMessage(send_request("userA"))
+        stream = self.stub.Subscribe(chat_pb2.SubscribeRequest(login="userB"))
+        self.assertEqual("Hi", next(stream).body)
+        with self.assertRaises(grpc.RpcError) as error:
+            next(self.stub.Subscribe(chat_pb2.SubscribeRequest(login="userC")))
+        self.assertEqual(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                         error.exception.code())
+        stream.cancel()
+
+
+class TestAsyncAdmissionInterceptor(IsolatedAsyncioTestCase):
+    """Tests AsyncAdmissionInterceptor on asyncio server."""
+
+    async def test_sender_rate(self):
+        """Tests message over sender limit is rejected with retry-after."""
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            port = sock.getsockname()[1]
+        storage = MemoryStorage()
+        server = create_aio_server(
+            AsyncStorageAdapter(storage), "localhost", port,
+            [AsyncAdmissionInterceptor(AdmissionController(sender_rate=1))])
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(
+                    f"localhost:{port}") as channel:
+                stub = chat_ext_grpc.ChatExtStub(channel)
+                await stub.SendMessage(send_request("userA"))
+                with self.assertRaises(grpc.RpcError) as error:
+                    await stub.SendMessage(send_request("userA"))
+        finally:
+            await server.stop(None)
+        self.assertEqual(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                         error.exception.code())
+        self.assertGreater(chat_ext_grpc.read_retry_after_metadata(
+            error.exception.trailing_metadata()), 0)
+        self.assertEqual(1, len(storage.get_user_messages("userB")))
+
+    async def test_message_stream(self):
+        """Tests admitted messages of rejected stream are saved."""
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            port = sock.getsockname()[1]
+        storage = MemoryStorage()
+        server = create_aio_server(
+            AsyncStorageAdapter(storage), "localhost", port,
+            [AsyncAdmissionInterceptor(AdmissionController(sender_rate=1))])
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(
+                    f"localhost:{port}") as channel:
+                stub = chat_ext_grpc.ChatExtStub(channel)
+                with self.assertRaises(grpc.RpcError) as error:
+                    await stub.SendMessages(iter([send_request("userA", "1"),
+                                                  send_request("userA", "2")]))
+        finally:
+            await server.stop(None)
+        self.assertEqual(1, chat_ext_grpc.read_saved_messages_metadata(
+            error.exception.trailing_metadata()))
+        self.assertEqual(1, len(storage.get_user_messages("userB")))
@@ -0,0 +1,178 @@
+"""Python module for testing chat_aio_server module."""
+
+from unittest import IsolatedAsyncioTestCase, mock
+
+import grpc
+
+import chat_pb2
+import chat_aio_server
+from chat_storage import Channel, Message, User, attach_seq
+
+
+def read_backlog(storage: mock.AsyncMock, messages):
+    """Makes storage mock return messages by the first page read and
+    break the watch, so the stream ends.
+    """
+    async def get_user_messages_page(login, after_seq, limit):
+        storage.watch_user_messages.call_args[0][1](None)
+        return messages
+
+    storage.get_user_messages_page.side_effect = get_user_messages_page
+
+
+class TestAsyncChat(IsolatedAsyncioTestCase):
+
+    """Tests AsyncChat class."""
+
+    def setUp(self):
+        """Creates storage and chat object to be used by the tests."""
+        self.storage = mock.AsyncMock()
+        self.storage.get_user_channels.return_value = {}
+        self.storage.watch_user_messages.return_value = mock.Mock()
+        self.chat = chat_aio_server.AsyncChat(self.storage,
+                                              subscribe_batch_size=1)
+
+    async def test_GetUsers(self):
+        """Tests 'GetUsers' method."""
+        self.storage.get_users_list.return_value = [
+            User(login="userA", full_name="AA AAA")]
+        expected = chat_pb2.GetUsersReply(
+            users=[chat_pb2.User(login="userA", full_name="AA AAA")])
+        context = mock.Mock(invocation_metadata=mock.Mock(return_value=()))
+        result = await self.chat.GetUsers(mock.Mock(), context)
+        self.assertEqual(expected, result)
+
+    async def test_GetUsers_page(self):
+        """Tests 'GetUsers' method with page requested in metadata."""
+        self.storage.get_users_page.return_value = [
+            User(login="userA", full_name="AA AAA")]
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (("page-size", "1"),)
+        result = await self.chat.GetUsers(mock.Mock(), context)
+        self.storage.get_users_page.assert_awaited_once_with("", 1, "")
+        context.set_trailing_metadata.assert_called_once_with(
+            (("next-page-token", "userA"),))
+        self.assertEqual(1, len(result.users))
+
+    @mock.patch("chat_storage.time.time")
+    async def test_SendMessage(self, mock_time):
+        """Tests 'SendMessage' method."""
+        mock_time.return_value = 1111
+        message = chat_pb2.Message(login_from="userA", login_to="userB",
+                                   body="Hello, you.")
+        result = await self.chat.SendMessage(
+            chat_pb2.SendMessageRequest(message=message), mock.Mock())
+        message = self.storage.create_message.call_args[0][0]
+        self.assertEqual(Message("userA", "userB", "Hello, you.",
+                                 message_id=message.message_id), message)
+        self.assertEqual("Done! userB received message from userA!",
+                         result.status)
+
+    async def test_SendMessages(self):
+        """Tests 'SendMessages' method."""
+        async def requests():
+            for body in ["Hello.", "Hi!"]:
+                yield chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+                    login_from="userA", login_to="userB", body=body))
+
+        result = await self.chat.SendMessages(requests(), mock.Mock())
+        batch = self.storage.create_messages.call_args[0][0]
+        self.assertListEqual(["Hello.", "Hi!"],
+                             [message.body for message in batch])
+        self.assertEqual("Done! 2 messages received.", result.status)
+
+    async def test_Subscribe(self):
+        """Tests 'Subscribe' method."""
+        messages = [Message(login_from="A", login_to="B", body="Hello!",
+                            created_at=1234),
+                    Message(login_from="C", login_to="B", body="Hi!",
+                            created_at=12345)]
+        cancel = self.storage.watch_user_messages.return_value
+        read_backlog(self.storage, messages)
+        context = mock.Mock(abort=mock.AsyncMock())
+        result = [message async for message in
+                  self.chat.Subscribe(mock.Mock(login="B"), context)]
+        expected = [chat_pb2.Message(login_from="A", login_to="B",
+                                     created_at=1234, body="Hello!"),
+                    chat_pb2.Message(login_from="C", login_to="B",
+                                     created_at=12345, body="Hi!")]
+        self.assertListEqual(expected, result)
+        self.storage.watch_user_messages.assert_awaited_once_with(
+            "B", mock.ANY, with_pending=False)
+        self.storage.delete_user_messages.assert_has_awaits(
+            [mock.call(messages[:1]), mock.call(messages[1:])])
+        cancel.assert_called_once_with()
+        context.abort.assert_awaited_once_with(grpc.StatusCode.UNAVAILABLE,
+                                               mock.ANY)
+
+    async def test_SubscribeFrom(self):
+        """Tests 'SubscribeFrom' method resumes after cursor."""
+        message = attach_seq(Message(login_from="A", login_to="B", body="Hi!",
+                                     created_at=1), 2)
+        read_backlog(self.storage, [message])
+        context = mock.Mock(abort=mock.AsyncMock())
+        context.invocation_metadata.return_value = (("cursor", "1"),)
+        result = [reply async for reply in
+                  self.chat.SubscribeFrom(mock.Mock(login="B"), context)]
+        self.storage.ack_user_messages.assert_awaited_once_with("B", 1)
+        self.assertEqual("2", result[0][1])
+        self.storage.delete_user_messages.assert_not_awaited()
+
+    async def test_abort_stalled(self):
+        """Tests call of subscriber which stopped reading is aborted with
+        RESOURCE_EXHAUSTED, error raised by abort is not passed on.
+        """
+        context = mock.Mock(abort=mock.AsyncMock(side_effect=Exception()))
+        await chat_aio_server.abort_stalled(context)
+        context.abort.assert_awaited_once_with(
+            grpc.StatusCode.RESOURCE_EXHAUSTED, mock.ANY)
+
+    async def test_AckMessages(self):
+        """Tests 'AckMessages' method deletes messages up to cursor."""
+        self.storage.ack_user_messages.return_value = 1
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (("cursor", "5"),)
+        reply = await self.chat.AckMessages(
+            chat_pb2.SubscribeRequest(login="B"), context)
+        self.storage.ack_user_messages.assert_awaited_once_with("B", 5)
+        self.assertEqual("Done! 1 messages acknowledged.", reply.status)
+
+    async def test_AckMessages_moves_channel_cursors(self):
+        """Tests 'AckMessages' method moves cursors of channels of the
+        cursor.
+        """
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (
+            ("cursor", "5;general=3"),)
+        await self.chat.AckMessages(chat_pb2.SubscribeRequest(login="B"),
+                                    context)
+        self.storage.ack_user_messages.assert_awaited_once_with("B", 5)
+        self.storage.set_channel_cursor.assert_awaited_once_with(
+            "general", "B", 3)
+
+    async def test_SendMessage_to_channel(self):
+        """Tests message to channel is sent by its members only."""
+        context = mock.Mock()
+        context.abort = mock.AsyncMock(side_effect=grpc.RpcError())
+        request = chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+            login_from="userA", login_to="#general", body="Hi all!"))
+        with self.assertRaises(grpc.RpcError):
+            await self.chat.SendMessage(request, context)
+        context.abort.assert_awaited_once_with(
+            grpc.StatusCode.PERMISSION_DENIED,
+            "userA is not a member of #general")
+        self.storage.get_user_channels.return_value = {"general": "1"}
+        await self.chat.SendMessage(request, context)
+        self.storage.create_message.assert_awaited_once()
+
+    async def test_JoinChannel(self):
+        """Tests 'JoinChannel' creates missing channel and adds member."""
+        self.storage.get_channel.return_value = None
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (("channel", "general"),)
+        reply = await self.chat.JoinChannel(
+            chat_pb2.SubscribeRequest(login="B"), context)
+        self.storage.create_channel.assert_awaited_once_with(
+            Channel("general"))
+        self.storage.join_channel.assert_awaited_once_with("general", "B")
+        self.assertEqual("Done! B joined #general.", reply.status)
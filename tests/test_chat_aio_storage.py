@@ -0,0 +1,137 @@
+"""Python module for testing chat_aio_storage module."""
+
+import asyncio
+import threading
+from unittest import IsolatedAsyncioTestCase, mock
+
+from chat_aio_storage import AsyncMessageWatch, AsyncStorageAdapter
+from chat_storage import (Message, SlowConsumerError, WatchBrokenError,
+                          attach_seq, message_seq)
+
+
+class TestAsyncStorageAdapter(IsolatedAsyncioTestCase):
+    """Tests AsyncStorageAdapter class."""
+
+    def setUp(self):
+        """Creates synchronous storage mock and adapter."""
+        self.storage = mock.Mock()
+        self.adapter = AsyncStorageAdapter(self.storage)
+        self.message = Message(login_from="userA", login_to="userB",
+                               body="Hello!", created_at=1234)
+
+    async def test_get_users_list(self):
+        """Tests 'get_users_list' method returns storage result."""
+        self.storage.get_users_list.return_value = ["user1"]
+        self.assertListEqual(["user1"], await self.adapter.get_users_list())
+
+    async def test_create_message(self):
+        """Tests 'create_message' method runs outside of event loop thread."""
+        threads = []
+        self.storage.create_message.side_effect = \
+            lambda message: threads.append(threading.current_thread())
+        await self.adapter.create_message(self.message)
+        self.storage.create_message.assert_called_once_with(self.message)
+        self.assertIsNot(threading.current_thread(), threads[0])
+
+    async def test_delete_user_messages(self):
+        """Tests 'delete_user_messages' method."""
+        await self.adapter.delete_user_messages([self.message])
+        self.storage.delete_user_messages.assert_called_once_with(
+            [self.message])
+
+
+class TestAsyncMessageWatch(IsolatedAsyncioTestCase):
+    """Tests AsyncMessageWatch class."""
+
+    def setUp(self):
+        """Creates adapter of storage mock reading pages of stored
+        messages.
+        """
+        self.stored = []
+        self.storage = AsyncStorageAdapter(mock.Mock())
+        self.storage.storage.get_user_messages_page.side_effect = (
+            lambda login, after_seq, limit: [
+                message for message in self.stored
+                if message_seq(message) > after_seq][:limit])
+        self.cancel = self.storage.storage.watch_user_messages.return_value
+        self.messages = [attach_seq(Message("userA", "userB", "hi"), x + 1)
+                         for x in range(3)]
+
+    async def test_iterates_batches_from_other_thread(self):
+        """Tests batches pushed from storage thread are merged and
+        iterated until watch is broken.
+        """
+        self.stored.extend(self.messages[:1])
+        async with AsyncMessageWatch(self.storage, "userB") as watch:
+            callback = self.storage.storage.watch_user_messages.call_args[0][1]
+            batches = watch.__aiter__()
+            self.assertListEqual(self.messages[:1], await batches.__anext__())
+            pusher = threading.Thread(target=lambda: [
+                callback(self.messages[1:2]), callback(self.messages[2:]),
+                callback(None)])
+            pusher.start()
+            pusher.join()
+            self.assertListEqual(self.messages[1:], await batches.__anext__())
+            with self.assertRaises(WatchBrokenError):
+                await batches.__anext__()
+        self.cancel.assert_called_once_with()
+
+    async def test_cancels_watch_in_executor(self):
+        """Tests storage watch is cancelled off event loop thread, as
+        cancel may call storage.
+        """
+        self.cancel.side_effect = lambda: threads.append(
+            threading.current_thread())
+        threads = []
+        async with AsyncMessageWatch(self.storage, "userB"):
+            pass
+        self.assertEqual(1, len(threads))
+        self.assertIsNot(threading.current_thread(), threads[0])
+
+    async def test_reads_pages_after_behind(self):
+        """Tests messages not fitting in buffer while subscriber was
+        behind are read by page after messages taken already.
+        """
+        self.stored.extend(self.messages[:1])
+        big = [attach_seq(Message("userA", "userB", "x" * 400), x)
+               for x in (2, 3)]
+        watch = AsyncMessageWatch(self.storage, "userB",
+                                  max_buffered_bytes=600)
+        async with watch:
+            callback = self.storage.storage.watch_user_messages.call_args[0][1]
+            batches = watch.__aiter__()
+            self.assertListEqual(self.messages[:1], await batches.__anext__())
+            self.stored.extend(big)
+            callback(big)
+            await asyncio.sleep(0)
+            self.assertListEqual(big[:1], await batches.__anext__())
+            self.assertListEqual(big[1:], await batches.__anext__())
+            callback(None)
+            with self.assertRaises(WatchBrokenError):
+                await batches.__anext__()
+        self.assertListEqual(
+            [mock.call("userB", 0, 2), mock.call("userB", 2, 2)],
+            self.storage.storage.get_user_messages_page.call_args_list)
+
+    async def test_disconnect_timer(self):
+        """Tests subscriber which stays behind without taking batches is
+        disconnected by timer with "disconnect" policy.
+        """
+        self.stored.extend(self.messages[:1])
+        on_disconnect = mock.Mock()
+        watch = AsyncMessageWatch(self.storage, "userB",
+                                  max_buffered_bytes=600,
+                                  slow_consumer_policy="disconnect",
+                                  slow_consumer_timeout=0.01,
+                                  on_disconnect=on_disconnect)
+        async with watch:
+            callback = self.storage.storage.watch_user_messages.call_args[0][1]
+            batches = watch.__aiter__()
+            self.assertListEqual(self.messages[:1], await batches.__anext__())
+            callback([attach_seq(Message("userA", "userB", "x" * 400), x)
+                      for x in (2, 3)])
+            await asyncio.sleep(0.1)
+            on_disconnect.assert_called_once_with()
+            self.cancel.assert_called_once_with()
+            with self.assertRaises(SlowConsumerError):
+                await batches.__anext__()
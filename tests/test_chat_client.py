@@ -48,6 +48,14 @@ class TestChatClient(TestCase):
         chat_client.choose_action(args, stub)
         mock_send_message.assert_called_once_with(args, stub)
 
+    @mock.patch("chat_client.send_messages")
+    def test_valid_choose_action_messages(self, mock_send_messages):
+        """Tests 'choose_action' method with valid data."""
+        stub = mock.Mock()
+        args = mock.Mock(action="messages")
+        chat_client.choose_action(args, stub)
+        mock_send_messages.assert_called_once_with(args, stub)
+
     @mock.patch("chat_client.subscribe")
     def test_valid_choose_action_subscribe(self, mock_subscribe):
         """Tests 'choose_action' method with valid data."""
@@ -58,29 +66,55 @@ class TestChatClient(TestCase):
 
     def test_get_users_list(self):
         """Tests 'get_users_list' method."""
-        stub = mock.Mock(GetUsers=mock.Mock())
-        chat_client.get_users_list(stub)
-        stub.GetUsers.assert_called_once_with(chat_pb2.GetUsersRequest())
+        client = mock.Mock()
+        chat_client.get_users_list(client)
+        client.get_users.assert_called_once_with()
 
     def test_send_message(self):
         """Tests 'send_message' method."""
         args = mock.Mock(message=["userA", "userB", "Hello."])
-        stub = mock.Mock(SendMessage=mock.Mock())
-        chat_client.send_message(args, stub)
-        message = chat_pb2.Message(login_from="userA",
-                                   login_to="userB",
-                                   body="Hello.")
-        stub.SendMessage.assert_called_once_with(
-            chat_pb2.SendMessageRequest(message=message))
+        client = mock.Mock()
+        chat_client.send_message(args, client)
+        client.send_message.assert_called_once_with("userA", "userB", "Hello.")
 
     def test_subscribe(self):
         """Tests 'subscribe' method."""
         args = mock.Mock(subscribe="userA")
-        stub = mock.Mock(
-            Subscribe=mock.Mock(
-                return_value=["message1", "message2", "message3"]
-            )
-        )
-        chat_client.subscribe(args, stub)
-        stub.Subscribe.assert_called_once_with(
-            chat_pb2.SubscribeRequest(login=args.subscribe))
+        client = mock.Mock()
+        client.subscribe.return_value = ["message1", "message2", "message3"]
+        chat_client.subscribe(args, client)
+        client.subscribe.assert_called_once_with("userA")
+
+    def test_parse_message_line(self):
+        """Tests 'parse_message_line' method keeps spaces of body."""
+        message = chat_client.parse_message_line("userA userB Hello, you!\n")
+        expected = chat_pb2.Message(login_from="userA", login_to="userB",
+                                    body="Hello, you!")
+        self.assertEqual(expected, message)
+
+    def test_parse_message_line_raiserror(self):
+        """Tests 'parse_message_line' method and check raiserror."""
+        with self.assertRaises(chat_client.IncorrectDataError):
+            chat_client.parse_message_line("userA userB\n")
+
+    @mock.patch("chat_client.sys.stdin", ["userA userB Hello.\n", "\n",
+                                          "userB userA Hi!\n"])
+    def test_send_messages(self):
+        """Tests 'send_messages' method streams stdin lines."""
+        sent = []
+        client = mock.Mock()
+        client.send_messages.side_effect = \
+            lambda messages: sent.extend(messages) or "ok"
+        chat_client.send_messages(mock.Mock(file=chat_client.sys.stdin),
+                                  client)
+        expected = [chat_pb2.Message(login_from="userA", login_to="userB",
+                                     body="Hello."),
+                    chat_pb2.Message(login_from="userB", login_to="userA",
+                                     body="Hi!")]
+        self.assertListEqual(expected, sent)
+
+    def test_messages_file_error(self):
+        """Tests file that can't be opened is reported by parser."""
+        parser = chat_client.create_parser()
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit):
+            parser.parse_args(["messages", "-f", "/nonexistent/messages"])
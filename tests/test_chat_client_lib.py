@@ -0,0 +1,213 @@
+"""Python module for testing chat_client_lib module."""
+
+import socket
+from concurrent import futures
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+
+import grpc
+
+import chat_ext_grpc
+import chat_pb2
+import chat_pb2_grpc
+from chat_aio_server import create_aio_server
+from chat_aio_storage import AsyncStorageAdapter
+from chat_client_lib import AsyncChatClient, ChatClient
+from chat_server import Chat
+from chat_storage import User, message_seq
+from storages.memory_storage import MemoryStorage
+
+
+class UnavailableError(grpc.RpcError):
+
+    """Error of call broken by lost connection."""
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+def free_port() -> int:
+    """Returns port free on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def pb_message(body, created_at=1):
+    """Returns message to userB with body."""
+    return chat_pb2.Message(login_from="userA", login_to="userB", body=body,
+                            created_at=created_at)
+
+
+class TestChatClient(TestCase):
+    """Tests ChatClient against server on local port."""
+
+    def setUp(self):
+        """Starts server over memory storage and connects client."""
+        self.storage = MemoryStorage()
+        self.storage.create_user(User("userA", "Ann"))
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        port = self.server.add_insecure_port("localhost:0")
+        chat = Chat(self.storage)
+        chat_pb2_grpc.add_ChatServicer_to_server(chat, self.server)
+        chat_ext_grpc.add_ChatExtServicer_to_server(chat, self.server)
+        self.server.start()
+        self.client = ChatClient("localhost", port)
+
+    def tearDown(self):
+        """Closes client and stops server."""
+        self.client.close()
+        self.server.stop(None)
+
+    def test_get_users(self):
+        """Tests users are returned."""
+        self.assertEqual(["userA"], [user.login
+                                     for user in self.client.get_users()])
+        self.assertEqual(["userA"], [user.login
+                                     for user in self.client.iter_users("u")])
+
+    def test_send_messages(self):
+        """Tests messages sent one by one, concurrently and in stream
+        are saved.
+        """
+        self.client.send_message("userA", "userB", "1")
+        sent = [self.client.send_message_future("userA", "userB", "2")
+                for x in range(3)]
+        for future in sent:
+            future.result()
+        self.client.send_messages(pb_message("3") for x in range(2))
+        self.assertEqual(["1", "2", "2", "2", "3", "3"], sorted(
+            message.body
+            for message in self.storage.get_user_messages("userB")))
+
+    def test_subscribe(self):
+        """Tests subscriber receives sent messages, which are deleted
+        once acknowledged.
+        """
+        self.client.send_messages([pb_message("1"), pb_message("2"),
+                                   pb_message("3")])
+        messages = self.client.subscribe("userB", ack_batch_size=2)
+        self.assertEqual(["1", "2", "3"],
+                         [next(messages).body for x in range(3)])
+        messages.close()
+        self.assertEqual(["3"], [
+            message.body
+            for message in self.storage.get_user_messages("userB")])
+        messages = self.client.subscribe("userB")
+        self.assertEqual("3", next(messages).body)
+        messages.close()
+
+    def test_channel(self):
+        """Tests message sent to channel once is received by every member
+        and acknowledgement moves cursor of member.
+        """
+        for login in ("userA", "userB", "userC"):
+            self.client.join_channel(login, "general")
+        self.client.send_message("userA", "#general", "Hi all!")
+        for login in ("userB", "userC"):
+            messages = self.client.subscribe(login, ack_batch_size=1)
+            self.assertEqual("Hi all!", next(messages).body)
+            with self.assertRaises(StopIteration):
+                messages.close()
+                next(messages)
+        self.assertEqual(1, len(self.storage.get_user_messages("#general")))
+        seq = message_seq(self.storage.get_user_messages("#general")[0])
+        self.client.ack_messages("userB", chat_ext_grpc.format_cursor(
+            None, {"general": seq}))
+        self.assertEqual({"general": seq},
+                         self.storage.get_user_channels("userB"))
+        self.assertEqual("Done! userC left #general.",
+                         self.client.leave_channel("userC", "general"))
+
+
+class FakeCall:
+
+    """Stream of messages with ids which breaks as connection is lost."""
+
+    def __init__(self, bodies, broken=True):
+        self.bodies = bodies
+        self.broken = broken
+
+    def __iter__(self):
+        for body in self.bodies:
+            yield pb_message(body), "id" + body
+        if self.broken:
+            raise UnavailableError()
+
+    def cancel(self):
+        pass
+
+
+class TestChatClientReconnect(TestCase):
+    """Tests ChatClient subscribes again on lost connection."""
+
+    def setUp(self):
+        """Creates client with fake stub."""
+        self.client = ChatClient()
+        self.client.stub = mock.Mock()
+
+    def tearDown(self):
+        """Closes client."""
+        self.client.close()
+
+    @mock.patch("chat_client_lib.time.sleep")
+    def test_subscribe_resumes(self, mock_sleep):
+        """Tests subscription is resumed after the last received message
+        when connection is lost or stream ends, and received messages are
+        acknowledged in batches.
+        """
+        self.client.stub.SubscribeFrom.side_effect = [
+            FakeCall(["1", "2", "3"]), FakeCall(["4"], broken=False),
+            FakeCall(["5"], broken=False)]
+        messages = self.client.subscribe("userB", ack_batch_size=2)
+        bodies = [next(messages).body for x in range(5)]
+        messages.close()
+        self.assertEqual(["1", "2", "3", "4", "5"], bodies)
+        self.assertEqual(
+            [(("cursor", ""),), (("cursor", "id3"),), (("cursor", "id4"),)],
+            [call[1]["metadata"]
+             for call in self.client.stub.SubscribeFrom.call_args_list])
+        self.client.stub.AckMessages.assert_called_once_with(
+            chat_pb2.SubscribeRequest(login="userB"),
+            metadata=(("cursor", "id2"),))
+        self.assertEqual(2, mock_sleep.call_count)
+
+    def test_subscribe_without_reconnect(self):
+        """Tests error is raised and iteration ends with the stream if
+        reconnect is off.
+        """
+        self.client.stub.SubscribeFrom.return_value = FakeCall([])
+        with self.assertRaises(grpc.RpcError):
+            list(self.client.subscribe("userB", reconnect=False))
+        self.client.stub.SubscribeFrom.return_value = FakeCall(
+            ["1"], broken=False)
+        self.assertEqual(1, len(list(self.client.subscribe(
+            "userB", reconnect=False))))
+
+
+class TestAsyncChatClient(IsolatedAsyncioTestCase):
+    """Tests AsyncChatClient against asyncio server on local port."""
+
+    async def asyncSetUp(self):
+        """Starts asyncio server over memory storage."""
+        self.storage = MemoryStorage()
+        port = free_port()
+        self.server = create_aio_server(AsyncStorageAdapter(self.storage),
+                                        "localhost", port)
+        await self.server.start()
+        self.client = AsyncChatClient("localhost", port)
+
+    async def asyncTearDown(self):
+        """Closes client and stops server."""
+        await self.client.close()
+        await self.server.stop(None)
+
+    async def test_send_and_subscribe(self):
+        """Tests sent messages are received by subscriber."""
+        await self.client.send_message("userA", "userB", "1")
+        await self.client.send_messages([pb_message("2")])
+        bodies = []
+        async for message in self.client.subscribe("userB"):
+            bodies.append(message.body)
+            if len(bodies) == 2:
+                break
+        self.assertEqual(["1", "2"], sorted(bodies))
@@ -0,0 +1,68 @@
+"""Python module for testing chat_codecs module."""
+
+from unittest import TestCase
+
+from chat_codecs import (JsonCodec, ProtobufCodec, UnknownCodecError,
+                         decode_message, decode_user, get_codec)
+from chat_storage import Message, User
+
+
+class TestCodecs(TestCase):
+    """Tests codecs and decoding values of any codec."""
+
+    def setUp(self):
+        """Creates entities to be used by the tests."""
+        self.user = User(login="userA", full_name="AA AAA")
+        self.message = Message(login_from="userA", login_to="userB",
+                               body="Hello, you!", created_at=1234,
+                               message_id="00000000001234000000-node")
+        self.legacy_message = Message(login_from="userA", login_to="userB",
+                                      body="Hi!", created_at=1234,
+                                      message_id=None)
+
+    def test_round_trip(self):
+        """Tests every codec decodes what it encoded."""
+        for codec in (JsonCodec(), ProtobufCodec()):
+            with self.subTest(codec=codec):
+                self.assertEqual(self.user,
+                                 decode_user(codec.encode_user(self.user)))
+                for message in (self.message, self.legacy_message):
+                    value = codec.encode_message(message)
+                    self.assertEqual(message, decode_message(value))
+
+    def test_protobuf_long_message_id(self):
+        """Tests protobuf codec keeps message ids of any length, ids
+        shorter than 128 bytes take one length byte.
+        """
+        codec = ProtobufCodec()
+        for length in (0, 127, 128, 300, 20000):
+            with self.subTest(length=length):
+                message = Message("userA", "userB", "Hi!", 1234,
+                                  "x" * length or None)
+                value = codec.encode_message(message)
+                self.assertEqual(message, decode_message(value))
+        self.assertEqual(b"\x01\x19" + self.message.message_id.encode(),
+                         codec.encode_message(self.message)[:27])
+
+    def test_decode_legacy_json(self):
+        """Tests JSON values saved before message ids are readable."""
+        value = b'{"login_from": "userA", "login_to": "userB", ' + \
+            b'"body": "Hi!", "created_at": 1234}'
+        self.assertEqual(self.legacy_message, decode_message(value))
+
+    def test_protobuf_is_smaller(self):
+        """Tests protobuf values are smaller than JSON ones."""
+        self.assertLess(len(ProtobufCodec().encode_message(self.message)),
+                        len(JsonCodec().encode_message(self.message)))
+
+    def test_get_codec_raiserror(self):
+        """Tests 'get_codec' method and check raiserror."""
+        self.assertIsInstance(get_codec("protobuf"), ProtobufCodec)
+        with self.assertRaises(UnknownCodecError) as err:
+            get_codec("xml")
+        self.assertEqual("Unknown codec: xml", str(err.exception))
+
+    def test_decode_unknown_version_raiserror(self):
+        """Tests decoding value of unknown version raises error."""
+        with self.assertRaises(UnknownCodecError):
+            decode_user(b"\x7fdata")
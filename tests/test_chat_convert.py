@@ -0,0 +1,44 @@
+"""Python module for testing chat_convert module."""
+
+from unittest import TestCase
+
+import chat_pb2
+from chat_convert import (attach_pb, message_from_pb, message_to_pb,
+                          user_to_pb, users_reply)
+from chat_storage import Message, User
+
+
+class TestChatConvert(TestCase):
+    """Tests conversions between storage entities and protobuf messages."""
+
+    def test_message_from_pb(self):
+        """Tests message from client gets creation time and is attached."""
+        message_pb = chat_pb2.Message(login_from="user1", login_to="user2",
+                                      body="Hi!")
+        message = message_from_pb(message_pb)
+        self.assertEqual(("user1", "user2", "Hi!"),
+                         (message.login_from, message.login_to, message.body))
+        self.assertEqual(message.created_at, message_pb.created_at)
+        self.assertIs(message_pb, message_to_pb(message))
+
+    def test_message_to_pb(self):
+        """Tests message without attached protobuf is converted once."""
+        message = Message("user1", "user2", "Hi!", 1234)
+        message_pb = message_to_pb(message)
+        expected = chat_pb2.Message(login_from="user1", login_to="user2",
+                                    body="Hi!", created_at=1234)
+        self.assertEqual(expected, message_pb)
+        self.assertIs(message_pb, message_to_pb(message))
+
+    def test_attach_pb(self):
+        """Tests attached protobuf doesn't affect message equality."""
+        message = Message("user1", "user2", "Hi!", 1234, "id")
+        self.assertIs(message, attach_pb(message, chat_pb2.Message()))
+        self.assertEqual(Message("user1", "user2", "Hi!", 1234, "id"), message)
+
+    def test_users_reply(self):
+        """Tests users are converted to GetUsers reply."""
+        reply = users_reply([User("user1", "AA AAA")])
+        self.assertEqual([user_to_pb(User("user1", "AA AAA"))],
+                         list(reply.users))
+        self.assertEqual("AA AAA", reply.users[0].full_name)
@@ -0,0 +1,61 @@
+"""Python module for testing chat_ext_grpc module."""
+
+from unittest import TestCase
+
+import chat_ext_grpc
+import chat_pb2
+
+
+class TestMessageWithId(TestCase):
+    """Tests serialization of SubscribeFrom replies."""
+
+    def test_round_trip(self):
+        """Tests message and its id are parsed back."""
+        message = chat_pb2.Message(login_from="A", login_to="B", body="Hi!",
+                                   created_at=1234)
+        message_id = "00000000001234000000-node" * 10
+        data = chat_ext_grpc.serialize_message_with_id((message, message_id))
+        self.assertEqual((message, message_id),
+                         chat_ext_grpc.parse_message_with_id(data))
+
+    def test_parsed_as_message(self):
+        """Tests reply is parsed by clients reading it as Message."""
+        message = chat_pb2.Message(login_from="A", login_to="B", body="Hi!")
+        data = chat_ext_grpc.serialize_message_with_id((message, "1"))
+        self.assertEqual(message.body, chat_pb2.Message.FromString(data).body)
+        self.assertEqual((message, ""), chat_ext_grpc.parse_message_with_id(
+            message.SerializeToString()))
+
+    def test_read_cursor_metadata(self):
+        """Tests cursor is read from metadata."""
+        self.assertEqual("5", chat_ext_grpc.read_cursor_metadata(
+            (("cursor", "5"),)))
+        self.assertEqual("", chat_ext_grpc.read_cursor_metadata(None))
+
+    def test_cursor(self):
+        """Tests positions in mailbox and channels are read back from
+        cursor, malformed cursor is refused.
+        """
+        channels = {"general": 7, "a;b=c": 9}
+        cursor = chat_ext_grpc.format_cursor(5, channels)
+        self.assertEqual((5, channels), chat_ext_grpc.parse_cursor(cursor))
+        self.assertEqual(";general=7", chat_ext_grpc.format_cursor(
+            None, {"general": 7}))
+        self.assertEqual((None, {"general": 7}),
+                         chat_ext_grpc.parse_cursor(";general=7"))
+        self.assertEqual((5, {}), chat_ext_grpc.parse_cursor("5"))
+        for malformed in ("5;general", "5;general=", "x", "5;general=x"):
+            with self.assertRaises(ValueError):
+                chat_ext_grpc.parse_cursor(malformed)
+
+    def test_retry_after_metadata(self):
+        """Tests seconds to retry after are read back from metadata."""
+        self.assertEqual(0.25, chat_ext_grpc.read_retry_after_metadata(
+            chat_ext_grpc.retry_after_metadata(0.25)))
+        self.assertIsNone(chat_ext_grpc.read_retry_after_metadata(()))
+        metadata = chat_ext_grpc.retry_after_metadata(1, saved_messages=0)
+        self.assertEqual(1.0,
+                         chat_ext_grpc.read_retry_after_metadata(metadata))
+        self.assertEqual(
+            0, chat_ext_grpc.read_saved_messages_metadata(metadata))
+        self.assertIsNone(chat_ext_grpc.read_saved_messages_metadata(()))
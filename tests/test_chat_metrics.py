@@ -0,0 +1,164 @@
+"""Python module for testing chat_metrics module."""
+
+import socket
+import urllib.request
+from typing import Optional
+from unittest import TestCase, mock
+
+import grpc
+from prometheus_client import REGISTRY
+
+import chat_ext_grpc
+import chat_metrics
+import chat_pb2
+from chat_metrics import (BufferMetrics, InstrumentedStorage,
+                          MetricsInterceptor, start_metrics_server)
+from chat_server import create_server
+from chat_storage import Message, message_seq
+from storages.memory_storage import MemoryStorage
+
+
+def sample(name: str, **labels) -> float:
+    """Returns value of metric sample in default registry, zero if it
+    is not exposed.
+    """
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestMetricsServer(TestCase):
+    """Tests start_metrics_server function."""
+
+    def test_metrics_server(self):
+        """Tests metrics are served over HTTP."""
+        with socket.socket() as free:
+            free.bind(("localhost", 0))
+            port = free.getsockname()[1]
+        start_metrics_server(port, "localhost")
+        chat_metrics.SLOW_CONSUMERS.labels("served").inc()
+        url = f"http://localhost:{port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            self.assertIn('chat_slow_consumers_total{action="served"}',
+                          response.read().decode())
+
+
+class TestBufferMetrics(TestCase):
+    """Tests BufferMetrics class."""
+
+    def test_buffered_and_slow_consumers(self):
+        """Tests buffered bytes are summed and observed per stream as
+        they grow, slow consumers are counted by action.
+        """
+        metrics = BufferMetrics()
+        total = sample("chat_subscribe_buffered_bytes")
+        count = sample("chat_subscribe_stream_buffered_bytes_count")
+        metrics.buffered(100, 100)
+        metrics.buffered(50, 150)
+        metrics.buffered(-150, 0)
+        self.assertEqual(total, sample("chat_subscribe_buffered_bytes"))
+        self.assertEqual(count + 2,
+                         sample("chat_subscribe_stream_buffered_bytes_count"))
+        value = sample("chat_slow_consumers_total", action="paused")
+        metrics.slow_consumer("paused")
+        self.assertEqual(value + 1,
+                         sample("chat_slow_consumers_total", action="paused"))
+
+
+class TestInstrumentedStorage(TestCase):
+    """Tests InstrumentedStorage class."""
+
+    def setUp(self):
+        """Creates instrumented memory storage."""
+        self.storage = InstrumentedStorage(MemoryStorage())
+
+    def test_calls_timed(self):
+        """Tests storage calls are counted by method and status."""
+        labels = {"method": "get_users_list", "status": "ok"}
+        calls = sample("chat_storage_duration_seconds_count", **labels)
+        self.storage.get_users_list()
+        self.assertEqual(calls + 1,
+                         sample("chat_storage_duration_seconds_count",
+                                **labels))
+
+    def depth(self, login: str) -> Optional[float]:
+        """Returns queue depth of user, None if it is not exposed."""
+        return REGISTRY.get_sample_value("chat_user_queue_depth",
+                                         {"login": login})
+
+    def test_user_queue_depth(self):
+        """Tests queue depth counts pushed and not deleted or acknowledged
+        messages of watched user and is dropped with the watch.
+        """
+        messages = [Message("userA", "userQ", str(x)) for x in range(3)]
+        cancel = self.storage.watch_user_messages("userQ", mock.Mock())
+        self.storage.create_messages(messages)
+        self.assertEqual(3, self.depth("userQ"))
+        self.storage.delete_user_messages(messages[:1])
+        self.assertEqual(2, self.depth("userQ"))
+        self.storage.ack_user_messages("userQ", message_seq(messages[1]))
+        self.assertEqual(1, self.depth("userQ"))
+        cancel()
+        self.assertIsNone(self.depth("userQ"))
+
+    def test_user_queue_depth_pages(self):
+        """Tests messages read by pages for watched user are counted in
+        queue depth once, even if they were pushed to watch before.
+        """
+        messages = [Message("userA", "userQ", str(x)) for x in range(3)]
+        self.storage.create_messages(messages[:1])
+        cancel = self.storage.watch_user_messages("userQ", mock.Mock(),
+                                                  with_pending=False)
+        self.storage.create_messages(messages[1:])
+        self.assertEqual(2, self.depth("userQ"))
+        self.assertListEqual(messages,
+                             self.storage.get_user_messages_page("userQ"))
+        self.assertEqual(3, self.depth("userQ"))
+        cancel()
+
+    def test_user_queue_depth_watches(self):
+        """Tests messages pushed to several watches of user are counted
+        once and queue depth is kept until the last watch is cancelled.
+        """
+        messages = [Message("userA", "userQ", str(x)) for x in range(2)]
+        cancel_first = self.storage.watch_user_messages("userQ", mock.Mock())
+        cancel_second = self.storage.watch_user_messages("userQ",
+                                                         mock.Mock())
+        self.storage.create_messages(messages)
+        self.assertEqual(2, self.depth("userQ"))
+        cancel_first()
+        cancel_first()
+        self.storage.create_message(Message("userA", "userQ", "2"))
+        self.assertEqual(3, self.depth("userQ"))
+        cancel_second()
+        self.assertIsNone(self.depth("userQ"))
+
+
+class TestMetricsInterceptor(TestCase):
+    """Tests MetricsInterceptor on running server."""
+
+    def setUp(self):
+        """Starts instrumented server over memory storage."""
+        self.storage = MemoryStorage()
+        self.server = create_server(self.storage, "localhost", 0,
+                                    [MetricsInterceptor()])
+        port = self.server.add_insecure_port("localhost:0")
+        self.server.start()
+        self.addCleanup(self.server.stop, None)
+        self.channel = grpc.insecure_channel(f"localhost:{port}")
+        self.addCleanup(self.channel.close)
+        self.stub = chat_ext_grpc.ChatExtStub(self.channel)
+
+    def test_rpcs_recorded(self):
+        """Tests unary calls are timed and streamed messages counted."""
+        labels = {"method": "SendMessage", "status": "ok"}
+        calls = sample("chat_rpc_duration_seconds_count", **labels)
+        sent = sample("chat_stream_messages_sent_total", method="Subscribe")
+        self.stub.SendMessage(chat_pb2.SendMessageRequest(
+            message=chat_pb2.Message(login_from="A", login_to="B", body="Hi")))
+        self.assertEqual(calls + 1,
+                         sample("chat_rpc_duration_seconds_count", **labels))
+        stream = self.stub.Subscribe(chat_pb2.SubscribeRequest(login="B"))
+        self.assertEqual("Hi", next(stream).body)
+        self.assertEqual(1, sample("chat_active_streams", method="Subscribe"))
+        stream.cancel()
+        self.assertEqual(sent + 1, sample("chat_stream_messages_sent_total",
+                                          method="Subscribe"))
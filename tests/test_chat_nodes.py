@@ -0,0 +1,110 @@
+"""Python module for testing chat_nodes module."""
+
+from concurrent import futures
+from unittest import TestCase, mock
+
+import grpc
+
+import chat_ext_grpc
+import chat_pb2
+import chat_pb2_grpc
+from chat_nodes import NodeForwarder, group_by_node, is_forwarded
+from chat_server import Chat
+from chat_storage import Message, StorageWrapper
+from storages.memory_storage import MemoryStorage
+
+
+class TestNodeFunctions(TestCase):
+    """Tests chat_nodes functions."""
+
+    def test_is_forwarded(self):
+        """Tests forwarded requests are recognized by metadata."""
+        self.assertTrue(is_forwarded((("forwarded-by", "node1:50051"),)))
+        self.assertFalse(is_forwarded(()))
+
+    def test_group_by_node(self):
+        """Tests messages are grouped by nodes of recipients, node of
+        every recipient is looked up once.
+        """
+        messages = [Message("A", login_to, "Hi!")
+                    for login_to in ["B", "C", "D", "B"]]
+        nodes = {"B": "node2", "C": "node1"}
+        get_node = mock.Mock(side_effect=nodes.get)
+        local, remote = group_by_node(messages, "node1", get_node)
+        self.assertEqual(messages[1:3], local)
+        self.assertEqual({"node2": [messages[0], messages[3]]}, remote)
+        self.assertEqual(3, get_node.call_count)
+
+
+class TestNodeForwarder(TestCase):
+    """Tests NodeForwarder class."""
+
+    def setUp(self):
+        """Creates forwarder and messages to be used by the tests."""
+        self.forwarder = NodeForwarder("node1")
+        self.messages = [Message("A", "B", "Hi!"), Message("A", "C", "Hi!")]
+        self.get_node = {"B": "node2"}.get
+
+    @mock.patch.object(NodeForwarder, "_get_stub")
+    def test_forward(self, mock_get_stub):
+        """Tests remote messages are sent to their node."""
+        local = self.forwarder.forward(self.get_node, self.messages)
+        self.assertEqual(self.messages[1:], local)
+        mock_get_stub.assert_called_once_with("node2")
+        send_messages = mock_get_stub.return_value.SendMessages
+        requests = list(send_messages.call_args[0][0])
+        self.assertEqual(["B"], [request.message.login_to
+                                 for request in requests])
+        self.assertEqual((("forwarded-by", "node1"),),
+                         send_messages.call_args[1]["metadata"])
+
+    @mock.patch.object(NodeForwarder, "_get_stub")
+    def test_forward_fails(self, mock_get_stub):
+        """Tests messages of unreachable node are kept by this node."""
+        mock_get_stub.return_value.SendMessages.side_effect = grpc.RpcError()
+        local = self.forwarder.forward(self.get_node, self.messages)
+        self.assertEqual(sorted(message.login_to for message in self.messages),
+                         sorted(message.login_to for message in local))
+
+
+class RegistryStorage(StorageWrapper):
+
+    """Memory storage finding every subscriber on one node."""
+
+    def __init__(self, node_address):
+        super().__init__(MemoryStorage())
+        self.node_address = node_address
+
+    def get_subscriber_node(self, login):
+        return self.node_address
+
+
+class TestForwardingBetweenNodes(TestCase):
+    """Tests message sent to one node reaches storage of another."""
+
+    def setUp(self):
+        """Starts node serving subscriber on local port."""
+        self.remote_storage = MemoryStorage()
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+        port = self.server.add_insecure_port("localhost:0")
+        self.remote_address = f"localhost:{port}"
+        chat = Chat(self.remote_storage, node_address=self.remote_address)
+        chat_pb2_grpc.add_ChatServicer_to_server(chat, self.server)
+        chat_ext_grpc.add_ChatExtServicer_to_server(chat, self.server)
+        self.server.start()
+
+    def tearDown(self):
+        """Stops remote node."""
+        self.server.stop(None)
+
+    def test_SendMessage_forwarded(self):
+        """Tests local node forwards message instead of saving it."""
+        local_storage = RegistryStorage(self.remote_address)
+        chat = Chat(local_storage, node_address="localhost:1")
+        context = mock.Mock(invocation_metadata=mock.Mock(return_value=()))
+        request = chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+            login_from="A", login_to="B", body="Hi!"))
+        chat.SendMessage(request, context)
+        self.assertEqual([], local_storage.get_user_messages("B"))
+        self.assertEqual(["Hi!"], [message.body for message in
+                                   self.remote_storage.get_user_messages("B")])
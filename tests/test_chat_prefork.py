@@ -0,0 +1,99 @@
+"""Python module for testing chat_prefork module."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+import chat_storage
+from chat_prefork import Supervisor, get_workers_count
+
+
+def count_start(directory: str, worker: int):
+    """Records start of worker in directory and exits at once."""
+    with open(os.path.join(directory, f"{worker}-{os.getpid()}"), "w"):
+        pass
+
+
+def wait_stopped(worker: int):
+    """Waits until worker is terminated."""
+    while True:
+        time.sleep(1)
+
+
+def send_node_id(connection, worker: int):
+    """Sends NODE_ID of worker process."""
+    connection.send(chat_storage.NODE_ID)
+
+
+class TestGetWorkersCount(TestCase):
+    """Tests get_workers_count function."""
+
+    def test_get_workers_count(self):
+        """Tests count is read from value, one by default and number of
+        CPUs for zero.
+        """
+        self.assertEqual(1, get_workers_count(None))
+        self.assertEqual(1, get_workers_count(""))
+        self.assertEqual(3, get_workers_count("3"))
+        with mock.patch("chat_prefork.os.cpu_count", return_value=8):
+            self.assertEqual(8, get_workers_count("0"))
+        with self.assertRaises(ValueError):
+            get_workers_count("-1")
+
+
+class TestSupervisor(TestCase):
+    """Tests Supervisor class."""
+
+    def setUp(self):
+        """Creates directory workers record their starts in."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def run_supervisor(self, supervisor: Supervisor, seconds: float):
+        """Runs supervisor in thread for seconds, then stops it."""
+        with mock.patch("chat_prefork.signal.signal"):
+            thread = threading.Thread(target=supervisor.run)
+            thread.start()
+            time.sleep(seconds)
+            supervisor.stop()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_restart_exited(self):
+        """Tests workers exiting are started again."""
+        supervisor = Supervisor(
+            lambda worker: count_start(self.directory, worker), 2,
+            restart_delay=0.05)
+        self.run_supervisor(supervisor, 0.5)
+        starts = os.listdir(self.directory)
+        self.assertGreater(len([name for name in starts
+                                if name.startswith("0-")]), 1)
+        self.assertGreater(len([name for name in starts
+                                if name.startswith("1-")]), 1)
+
+    def test_shutdown(self):
+        """Tests workers are terminated when supervisor is stopped."""
+        supervisor = Supervisor(wait_stopped, 2)
+        self.run_supervisor(supervisor, 0.2)
+        self.assertEqual([-15, -15], [process.exitcode for process
+                                      in supervisor.processes.values()])
+
+    def test_shutdown_kills(self):
+        """Tests workers not stopped in time are killed."""
+        supervisor = Supervisor(wait_stopped, 1, shutdown_timeout=0.1)
+        supervisor._start_worker(0)
+        with mock.patch.object(supervisor.processes[0], "terminate"):
+            supervisor.shutdown()
+        self.assertEqual(-9, supervisor.processes[0].exitcode)
+
+    def test_node_id_of_worker(self):
+        """Tests forked worker has node id of its own."""
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        supervisor = Supervisor(lambda worker: send_node_id(sender, worker), 1)
+        supervisor._start_worker(0)
+        supervisor.processes[0].join(10)
+        self.assertNotEqual(chat_storage.NODE_ID, receiver.recv())
@@ -0,0 +1,68 @@
+"""Python module for testing chat_rate_limit module."""
+
+from unittest import TestCase, mock
+
+from chat_rate_limit import SubscriberRateLimiter, TokenBucket
+
+
+class TestTokenBucket(TestCase):
+    """Tests TokenBucket class."""
+
+    @mock.patch("chat_rate_limit.time.monotonic")
+    def test_reserve(self, mock_monotonic):
+        """Tests 'reserve' method returns delay after tokens run out."""
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, capacity=2)
+        self.assertEqual(0.0, bucket.reserve())
+        self.assertEqual(0.0, bucket.reserve())
+        self.assertEqual(0.5, bucket.reserve())
+        mock_monotonic.return_value = 101.5
+        self.assertEqual(0.0, bucket.reserve())
+
+    @mock.patch("chat_rate_limit.time.monotonic")
+    def test_take(self, mock_monotonic):
+        """Tests 'take' method refuses tokens instead of going into debt."""
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, capacity=2)
+        self.assertEqual(0.0, bucket.take())
+        self.assertEqual(0.0, bucket.take())
+        self.assertEqual(0.5, bucket.take())
+        self.assertEqual(0.5, bucket.take())
+        mock_monotonic.return_value = 100.5
+        self.assertEqual(0.0, bucket.take())
+
+    @mock.patch("chat_rate_limit.time.monotonic")
+    def test_take_slow_rate(self, mock_monotonic):
+        """Tests token is taken from bucket with rate below one token per
+        second, and refunded token can be taken again.
+        """
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=0.5)
+        self.assertEqual(0.0, bucket.take())
+        self.assertEqual(2.0, bucket.take())
+        bucket.refund()
+        self.assertEqual(0.0, bucket.take())
+        mock_monotonic.return_value = 102.0
+        self.assertEqual(0.0, bucket.take())
+
+
+class TestSubscriberRateLimiter(TestCase):
+    """Tests SubscriberRateLimiter class."""
+
+    @mock.patch("chat_rate_limit.time.sleep")
+    def test_wait_without_limits(self, mock_sleep):
+        """Tests 'wait' method does not sleep without limits."""
+        SubscriberRateLimiter().wait(100)
+        mock_sleep.assert_not_called()
+
+    @mock.patch("chat_rate_limit.time.sleep")
+    @mock.patch("chat_rate_limit.time.monotonic")
+    def test_wait_bytes_limit(self, mock_monotonic, mock_sleep):
+        """Tests 'wait' method sleeps by the strictest limit."""
+        mock_monotonic.return_value = 100.0
+        limiter = SubscriberRateLimiter(messages_per_second=1000,
+                                        bytes_per_second=100)
+        limiter.wait(100)
+        mock_sleep.assert_not_called()
+        limiter.wait(50)
+        mock_sleep.assert_called_once_with(0.5)
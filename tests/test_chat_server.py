@@ -3,9 +3,24 @@
 from itertools import islice
 from unittest import TestCase, mock
 
+import grpc
+
 import chat_pb2
 import chat_server
-from chat_storage import Message, User
+from chat_storage import Channel, Message, User, attach_seq, message_seq
+from storages.memory_storage import MemoryStorage
+
+
+def read_backlog(storage: mock.Mock, messages, end_watch: bool = True):
+    """Makes storage mock return messages by the first page read, then
+    by default breaking the watch, so the stream ends.
+    """
+    def get_user_messages_page(login, after_seq, limit):
+        if end_watch:
+            storage.watch_user_messages.call_args[0][1](None)
+        return messages
+
+    storage.get_user_messages_page.side_effect = get_user_messages_page
 
 
 class TestChat(TestCase):
@@ -21,6 +36,7 @@ class TestChat(TestCase):
     def setUp(self):
         """Creates storage and chat object to be used by the tests."""
         self.storage = mock.Mock()
+        self.storage.get_user_channels.return_value = {}
         self.chat = chat_server.Chat(self.storage)
 
     def test_GetUsers(self):
@@ -30,9 +46,59 @@ class TestChat(TestCase):
         users = [chat_pb2.User(login="userA", full_name="AA AAA"),
                  chat_pb2.User(login="userB", full_name="BB BBB")]
         expected = chat_pb2.GetUsersReply(users=users)
-        result = self.chat.GetUsers(mock.Mock(), mock.Mock())
+        context = mock.Mock(invocation_metadata=mock.Mock(return_value=()))
+        result = self.chat.GetUsers(mock.Mock(), context)
         self.assertEqual(expected, result)
 
+    def test_GetUsers_reuses_reply(self):
+        """Tests 'GetUsers' method builds reply again only for new list."""
+        users = [self.user1]
+        context = mock.Mock(invocation_metadata=mock.Mock(return_value=()))
+        self.storage.get_users_list.return_value = users
+        reply = self.chat.GetUsers(mock.Mock(), context)
+        self.assertIs(reply, self.chat.GetUsers(mock.Mock(), context))
+        self.storage.get_users_list.return_value = [self.user1, self.user2]
+        self.assertEqual(2, len(self.chat.GetUsers(mock.Mock(), context).users))
+
+    def test_GetUsers_page(self):
+        """Tests 'GetUsers' method with page requested in metadata."""
+        self.storage.get_users_page.return_value = [self.user1, self.user2]
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (
+            ("page-size", "2"), ("page-token", "user"), ("login-prefix", "u"))
+        result = self.chat.GetUsers(mock.Mock(), context)
+        self.storage.get_users_page.assert_called_once_with("user", 2, "u")
+        context.set_trailing_metadata.assert_called_once_with(
+            (("next-page-token", "userB"),))
+        self.assertEqual(2, len(result.users))
+        self.storage.get_users_list.assert_not_called()
+
+    def test_GetUsers_page_size_invalid(self):
+        """Tests 'GetUsers' method aborts with too big page size."""
+        context = mock.Mock()
+        context.abort.side_effect = Exception("aborted")
+        context.invocation_metadata.return_value = (("page-size", "5000"),)
+        with self.assertRaises(Exception):
+            self.chat.GetUsers(mock.Mock(), context)
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.INVALID_ARGUMENT,
+            "page size must be from 1 to 1000")
+
+    @mock.patch("chat_server.USERS_PAGE_SIZE", 1)
+    def test_StreamUsers(self):
+        """Tests 'StreamUsers' method reads users page by page."""
+        self.storage.get_users_page.side_effect = [[self.user1], [self.user2],
+                                                   []]
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (("login-prefix", "user"),)
+        result = list(self.chat.StreamUsers(mock.Mock(), context))
+        self.assertListEqual(
+            [chat_pb2.User(login="userA", full_name="AA AAA"),
+             chat_pb2.User(login="userB", full_name="BB BBB")], result)
+        self.storage.get_users_page.assert_has_calls([
+            mock.call("", 1, "user"), mock.call("userA", 1, "user"),
+            mock.call("userB", 1, "user")])
+
     @mock.patch("chat_storage.time.time")
     def test_SendMessage(self, mock_time):
         """Tests 'SendMessage' method."""
@@ -46,21 +112,38 @@ class TestChat(TestCase):
             f"from {request.message.login_from}!"
         )
         result = self.chat.SendMessage(request, mock.Mock())
-        self.storage.create_message.assert_called_with(
-            Message(request.message.login_from, request.message.login_to, request.message.body))
+        message = self.storage.create_message.call_args[0][0]
+        self.assertEqual(
+            Message(request.message.login_from, request.message.login_to,
+                    request.message.body, message_id=message.message_id),
+            message)
+        self.assertEqual(1111, message.created_at)
         self.assertEqual(expected, result)
 
-    @mock.patch("chat_storage.time.sleep")
-    def test_Subscribe(self, mock_time):
+    @mock.patch("chat_server.SEND_BATCH_SIZE", 2)
+    def test_SendMessages(self):
+        """Tests 'SendMessages' method saves messages in batches."""
+        requests = [chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+            login_from="userA", login_to="userB", body=str(x)))
+            for x in range(3)]
+        result = self.chat.SendMessages(iter(requests), mock.Mock())
+        batches = [call[0][0]
+                   for call in self.storage.create_messages.call_args_list]
+        self.assertListEqual([["0", "1"], ["2"]],
+                             [[message.body for message in batch]
+                              for batch in batches])
+        self.assertEqual(chat_pb2.SendMessageReply(
+            status="Done! 3 messages received."), result)
+
+    def test_Subscribe(self):
         """Tests 'Subscribe' method."""
-        mock_time.return_value = None
         request = mock.Mock(login="B")
         context = mock.Mock()
-        context.is_active.return_value = True
-        self.storage.get_user_messages.return_value = [
+        messages = [
             Message(login_from="A", login_to="B",
                     body="Hello, you!", created_at=1234),
             Message(login_from="C", login_to="B", body="Hello!", created_at=12345)]
+        read_backlog(self.storage, messages, end_watch=False)
         expected = [chat_pb2.Message(login_from="A",
                                      login_to="B",
                                      created_at=1234,
@@ -70,21 +153,341 @@ class TestChat(TestCase):
                                      created_at=12345,
                                      body="Hello!")
                     ]
-        result = [message for message in islice(
-            self.chat.Subscribe(request, context), 0, 3)]
-        calls = [mock.call(Message(login_from="A", login_to="B",
-                                   body="Hello, you!", created_at=1234)),
-                 mock.call(Message(login_from='C', login_to='B',
-                                   body='Hello!', created_at=12345))]
-        self.storage.get_user_messages.assert_called_with("B")
-        self.storage.delete_user_message.assert_has_calls(calls)
-        self.assertListEqual(expected, result[:2])
+        subscription = self.chat.Subscribe(request, context)
+        result = [message for message in islice(subscription, 0, 2)]
+        self.storage.watch_user_messages.assert_called_once_with(
+            "B", mock.ANY, with_pending=False)
+        self.storage.delete_user_messages.assert_not_called()
+        self.assertListEqual(expected, result)
+        context.add_callback.call_args[0][0]()
+        self.assertListEqual([], list(subscription))
+        self.storage.delete_user_messages.assert_called_once_with(messages)
+
+    def test_Subscribe_batches(self):
+        """Tests 'Subscribe' method acknowledges messages in batches."""
+        chat = chat_server.Chat(self.storage, subscribe_batch_size=2)
+        messages = [Message(login_from="A", login_to="B", body=str(x),
+                            created_at=x) for x in range(5)]
+        read_backlog(self.storage, messages)
+        result = list(chat.Subscribe(mock.Mock(login="B"), mock.Mock()))
+        self.assertEqual(5, len(result))
+        self.storage.delete_user_messages.assert_has_calls(
+            [mock.call(messages[0:2]), mock.call(messages[2:4]),
+             mock.call(messages[4:])])
+
+    def test_Subscribe_slow_consumer(self):
+        """Tests subscriber behind its stream longer than timeout is
+        disconnected, messages stay in storage.
+        """
+        storage = MemoryStorage()
+        chat = chat_server.Chat(storage, max_buffered_bytes=600,
+                                slow_consumer_policy="disconnect",
+                                slow_consumer_timeout=0)
+        context = mock.Mock()
+        context.abort.side_effect = grpc.RpcError()
+        messages = [Message("A", "B", str(x) * 400) for x in range(3)]
+        storage.create_message(messages[0])
+        subscription = chat.Subscribe(mock.Mock(login="B"), context)
+        self.assertEqual(messages[0].body, next(subscription).body)
+        storage.create_message(messages[1])
+        storage.create_message(messages[2])
+        with self.assertRaises(grpc.RpcError):
+            next(subscription)
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.RESOURCE_EXHAUSTED, mock.ANY)
+        self.assertListEqual(messages[1:], storage.get_user_messages("B"))
+
+    @mock.patch("chat_server.MessageWatch")
+    def test_Subscribe_cancels_stalled(self, mock_watch):
+        """Tests 'Subscribe' method lets watch cancel the call of
+        subscriber which stopped reading.
+        """
+        mock_watch.return_value.__iter__.return_value = iter([])
+        context = mock.Mock()
+        list(self.chat.Subscribe(mock.Mock(login="B"), context))
+        self.assertIs(context.cancel,
+                      mock_watch.call_args[1]["on_disconnect"])
+
+    @mock.patch("chat_server.SubscriberRateLimiter")
+    def test_Subscribe_rate_limit(self, mock_limiter):
+        """Tests 'Subscribe' method paces every message by its size."""
+        chat = chat_server.Chat(self.storage, messages_per_second=10,
+                                bytes_per_second=1000)
+        message = Message(login_from="A", login_to="B", body="Hi",
+                          created_at=1)
+        read_backlog(self.storage, [message])
+        result = list(chat.Subscribe(mock.Mock(login="B"), mock.Mock()))
+        mock_limiter.assert_called_once_with(10, 1000)
+        mock_limiter.return_value.wait.assert_called_once_with(
+            result[0].ByteSize())
+
+    def test_Subscribe_registers_node(self):
+        """Tests 'Subscribe' method registers node until stream is closed."""
+        chat = chat_server.Chat(self.storage, node_address="node1:50051")
+        read_backlog(self.storage, [])
+        context = mock.Mock()
+        list(chat.Subscribe(mock.Mock(login="B"), context))
+        context.abort.assert_called_once_with(grpc.StatusCode.UNAVAILABLE,
+                                              mock.ANY)
+        self.storage.register_subscriber.assert_called_once_with(
+            "B", "node1:50051")
+        context.add_callback.assert_any_call(
+            self.storage.register_subscriber.return_value)
+
+    def test_SendMessage_forwarded(self):
+        """Tests 'SendMessage' forwards message of subscriber on other node
+        unless the request was forwarded already.
+        """
+        self.storage.watches_across_nodes = False
+        chat = chat_server.Chat(self.storage, node_address="node1:50051")
+        chat.forwarder = mock.Mock()
+        chat.forwarder.forward.return_value = []
+        request = chat_pb2.SendMessageRequest(message=chat_pb2.Message(
+            login_from="A", login_to="B", body="Hi!"))
+        context = mock.Mock(invocation_metadata=mock.Mock(return_value=()))
+        chat.SendMessage(request, context)
+        chat.forwarder.forward.assert_called_once_with(
+            self.storage.get_subscriber_node, mock.ANY)
+        self.storage.create_message.assert_not_called()
+        context.invocation_metadata.return_value = (
+            ("forwarded-by", "node2:50051"),)
+        chat.SendMessage(request, context)
+        chat.forwarder.forward.assert_called_once()
+        self.storage.create_message.assert_called_once()
+
+    def test_forwarding_needs_node_storage(self):
+        """Tests messages aren't forwarded over storage shared by nodes."""
+        self.storage.watches_across_nodes = True
+        chat = chat_server.Chat(self.storage, node_address="node1:50051")
+        self.assertIsNone(chat.forwarder)
+
+    def test_Subscribe_stops_on_close(self):
+        """Tests 'Subscribe' method ends when stream is closed."""
+        cancel = mock.Mock()
+        self.storage.watch_user_messages.return_value = cancel
+        context = mock.Mock()
+        context.add_callback.side_effect = lambda close: close()
+        result = list(self.chat.Subscribe(mock.Mock(login="B"), context))
+        self.assertListEqual([], result)
+        cancel.assert_called_once_with()
+
+
+    def test_SubscribeFrom(self):
+        """Tests 'SubscribeFrom' method acknowledges messages up to cursor,
+        streams messages with cursors and deletes only messages without
+        sequence numbers.
+        """
+        messages = [Message(login_from="A", login_to="B", body="Hi!",
+                            created_at=1) for x in range(2)]
+        attach_seq(messages[0], 2)
+        read_backlog(self.storage, messages)
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (("cursor", "1"),)
+        result = list(self.chat.SubscribeFrom(mock.Mock(login="B"), context))
+        self.storage.ack_user_messages.assert_called_once_with("B", 1)
+        self.assertListEqual(["2", "2"], [cursor for reply, cursor in result])
+        self.assertEqual("Hi!", result[0][0].body)
+        self.storage.delete_user_messages.assert_called_once_with(
+            messages[1:])
+
+    def test_AckMessages(self):
+        """Tests 'AckMessages' method deletes messages up to cursor."""
+        self.storage.ack_user_messages.return_value = 3
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (("cursor", "5"),)
+        reply = self.chat.AckMessages(chat_pb2.SubscribeRequest(login="B"),
+                                      context)
+        self.storage.ack_user_messages.assert_called_once_with("B", 5)
+        self.assertEqual("Done! 3 messages acknowledged.", reply.status)
+
+    def test_AckMessages_malformed_cursor(self):
+        """Tests 'AckMessages' method rejects malformed cursor."""
+        context = mock.Mock()
+        context.invocation_metadata.return_value = (("cursor", "5;general"),)
+        context.abort.side_effect = grpc.RpcError()
+        with self.assertRaises(grpc.RpcError):
+            self.chat.AckMessages(chat_pb2.SubscribeRequest(login="B"),
+                                  context)
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.INVALID_ARGUMENT, mock.ANY)
+        self.storage.ack_user_messages.assert_not_called()
+
+    def test_AckMessages_without_cursor(self):
+        """Tests 'AckMessages' method rejects request without cursor."""
+        context = mock.Mock()
+        context.invocation_metadata.return_value = ()
+        context.abort.side_effect = grpc.RpcError()
+        with self.assertRaises(grpc.RpcError):
+            self.chat.AckMessages(chat_pb2.SubscribeRequest(login="B"),
+                                  context)
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.INVALID_ARGUMENT, "cursor is required")
+        self.storage.ack_user_messages.assert_not_called()
+
+
+class TestChatChannels(TestCase):
+
+    """Tests channels of Chat class over memory storage."""
+
+    def setUp(self):
+        """Creates chat over memory storage, userA joins #general."""
+        self.storage = MemoryStorage()
+        self.chat = chat_server.Chat(self.storage)
+        self.context = mock.Mock()
+        self.context.invocation_metadata.return_value = (
+            ("channel", "general"),)
+        self.context.abort.side_effect = grpc.RpcError()
+        reply = self.chat.JoinChannel(
+            chat_pb2.SubscribeRequest(login="userA"), self.context)
+        self.assertEqual("Done! userA joined #general.", reply.status)
+
+    def send(self, login_from: str, body: str):
+        """Sends message to #general."""
+        return self.chat.SendMessage(chat_pb2.SendMessageRequest(
+            message=chat_pb2.Message(login_from=login_from,
+                                     login_to="#general", body=body)),
+            self.context)
+
+    def test_JoinChannel_creates_channel(self):
+        """Tests channel is created by the first member."""
+        self.assertEqual(Channel("general"),
+                         self.storage.get_channel("general"))
+        self.context.invocation_metadata.return_value = ()
+        with self.assertRaises(grpc.RpcError):
+            self.chat.JoinChannel(chat_pb2.SubscribeRequest(login="userA"),
+                                  self.context)
+        self.context.abort.assert_called_once_with(
+            grpc.StatusCode.INVALID_ARGUMENT, "channel is required")
+
+    def test_SendMessage_saved_once(self):
+        """Tests message to channel is saved once in its log, members
+        only may send it.
+        """
+        self.chat.JoinChannel(chat_pb2.SubscribeRequest(login="userB"),
+                              self.context)
+        self.send("userA", "Hi all!")
+        self.assertEqual(["Hi all!"], [
+            message.body
+            for message in self.storage.get_user_messages("#general")])
+        self.assertEqual([], self.storage.get_user_messages("userB"))
+        with self.assertRaises(grpc.RpcError):
+            self.send("userC", "Hi!")
+        self.context.abort.assert_called_once_with(
+            grpc.StatusCode.PERMISSION_DENIED,
+            "userC is not a member of #general")
+
+    def test_Subscribe_merges_channels(self):
+        """Tests Subscribe streams direct messages and channel messages
+        after cursor of member, cursor is moved past delivered messages.
+        """
+        self.storage.create_message(Message("userC", "#general", "before"))
+        self.chat.JoinChannel(chat_pb2.SubscribeRequest(login="userB"),
+                              self.context)
+        self.send("userA", "Hi all!")
+        self.storage.create_message(Message("userA", "userB", "Hi B!"))
+        stream = self.chat.Subscribe(chat_pb2.SubscribeRequest(login="userB"),
+                                     self.context)
+        self.assertCountEqual(["Hi all!", "Hi B!"],
+                              [next(stream).body for x in range(2)])
+        self.context.add_callback.call_args_list[-1][0][0]()
+        self.assertEqual([], list(stream))
+        self.assertEqual([], self.storage.get_user_messages("userB"))
+        self.assertEqual(2, len(self.storage.get_user_messages("#general")))
+        cursor = self.storage.get_user_channels("userB")["general"]
+        self.assertEqual(message_seq(
+            self.storage.get_user_messages("#general")[-1]), cursor)
+
+    def test_SubscribeFrom_channel_cursors(self):
+        """Tests cursor of SubscribeFrom stream acknowledges direct
+        messages and moves cursors only of channels read from.
+        """
+        self.chat.JoinChannel(chat_pb2.SubscribeRequest(login="userB"),
+                              self.context)
+        self.storage.create_channel(Channel("dev"))
+        self.storage.join_channel("dev", "userB")
+        dev_cursor = self.storage.get_user_channels("userB")["dev"]
+        self.send("userA", "Hi all!")
+        self.storage.create_message(Message("userA", "userB", "Hi B!"))
+        self.context.invocation_metadata.return_value = ()
+        stream = self.chat.SubscribeFrom(
+            chat_pb2.SubscribeRequest(login="userB"), self.context)
+        cursor = [next(stream)[1] for x in range(2)][-1]
+        self.context.add_callback.call_args_list[-1][0][0]()
+        self.assertEqual([], list(stream))
+        self.context.invocation_metadata.return_value = (("cursor", cursor),)
+        reply = self.chat.AckMessages(
+            chat_pb2.SubscribeRequest(login="userB"), self.context)
+        self.assertEqual("Done! 1 messages acknowledged.", reply.status)
+        self.assertEqual({"general": message_seq(
+                              self.storage.get_user_messages("#general")[-1]),
+                          "dev": dev_cursor},
+                         self.storage.get_user_channels("userB"))
+
+    def test_Subscribe_to_channel_rejected(self):
+        """Tests channel log can not be read and deleted by Subscribe."""
+        with self.assertRaises(grpc.RpcError):
+            next(self.chat.Subscribe(
+                chat_pb2.SubscribeRequest(login="#general"), self.context))
+        self.context.abort.assert_called_once_with(
+            grpc.StatusCode.INVALID_ARGUMENT,
+            "channel can not be subscribed to")
+
+    def test_LeaveChannel(self):
+        """Tests user who left is not member of channel."""
+        reply = self.chat.LeaveChannel(
+            chat_pb2.SubscribeRequest(login="userA"), self.context)
+        self.assertEqual("Done! userA left #general.", reply.status)
+        self.assertEqual({}, self.storage.get_user_channels("userA"))
 
 
 class TestServerFunctions(TestCase):
 
     """Class for testing chat_server functions."""
 
+    def test_split_channel_messages(self):
+        """Tests messages to user are split from cursors of channels."""
+        messages = [attach_seq(Message("A", "#general", "1"), 3),
+                    Message("A", "B", "2"),
+                    attach_seq(Message("A", "#general", "3"), 5),
+                    attach_seq(Message("A", "#dev", "4"), 4),
+                    Message("A", "#dev", "5")]
+        self.assertEqual(
+            ([messages[1]], {"general": 5, "dev": 4}),
+            chat_server.split_channel_messages(messages))
+
+    @mock.patch.dict("os.environ", {"STORAGE": "sqlite",
+                                    "SERVER_WORKERS": "2"})
+    @mock.patch("chat_server.Supervisor")
+    def test_main_workers_local_storage(self, supervisor):
+        """Tests workers are not started with storage not shared by
+        them.
+        """
+        with self.assertRaises(SystemExit), self.assertLogs(
+                "config_logger", "ERROR"):
+            chat_server.main()
+        supervisor.assert_not_called()
+
+    @mock.patch.dict("os.environ", {"STORAGE": "sharded",
+                                    "SERVER_WORKERS": "2"})
+    @mock.patch("chat_server.Supervisor")
+    def test_main_workers_shared_storage(self, supervisor):
+        """Tests workers are started with storage shared by them."""
+        chat_server.main()
+        supervisor.assert_called_once_with(chat_server.run_server, 2)
+        supervisor.return_value.run.assert_called_once_with()
+
+    @mock.patch.dict("os.environ", {"STORAGE": "memory",
+                                    "SERVER_NODE_ADDRESS": "localhost:1"})
+    @mock.patch("chat_server.create_server")
+    def test_run_server_nodes_local_storage(self, create_server):
+        """Tests server node is not started with storage whose subscribers
+        other nodes can't find.
+        """
+        with self.assertRaises(SystemExit), self.assertLogs(
+                "config_logger", "ERROR"):
+            chat_server.run_server()
+        create_server.assert_not_called()
+
     def test_create_users_list(self):
         """Tests 'create_users_list' method."""
         self.storage = mock.Mock()
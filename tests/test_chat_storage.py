@@ -1,8 +1,13 @@
 """Python module for testing chat_storage module."""
 
-from unittest import TestCase
+import threading
+import time
+from unittest import TestCase, mock
 
-from chat_storage import Message, User
+from chat_storage import (Channel, DeliveryBuffer, Message, MessageClock,
+                          MessageCompactor, MessageWatch, SlowConsumerError,
+                          Storage, StorageWrapper, User, WatchBrokenError,
+                          attach_seq, channel_name, is_channel, message_seq)
 
 
 class TestUserInstance(TestCase):
@@ -19,6 +24,15 @@ class TestUserInstance(TestCase):
         expected_key = "user.user1"
         self.assertEqual(expected_key, key)
 
+    def test_user_slotted_and_frozen(self):
+        """Tests user has no instance dict and can't be changed."""
+        user = User(**self.user_data)
+        self.assertFalse(hasattr(user, "__dict__"))
+        with self.assertRaises(AttributeError):
+            user.login = "user2"
+        self.assertEqual(User(**self.user_data), user)
+        self.assertEqual(hash(User(**self.user_data)), hash(user))
+
 
 class TestMessageInstance(TestCase):
     """Tests Message class."""
@@ -26,11 +40,379 @@ class TestMessageInstance(TestCase):
     def setUp(self):
         """Creates message data to be used by the tests."""
         self.message_data = {"login_from": "user1", "login_to": "user2",
-                             "body": "Hello, you!", "created_at": 1234}
+                             "body": "Hello, you!", "created_at": 1234,
+                             "message_id": "00000000001234000000-node"}
 
     def test_get_unique_key(self):
         """Tests get unique key method."""
         user = Message(**self.message_data)
         key = user.get_unique_key()
-        expected_key = "message.user2.user1.1234"
+        expected_key = "message.user2.00000000001234000000-node"
         self.assertEqual(expected_key, key)
+
+    def test_get_unique_key_without_id(self):
+        """Tests get unique key method for message saved without id."""
+        message = Message(**{**self.message_data, "message_id": None})
+        expected_key = "message.user2.user1.1234"
+        self.assertEqual(expected_key, message.get_unique_key())
+
+    def test_get_unique_key_cached(self):
+        """Tests unique key is built once and doesn't affect equality."""
+        message = Message(**self.message_data)
+        self.assertIs(message.get_unique_key(), message.get_unique_key())
+        self.assertEqual(Message(**self.message_data), message)
+
+    def test_message_seq(self):
+        """Tests sequence number is kept on message apart from fields."""
+        message = Message(**self.message_data)
+        self.assertIsNone(message_seq(message))
+        self.assertIs(message, attach_seq(message, 5))
+        self.assertEqual(5, message_seq(message))
+        self.assertEqual(Message(**self.message_data), message)
+
+    def test_message_slotted_and_frozen(self):
+        """Tests message has no instance dict and can't be changed."""
+        message = Message(**self.message_data)
+        self.assertFalse(hasattr(message, "__dict__"))
+        with self.assertRaises(AttributeError):
+            message.body = "Bye!"
+
+    def test_message_ids_ordered(self):
+        """Tests ids of messages created in a row are unique and ordered."""
+        messages = [Message("user1", "user2", "Hi!") for x in range(1000)]
+        ids = [message.message_id for message in messages]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertListEqual(sorted(ids), ids)
+        self.assertEqual(len(ids[0]), len(ids[-1]))
+
+
+class TestMessageClock(TestCase):
+    """Tests MessageClock class."""
+
+    @mock.patch("chat_storage.time.time_ns")
+    def test_now_strictly_increasing(self, mock_time_ns):
+        """Tests 'now' method when wall clock stalls or goes back."""
+        clock = MessageClock()
+        mock_time_ns.return_value = 100
+        self.assertEqual(100, clock.now())
+        self.assertEqual(101, clock.now())
+        mock_time_ns.return_value = 50
+        self.assertEqual(102, clock.now())
+        mock_time_ns.return_value = 200
+        self.assertEqual(200, clock.now())
+
+
+class TestStorage(TestCase):
+    """Tests default methods of Storage class."""
+
+    def test_get_users_page(self):
+        """Tests 'get_users_page' pages users list by login."""
+        storage = mock.Mock()
+        storage.get_users_list.return_value = [
+            User(login=login, full_name="") for login in
+            ["userC", "admin", "userA", "userB"]]
+        users = Storage.get_users_page(storage, "userA", 1, "user")
+        self.assertListEqual([User(login="userB", full_name="")], users)
+
+    def test_create_messages(self):
+        """Tests 'create_messages' saves every message."""
+        storage = mock.Mock()
+        Storage.create_messages(storage, ["message1", "message2"])
+        storage.create_message.assert_has_calls(
+            [mock.call("message1"), mock.call("message2")])
+
+    def test_delete_user_messages(self):
+        """Tests 'delete_user_messages' deletes every message."""
+        storage = mock.Mock()
+        Storage.delete_user_messages(storage, ["message1", "message2"])
+        storage.delete_user_message.assert_has_calls(
+            [mock.call("message1"), mock.call("message2")])
+
+
+    def test_ack_user_messages(self):
+        """Tests 'ack_user_messages' deletes messages up to cursor."""
+        storage = mock.Mock()
+        messages = [attach_seq(Message("A", "B", "Hi!"), seq)
+                    for seq in [1, 2]] + [Message("A", "B", "Hi!")]
+        storage.get_user_messages.return_value = messages
+        self.assertEqual(1, Storage.ack_user_messages(storage, "B", 1))
+        storage.delete_user_messages.assert_called_once_with(messages[:1])
+
+
+    def test_get_user_messages_page(self):
+        """Tests 'get_user_messages_page' pages messages after sequence
+        number.
+        """
+        storage = mock.Mock()
+        messages = [attach_seq(Message("A", "B", "Hi!"), seq)
+                    for seq in [1, 2, 3, 4]]
+        storage.get_user_messages.return_value = messages
+        self.assertListEqual(messages[1:3], Storage.get_user_messages_page(
+            storage, "B", 1, 2))
+
+    def test_compact_messages(self):
+        """Tests storages keep messages by default."""
+        self.assertEqual(0, Storage.compact_messages(mock.Mock()))
+
+
+class TestChannelInstance(TestCase):
+    """Tests Channel class."""
+
+    def test_get_unique_key(self):
+        """Tests channel key and recipient of messages sent to it."""
+        channel = Channel("general", "General talk")
+        self.assertEqual("channel.general", channel.get_unique_key())
+        self.assertEqual("#general", channel.login)
+        self.assertTrue(is_channel(channel.login))
+        self.assertFalse(is_channel("general"))
+        self.assertEqual("general", channel_name(channel.login))
+
+
+class TestStorageWrapper(TestCase):
+    """Tests StorageWrapper class."""
+
+    def test_methods_passed(self):
+        """Tests methods are passed to wrapped storage."""
+        storage = mock.Mock()
+        wrapper = StorageWrapper(storage)
+        self.assertIs(storage.get_users_list.return_value,
+                      wrapper.get_users_list())
+        wrapper.delete_user_messages(["message1"])
+        storage.delete_user_messages.assert_called_once_with(["message1"])
+        callback = mock.Mock()
+        wrapper.watch_user_messages("user1", callback)
+        storage.watch_user_messages.assert_called_once_with("user1", callback,
+                                                            True)
+        self.assertIs(storage.get_user_messages_page.return_value,
+                      wrapper.get_user_messages_page("user1", 2, 10))
+        storage.get_user_messages_page.assert_called_once_with("user1", 2, 10)
+
+    def test_watch_users_unsupported(self):
+        """Tests storages can not watch users by default."""
+        self.assertIsNone(Storage.watch_users(mock.Mock(), mock.Mock()))
+
+
+class TestMessageWatch(TestCase):
+    """Tests MessageWatch class."""
+
+    def setUp(self):
+        """Creates storage mock capturing watch callback, with empty
+        mailbox.
+        """
+        self.storage = mock.Mock()
+        self.storage.get_user_messages_page.return_value = []
+        self.cancel = self.storage.watch_user_messages.return_value
+        self.watch = MessageWatch(self.storage, "user2")
+        self.callback = self.storage.watch_user_messages.call_args[0][1]
+        self.messages = [attach_seq(Message("user1", "user2", "hi"), x + 1)
+                         for x in range(4)]
+
+    def test_iterates_batches(self):
+        """Tests messages saved before are read by page, batches passed
+        to callback are iterated in order, batches queued meanwhile are
+        merged, broken watch raises error.
+        """
+        self.storage.watch_user_messages.assert_called_once_with(
+            "user2", self.callback, with_pending=False)
+        self.storage.get_user_messages_page.return_value = self.messages[:1]
+        batches = iter(self.watch)
+        self.assertListEqual(self.messages[:1], next(batches))
+        self.storage.get_user_messages_page.assert_called_once_with(
+            "user2", 0, 100)
+        self.callback(self.messages[1:2])
+        self.callback(self.messages[:1] + self.messages[2:])
+        self.callback(None)
+        self.assertListEqual(self.messages[1:], next(batches))
+        with self.assertRaises(WatchBrokenError):
+            next(batches)
+
+    def test_close(self):
+        """Tests 'close' method cancels watch and stops iteration."""
+        self.watch.close()
+        self.assertListEqual([], list(self.watch))
+        self.cancel.assert_called_once_with()
+
+    def test_channels_merged(self):
+        """Tests messages of channels after cursors are merged with
+        messages of user.
+        """
+        messages = [attach_seq(Message("user1", "#general", str(x)), x)
+                    for x in range(5)]
+        pages = {"user2": self.messages[:1], "#general": messages[2:4]}
+        self.storage.get_user_messages_page.side_effect = (
+            lambda login, after_seq, limit: pages[login])
+        watch = MessageWatch(self.storage, "user2", {"general": 1})
+        self.storage.watch_user_messages.assert_called_with(
+            "#general", mock.ANY, with_pending=False)
+        channel_callback = self.storage.watch_user_messages.call_args[0][1]
+        batches = iter(watch)
+        self.assertListEqual(self.messages[:1] + messages[2:4],
+                             next(batches))
+        self.storage.get_user_messages_page.assert_called_with(
+            "#general", 1, 100)
+        channel_callback(messages[3:])
+        self.assertListEqual(messages[4:], next(batches))
+        watch.close()
+        self.assertEqual(2, self.cancel.call_count)
+
+    def test_reads_pages(self):
+        """Tests mailbox is read page by page as the consumer takes
+        batches, messages pushed meanwhile are read with them and
+        messages not fitting in buffer are read again.
+        """
+        stored = self.messages[:3]
+        self.storage.get_user_messages_page.side_effect = (
+            lambda login, after_seq, limit: [
+                message for message in stored
+                if message_seq(message) > after_seq][:limit])
+        big = [attach_seq(Message("user1", "user2", "x" * 400), x)
+               for x in (5, 6)]
+        watch = MessageWatch(self.storage, "user2", max_buffered_bytes=600)
+        callback = self.storage.watch_user_messages.call_args[0][1]
+        batches = iter(watch)
+        self.assertListEqual(self.messages[:2], next(batches))
+        stored.extend(self.messages[3:] + big)
+        callback(self.messages[3:])
+        callback(big)
+        self.assertListEqual(self.messages[2:], next(batches))
+        self.assertListEqual(big[:1], next(batches))
+        self.assertListEqual(big[1:], next(batches))
+        self.assertListEqual(
+            [mock.call("user2", 0, 2), mock.call("user2", 2, 2),
+             mock.call("user2", 4, 2), mock.call("user2", 5, 2)],
+            self.storage.get_user_messages_page.call_args_list)
+        watch.close()
+
+    def test_disconnect_timer(self):
+        """Tests subscriber which stays behind without taking batches is
+        disconnected by timer with "disconnect" policy.
+        """
+        self.storage.get_user_messages_page.return_value = self.messages[:1]
+        disconnected = threading.Event()
+        listener = mock.Mock()
+        watch = MessageWatch(self.storage, "user2", max_buffered_bytes=600,
+                             slow_consumer_policy="disconnect",
+                             slow_consumer_timeout=0.01, listener=listener,
+                             on_disconnect=disconnected.set)
+        callback = self.storage.watch_user_messages.call_args[0][1]
+        batches = iter(watch)
+        self.assertListEqual(self.messages[:1], next(batches))
+        callback([attach_seq(Message("user1", "user2", "x" * 400), x)
+                  for x in (2, 3)])
+        self.assertTrue(disconnected.wait(5))
+        listener.slow_consumer.assert_has_calls(
+            [mock.call("paused"), mock.call("disconnected")])
+        self.cancel.assert_called_once_with()
+        with self.assertRaises(SlowConsumerError):
+            next(batches)
+
+
+class TestDeliveryBuffer(TestCase):
+    """Tests DeliveryBuffer class."""
+
+    def setUp(self):
+        """Creates messages of 10 bytes and buffer of two of them."""
+        self.messages = [
+            attach_seq(Message("a", "b", "cdefg", message_id=str(x) * 3),
+                       x + 1)
+            for x in range(3)]
+        self.listener = mock.Mock()
+        self.buffer = DeliveryBuffer(20, listener=self.listener)
+
+    def test_push_and_take(self):
+        """Tests messages are buffered up to max bytes and taken, moving
+        positions of their mailboxes, messages up to position are not
+        buffered again.
+        """
+        self.buffer.push(self.messages[:2])
+        self.assertEqual(20, self.buffer.size)
+        self.listener.buffered.assert_called_once_with(20, 20)
+        self.assertListEqual(self.messages[:2], self.buffer.take())
+        self.assertEqual({"b": 2}, self.buffer.positions)
+        self.listener.buffered.assert_called_with(-20, 0)
+        self.assertEqual(0, self.buffer.size)
+        self.buffer.push(self.messages[:2])
+        self.assertListEqual([], self.buffer.messages)
+
+    def test_overflow(self):
+        """Tests messages are buffered while they fit, mailbox whose
+        messages do not fit is lagging and its messages are not buffered
+        until it is read by pages.
+        """
+        self.buffer.push(self.messages)
+        self.assertListEqual(self.messages[:2], self.buffer.messages)
+        self.assertEqual({"b"}, self.buffer.lagging)
+        self.assertIsNotNone(self.buffer.behind_since)
+        self.listener.slow_consumer.assert_called_once_with("paused")
+        self.buffer.take()
+        self.buffer.push(self.messages[2:])
+        self.assertListEqual([], self.buffer.messages)
+        self.buffer.resume()
+        self.assertIsNone(self.buffer.behind_since)
+
+    def test_pages(self):
+        """Tests mailbox is caught up once its last page fits and no
+        messages were pushed while it was read.
+        """
+        buffer = DeliveryBuffer(20, positions={"b": 0})
+        self.assertEqual({"b"}, buffer.lagging)
+        self.assertEqual(1, buffer.page_limit())
+        buffer.start_page("b")
+        buffer.add_page("b", self.messages[:1], 1)
+        self.assertEqual({"b"}, buffer.lagging)
+        buffer.take()
+        buffer.start_page("b")
+        buffer.push(self.messages[1:])
+        buffer.add_page("b", self.messages[1:], 5)
+        self.assertEqual({"b"}, buffer.lagging)
+        self.assertEqual(0, buffer.page_limit())
+        buffer.take()
+        buffer.start_page("b")
+        buffer.add_page("b", [], 5)
+        self.assertEqual(set(), buffer.lagging)
+        self.assertEqual(100, DeliveryBuffer().page_limit())
+
+    @mock.patch("chat_storage.time.monotonic", side_effect=[10, 15, 20, 41])
+    def test_disconnect(self, mock_monotonic):
+        """Tests subscriber behind longer than timeout is disconnected
+        with "disconnect" policy.
+        """
+        buffer = DeliveryBuffer(10, "disconnect", 20, self.listener)
+        buffer.push(self.messages[:2])
+        buffer.resume()
+        buffer.push([attach_seq(Message("a", "c", "cdefg", message_id="000"),
+                                1)])
+        with self.assertRaises(SlowConsumerError):
+            buffer.resume()
+        self.listener.slow_consumer.assert_called_with("disconnected")
+
+    def test_unknown_policy(self):
+        """Tests unknown slow consumer policy is not accepted."""
+        with self.assertRaises(ValueError):
+            DeliveryBuffer(10, "drop")
+
+
+class TestMessageCompactor(TestCase):
+    """Tests MessageCompactor class."""
+
+    def test_compacts_until_stopped(self):
+        """Tests storage is compacted every interval, failures are
+        retried on the next one.
+        """
+        storage = mock.Mock()
+        compacted = threading.Event()
+
+        def compact_messages():
+            if storage.compact_messages.call_count == 2:
+                compacted.set()
+                return 1
+            raise RuntimeError("storage is unavailable")
+
+        storage.compact_messages.side_effect = compact_messages
+        compactor = MessageCompactor(storage, interval=0.001)
+        compactor.start()
+        self.assertTrue(compacted.wait(1))
+        compactor.stop()
+        calls = storage.compact_messages.call_count
+        time.sleep(0.01)
+        self.assertEqual(calls, storage.compact_messages.call_count)
@@ -0,0 +1,110 @@
+"""Python module for testing chat_wal module."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from chat_storage import Message
+from chat_wal import WalStorage, WriteAheadLog
+from storages.memory_storage import MemoryStorage
+
+
+class TestWriteAheadLog(TestCase):
+    """Tests WriteAheadLog class."""
+
+    def setUp(self):
+        """Creates log directory and messages to be used by the tests."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.messages = [Message("userA", "userB", f"message {x}", x)
+                         for x in range(10)]
+
+    def test_append_read(self):
+        """Tests appended messages are read in order."""
+        wal = WriteAheadLog(self.directory)
+        wal.append(self.messages[:4])
+        wal.append(self.messages[4:])
+        messages, position = wal.read(wal.checkpoint, 6)
+        self.assertEqual(self.messages[:6], messages)
+        messages, position = wal.read(position, 100)
+        self.assertEqual(self.messages[6:], messages)
+        self.assertEqual(wal.synced, position)
+        wal.close()
+
+    def test_segments(self):
+        """Tests log rolls over to new segments and removes the ones
+        before checkpoint.
+        """
+        wal = WriteAheadLog(self.directory, segment_size=128)
+        wal.append(self.messages)
+        self.assertGreater(wal.synced[0], 2)
+        messages, position = wal.read(wal.checkpoint, 100)
+        self.assertEqual(self.messages, messages)
+        wal.set_checkpoint(position)
+        self.assertEqual(1, len([name for name in os.listdir(self.directory)
+                                 if name.endswith(".wal")]))
+        wal.close()
+
+    def test_message_too_big(self):
+        """Tests message bigger than segment is refused."""
+        wal = WriteAheadLog(self.directory, segment_size=64)
+        with self.assertRaises(ValueError):
+            wal.append([Message("userA", "userB", "x" * 100)])
+        wal.close()
+
+    def test_reopen(self):
+        """Tests log reopened from checkpoint keeps unread messages and
+        drops torn record at its end.
+        """
+        wal = WriteAheadLog(self.directory)
+        wal.append(self.messages)
+        messages, position = wal.read(wal.checkpoint, 3)
+        wal.set_checkpoint(position)
+        end = wal.synced
+        data = wal._segments[end[0]]
+        data[end[1]:end[1] + 12] = b"\x20\x00\x00\x00torn-rec"
+        wal.close()
+        wal = WriteAheadLog(self.directory)
+        self.assertEqual(end, wal.synced)
+        messages, position = wal.read(wal.checkpoint, 100)
+        self.assertEqual(self.messages[3:], messages)
+        wal.append(self.messages[:1])
+        messages, position = wal.read(position, 100)
+        self.assertEqual(self.messages[:1], messages)
+        wal.close()
+
+
+class TestWalStorage(TestCase):
+    """Tests WalStorage class."""
+
+    def setUp(self):
+        """Creates log directory and wrapped storage."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.memory = MemoryStorage()
+        self.messages = [Message("userA", "userB", f"message {x}", x)
+                         for x in range(5)]
+
+    def test_messages_drained(self):
+        """Tests messages written to log are saved to storage."""
+        storage = WalStorage(self.memory, self.directory)
+        storage.create_message(self.messages[0])
+        storage.create_messages(self.messages[1:])
+        self.assertTrue(storage.flush(timeout=5))
+        self.assertEqual(self.messages, storage.get_user_messages("userB"))
+        storage.close()
+
+    @mock.patch("chat_wal.DRAIN_RETRY_DELAY", 0.001)
+    def test_replay_after_restart(self):
+        """Tests messages not saved before close are saved after restart."""
+        failing = mock.Mock()
+        failing.create_messages.side_effect = ConnectionError()
+        storage = WalStorage(failing, self.directory)
+        storage.create_messages(self.messages)
+        self.assertFalse(storage.flush(timeout=0.05))
+        storage.close()
+        storage = WalStorage(self.memory, self.directory)
+        self.assertTrue(storage.flush(timeout=5))
+        self.assertEqual(self.messages, self.memory.get_user_messages("userB"))
+        storage.close()
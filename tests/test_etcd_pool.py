@@ -0,0 +1,78 @@
+"""Python module for testing etcd_pool module."""
+
+from unittest import TestCase, mock
+
+import grpc
+from etcd3.exceptions import ConnectionFailedError, PreconditionFailedError
+
+from storages.etcd_pool import EtcdClientPool, is_transient, parse_endpoints
+
+
+class TestParseEndpoints(TestCase):
+    """Tests parse_endpoints function."""
+
+    def test_parse_endpoints(self):
+        """Tests hosts with and without port."""
+        self.assertEqual([("etcd1", 2379), ("etcd2", 2380)],
+                         parse_endpoints("etcd1, etcd2:2380", "2379"))
+
+
+class TestEtcdClientPool(TestCase):
+    """Tests EtcdClientPool class."""
+
+    def setUp(self):
+        """Creates pool of mock clients over two endpoints."""
+        self.client_factory = mock.Mock(side_effect=lambda host, port:
+                                        mock.Mock(host=host))
+        self.pool = EtcdClientPool([("etcd1", 2379), ("etcd2", 2379)],
+                                   self.client_factory, size=3, backoff=0)
+
+    def test_clients_spread_over_endpoints(self):
+        """Tests clients are connected to endpoints in turn."""
+        self.assertEqual(["etcd1", "etcd2", "etcd1"],
+                         [pooled.client.host for pooled in self.pool.clients])
+
+    def test_call_round_robin(self):
+        """Tests idle clients are used in turn."""
+        used = [self.pool.call(lambda client: client) for x in range(4)]
+        clients = [pooled.client for pooled in self.pool.clients]
+        self.assertEqual(clients + clients[:1], used)
+
+    def test_call_least_loaded(self):
+        """Tests nested call doesn't get client busy with outer call."""
+        outer, inner = self.pool.call(
+            lambda outer: (outer, self.pool.call(lambda inner: inner)))
+        self.assertIsNot(outer, inner)
+        self.assertEqual([0, 0, 0],
+                         [pooled.in_flight for pooled in self.pool.clients])
+
+    def test_call_fails_over(self):
+        """Tests failed client is reconnected to the next endpoint."""
+        function = mock.Mock(side_effect=[ConnectionFailedError(), "result"])
+        self.assertEqual("result", self.pool.call(function))
+        failed = function.call_args_list[0][0][0]
+        failed.close.assert_called_once_with()
+        self.assertEqual("etcd2", self.pool.clients[0].client.host)
+        self.assertEqual(4, self.client_factory.call_count)
+
+    def test_call_retries_exhausted(self):
+        """Tests the last transient error is raised after retries."""
+        function = mock.Mock(side_effect=ConnectionFailedError())
+        with self.assertRaises(ConnectionFailedError):
+            self.pool.call(function)
+        self.assertEqual(self.pool.retries + 1, function.call_count)
+
+    def test_call_not_transient(self):
+        """Tests other errors are raised without retry."""
+        function = mock.Mock(side_effect=PreconditionFailedError())
+        with self.assertRaises(PreconditionFailedError):
+            self.pool.call(function)
+        function.assert_called_once()
+
+    def test_is_transient_rpc_error(self):
+        """Tests unavailable gRPC error is transient."""
+        error = grpc.RpcError()
+        error.code = lambda: grpc.StatusCode.UNAVAILABLE
+        self.assertTrue(is_transient(error))
+        error.code = lambda: grpc.StatusCode.INVALID_ARGUMENT
+        self.assertFalse(is_transient(error))
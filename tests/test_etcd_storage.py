@@ -2,7 +2,9 @@
 
 from unittest import TestCase, mock
 
-from chat_storage import Message, User
+from etcd3.events import DeleteEvent, PutEvent
+
+from chat_storage import Channel, Message, User, message_seq
 from storages.etcd_storage import EtcdStorage
 
 
@@ -15,9 +17,11 @@ class TestEtcdStorage(TestCase):
         cls.user1 = User(login="userA", full_name="AA AAA")
         cls.user2 = User(login="userB", full_name="BB BBB")
         cls.message1 = Message(
-            login_from="user1", login_to="userB", body="Hello!", created_at=1234)
+            login_from="user1", login_to="userB", body="Hello!", created_at=1234,
+            message_id="00000000001234000000-node")
         cls.message2 = Message(
-            login_from="user2", login_to="userB", body="Hello, you!", created_at=5678)
+            login_from="user2", login_to="userB", body="Hello, you!", created_at=5678,
+            message_id=None)
 
     @mock.patch("storages.etcd_storage.etcd3")
     def setUp(self, mock_etcd):
@@ -26,20 +30,92 @@ class TestEtcdStorage(TestCase):
         mock_etcd.client.return_value = self.client
         self.storage = EtcdStorage(host="localhost", port=2379)
 
+    @mock.patch("storages.etcd_storage.etcd3")
+    def test_init_pool(self, mock_etcd):
+        """Tests pool clients are connected to every etcd host."""
+        EtcdStorage(host="etcd1,etcd2:2380", port="2379", pool_size=2)
+        mock_etcd.client.assert_has_calls([
+            mock.call(host="etcd1", port=2379),
+            mock.call(host="etcd2", port=2380)])
+
     def test_create_user(self):
         """Tests 'create_user' method."""
         self.client.put = mock.Mock()
         self.storage.create_user(self.user1)
         self.client.put.assert_called_once_with(
-            "user.userA", '{"login": "userA", "full_name": "AA AAA"}')
+            "user.userA", b'{"login": "userA", "full_name": "AA AAA"}')
 
     def test_create_message(self):
         """Tests 'create_message' method."""
         self.client.put = mock.Mock()
         self.storage.create_message(self.message1)
         self.client.put.assert_called_once_with(
-            "message.userB.user1.1234",
-            '{"login_from": "user1", "login_to": "userB", "body": "Hello!", "created_at": 1234}')
+            "message.userB.00000000001234000000-node",
+            b'{"login_from": "user1", "login_to": "userB", "body": "Hello!", ' +
+            b'"created_at": 1234, "message_id": "00000000001234000000-node"}',
+            lease=None)
+
+    @mock.patch("storages.etcd_storage.time.time", return_value=1000.0)
+    def test_create_message_ttl(self, mock_time):
+        """Tests messages expiring in one bucket share one lease, which
+        ends with the bucket.
+        """
+        self.storage.message_ttl = 100
+        self.storage.create_message(self.message1)
+        self.storage.create_messages([self.message2])
+        self.client.lease.assert_called_once_with(140)
+        self.assertIs(self.client.lease.return_value,
+                      self.client.put.call_args[1]["lease"])
+        self.client.transactions.put.assert_called_once_with(
+            mock.ANY, mock.ANY, lease=self.client.lease.return_value)
+        mock_time.return_value = 1150.0
+        self.storage.create_message(self.message1)
+        self.client.lease.assert_called_with(110)
+        self.assertEqual([1260], list(self.storage._message_leases))
+
+    @mock.patch("storages.etcd_storage.etcd3")
+    def test_create_message_protobuf(self, mock_etcd):
+        """Tests 'create_message' method with protobuf codec, the value
+        is readable by 'get_user_messages'.
+        """
+        mock_etcd.client.return_value = self.client
+        storage = EtcdStorage(host="localhost", port=2379, codec="protobuf")
+        storage.create_message(self.message1)
+        key, value = self.client.put.call_args[0]
+        self.assertEqual("message.userB.00000000001234000000-node", key)
+        self.assertEqual(b"\x01", value[:1])
+        self.client.get_prefix_response.return_value = mock.Mock(
+            kvs=[mock.Mock(value=value, mod_revision=4)])
+        self.assertListEqual([self.message1],
+                             storage.get_user_messages("userB"))
+
+    def test_get_users_page(self):
+        """Tests 'get_users_page' method reads limited range of keys."""
+        self.client.kvstub.Range.return_value = mock.Mock(kvs=[
+            mock.Mock(value='{"login": "userB", "full_name": "BB BBB"}'.encode())])
+        users = self.storage.get_users_page("userA", 1, "user")
+        self.assertListEqual([self.user2], users)
+        range_request = self.client.kvstub.Range.call_args[0][0]
+        self.assertEqual(b"user.userA\0", range_request.key)
+        self.assertEqual(b"user.uses", range_request.range_end)
+        self.assertEqual(1, range_request.limit)
+
+    def test_get_users_page_prefix_start(self):
+        """Tests 'get_users_page' method starts at login prefix."""
+        self.client.kvstub.Range.return_value = mock.Mock(kvs=[])
+        self.storage.get_users_page("", 10, "user")
+        range_request = self.client.kvstub.Range.call_args[0][0]
+        self.assertEqual(b"user.user", range_request.key)
+
+    def test_create_messages(self):
+        """Tests 'create_messages' method puts batch in transaction."""
+        self.client.transactions.put.side_effect = \
+            lambda key, value, lease: key
+        self.storage.create_messages([self.message1, self.message2])
+        self.client.transaction.assert_called_once_with(
+            compare=[], success=["message.userB.00000000001234000000-node",
+                                 "message.userB.user2.5678"], failure=[])
+        self.client.put.assert_not_called()
 
     def test_get_users_list(self):
         """Tests 'users_list' method."""
@@ -52,19 +128,291 @@ class TestEtcdStorage(TestCase):
         self.assertListEqual(expected, users)
 
     def test_get_user_messages(self):
-        """Tests 'get_user_messages' method."""
-        self.client.get_prefix.return_value = [
-            ('{"login_from": "user1","login_to": "userB",\
-            "body": "Hello!","created_at": 1234}'.encode(), "message1"),
-            ('{"login_from": "user2", "login_to": "userB",\
-            "body": "Hello, you!", "created_at": 5678}'.encode(), "user2")]
+        """Tests 'get_user_messages' method reads messages in order of
+        mod revisions, which are their seqs, including message saved
+        without id.
+        """
+        self.client.get_prefix_response.return_value = mock.Mock(kvs=[
+            mock.Mock(value='{"login_from": "user1","login_to": "userB",\
+            "body": "Hello!","created_at": 1234,\
+            "message_id": "00000000001234000000-node"}'.encode(),
+                      mod_revision=4),
+            mock.Mock(value='{"login_from": "user2", "login_to": "userB",\
+            "body": "Hello, you!", "created_at": 5678}'.encode(),
+                      mod_revision=6)])
         messages = self.storage.get_user_messages("userB")
         expected = [self.message1, self.message2]
-        self.client.get_prefix.assert_called_with("message.userB.")
+        self.client.get_prefix_response.assert_called_with(
+            "message.userB.", sort_order="ascend", sort_target="mod")
         self.assertListEqual(expected, messages)
+        self.assertListEqual([4, 6], [message_seq(message)
+                                      for message in messages])
+
+    def test_get_user_messages_page(self):
+        """Tests 'get_user_messages_page' method lets etcd filter messages
+        after seq, sort them by mod revisions and limit them.
+        """
+        self.client.kvstub.Range.return_value = mock.Mock(kvs=[mock.Mock(
+            value=self.storage.codec.encode_message(self.message1),
+            mod_revision=9)])
+        messages = self.storage.get_user_messages_page("userB", 8, 50)
+        self.assertListEqual([self.message1], messages)
+        self.assertEqual(9, message_seq(messages[0]))
+        request = self.client.kvstub.Range.call_args[0][0]
+        self.assertEqual(b"message.userB.", request.key)
+        self.assertEqual(b"message.userB/", request.range_end)
+        self.assertEqual((9, 50), (request.min_mod_revision, request.limit))
+        self.assertEqual(request.MOD, request.sort_target)
+        self.assertEqual(request.ASCEND, request.sort_order)
 
     def test_delete_user_message(self):
         """Tests 'delete_user_message' method."""
         self.client.delete = mock.Mock()
         self.storage.delete_user_message(self.message1)
-        self.client.delete.assert_called_once_with("message.userB.user1.1234")
+        self.client.delete.assert_called_once_with(
+            "message.userB.00000000001234000000-node")
+
+    @mock.patch("storages.etcd_storage.MAX_TXN_OPS", 2)
+    def test_ack_user_messages(self):
+        """Tests 'ack_user_messages' method reads keys modified up to
+        cursor revision and deletes them in transactions if they are not
+        modified since, keys of failed transaction one by one.
+        """
+        self.client.kvstub.Range.return_value = mock.Mock(kvs=[
+            mock.Mock(key=b"message.userB.1"),
+            mock.Mock(key=b"message.userB.2"),
+            mock.Mock(key=b"message.userB.3")])
+        self.client.transactions = mock.MagicMock()
+        mod = self.client.transactions.mod.return_value
+        mod.__lt__.return_value = "mod < 8"
+        self.client.transaction.side_effect = [
+            (False, []), (True, []), (False, []), (True, [])]
+        self.assertEqual(2, self.storage.ack_user_messages("userB", 7))
+        range_request = self.client.kvstub.Range.call_args[0][0]
+        self.assertEqual(b"message.userB.", range_request.key)
+        self.assertEqual(b"message.userB/", range_request.range_end)
+        self.assertEqual(7, range_request.max_mod_revision)
+        self.assertTrue(range_request.keys_only)
+        self.assertListEqual(
+            [2, 1, 1, 1], [len(call[1]["compare"]) for call
+                           in self.client.transaction.call_args_list])
+        self.assertListEqual(
+            [b"message.userB.1", b"message.userB.2", b"message.userB.1",
+             b"message.userB.2", b"message.userB.3"],
+            [call[0][0] for call
+             in self.client.transactions.delete.call_args_list])
+        mod.__lt__.assert_called_with(8)
+
+    def test_compact_messages(self):
+        """Tests 'compact_messages' deletes the oldest messages over
+        mailbox size of every recipient found among message keys, history
+        is not compacted unless it is enabled.
+        """
+        self.storage.mailbox_size = 2
+        message_value = self.storage.codec.encode_message(self.message1)
+        self.client.kvstub.Range.side_effect = [
+            mock.Mock(kvs=[mock.Mock(value=message_value)]),
+            mock.Mock(count=5),
+            mock.Mock(kvs=[mock.Mock(key=b"message.userB.1"),
+                           mock.Mock(key=b"message.userB.3")]),
+            mock.Mock(kvs=[])]
+        self.client.kvstub.DeleteRange.return_value = mock.Mock(deleted=3)
+        self.assertEqual(3, self.storage.compact_messages())
+        scan_requests = [call[0][0] for call in
+                         self.client.kvstub.Range.call_args_list[::3]]
+        self.assertEqual([b"message.", b"message.userB/"],
+                         [request.key for request in scan_requests])
+        oldest_request = self.client.kvstub.Range.call_args_list[2][0][0]
+        self.assertEqual(3, oldest_request.limit)
+        delete_request = self.client.kvstub.DeleteRange.call_args[0][0]
+        self.assertEqual(b"message.userB.", delete_request.key)
+        self.assertEqual(b"message.userB.3\0", delete_request.range_end)
+        self.client.compact.assert_not_called()
+
+    def test_compact_history(self):
+        """Tests enabled history compaction compacts up to revision of
+        the previous compaction.
+        """
+        self.storage.compact_history = True
+        self.client.kvstub.Range.side_effect = [
+            mock.Mock(header=mock.Mock(revision=10)),
+            mock.Mock(header=mock.Mock(revision=20))]
+        self.assertEqual(0, self.storage.compact_messages())
+        self.client.compact.assert_not_called()
+        self.assertEqual(0, self.storage.compact_messages())
+        self.client.compact.assert_called_once_with(10)
+
+    def test_watch_user_messages(self):
+        """Tests 'watch_user_messages' method."""
+        self.client.get_prefix_response.return_value = mock.Mock(
+            kvs=[mock.Mock(value='{"login_from": "user1", "login_to": "userB",\
+            "body": "Hello!", "created_at": 1234,\
+            "message_id": "00000000001234000000-node"}'.encode(),
+                           mod_revision=5)],
+            header=mock.Mock(revision=7))
+        self.client.add_watch_prefix_callback.return_value = 3
+        callback = mock.Mock()
+        cancel = self.storage.watch_user_messages("userB", callback)
+        callback.assert_called_once_with([self.message1])
+        self.assertEqual(5, message_seq(callback.call_args[0][0][0]))
+        self.client.get_prefix_response.assert_called_with(
+            "message.userB.", sort_order="ascend", sort_target="mod")
+        self.client.add_watch_prefix_callback.assert_called_once_with(
+            "message.userB.", mock.ANY, start_revision=8)
+
+        on_watch_response = self.client.add_watch_prefix_callback.call_args[0][1]
+        put_event = PutEvent(mock.Mock(kv=mock.Mock(value='{"login_from": "user2",\
+            "login_to": "userB", "body": "Hello, you!", "created_at": 5678}'.encode(),
+            mod_revision=8)))
+        on_watch_response(mock.Mock(events=[put_event,
+                                            DeleteEvent(mock.Mock())]))
+        callback.assert_called_with([self.message2])
+        self.assertEqual(8, message_seq(callback.call_args[0][0][0]))
+        on_watch_response(Exception("etcd connection failed"))
+        callback.assert_called_with(None)
+        cancel()
+        self.client.cancel_watch.assert_called_once_with(3)
+
+    def test_watch_new_messages(self):
+        """Tests watch without pending messages passes none of the pending
+        ones, only revision to start watch from is read by range without
+        keys.
+        """
+        self.client.get_prefix_response.return_value = mock.Mock(
+            kvs=[mock.Mock(
+                value=self.storage.codec.encode_message(self.message1),
+                mod_revision=5)],
+            header=mock.Mock(revision=7))
+        self.client.kvstub.Range.return_value = mock.Mock(
+            kvs=[], header=mock.Mock(revision=7))
+        callback = mock.Mock()
+        self.storage.watch_user_messages("userB", callback, with_pending=False)
+        callback.assert_not_called()
+        request = self.client.kvstub.Range.call_args[0][0]
+        self.assertEqual(b"message.userB.", request.key)
+        self.assertEqual(b"message.userB/", request.range_end)
+        self.assertTrue(request.count_only)
+        self.client.add_watch_prefix_callback.assert_called_once_with(
+            "message.userB.", mock.ANY, start_revision=8)
+
+    def test_delete_user_messages(self):
+        """Tests 'delete_user_messages' method deletes batch in
+        transactions of limited size.
+        """
+        self.client.transactions.delete.side_effect = lambda key: key
+        messages = [self.message1] * 130
+        self.storage.delete_user_messages(messages)
+        self.client.transaction.assert_has_calls([
+            mock.call(compare=[], success=["message.userB.00000000001234000000-node"] * 128,
+                      failure=[]),
+            mock.call(compare=[], success=["message.userB.00000000001234000000-node"] * 2,
+                      failure=[])])
+        self.client.delete.assert_not_called()
+
+    def test_watch_users(self):
+        """Tests 'watch_users' method."""
+        self.client.add_watch_prefix_callback.return_value = 4
+        callback = mock.Mock()
+        cancel = self.storage.watch_users(callback)
+        self.client.add_watch_prefix_callback.assert_called_once_with(
+            "user.", mock.ANY)
+        self.client.add_watch_prefix_callback.call_args[0][1](mock.Mock())
+        callback.assert_called_once_with()
+        cancel()
+        self.client.cancel_watch.assert_called_once_with(4)
+
+    @mock.patch("storages.etcd_storage.threading.Thread")
+    def test_watch_users_broken(self, mock_thread):
+        """Tests broken users watch is started again in background and
+        callback is called once it is back.
+        """
+        self.client.add_watch_prefix_callback.side_effect = [4, 5]
+        callback = mock.Mock()
+        cancel = self.storage.watch_users(callback)
+        on_watch_response = self.client.add_watch_prefix_callback.call_args[0][1]
+        on_watch_response(Exception("stream broken"))
+        callback.assert_called_once_with()
+        mock_thread.call_args[1]["target"]()
+        self.assertEqual(2, self.client.add_watch_prefix_callback.call_count)
+        self.assertEqual(2, callback.call_count)
+        cancel()
+        self.client.cancel_watch.assert_called_once_with(5)
+
+    @mock.patch("storages.etcd_storage.threading.Thread")
+    def test_register_subscriber(self, mock_thread):
+        """Tests subscriber is saved under one node lease and deleted
+        after the last subscription if it still belongs to the node.
+        """
+        lease = self.client.lease.return_value
+        cancel1 = self.storage.register_subscriber("userB", "node1")
+        cancel2 = self.storage.register_subscriber("userB", "node1")
+        self.client.lease.assert_called_once_with(10)
+        mock_thread.return_value.start.assert_called_once_with()
+        self.client.put.assert_called_with("subscriber.userB", "node1",
+                                           lease=lease)
+        cancel1()
+        self.client.transaction.assert_not_called()
+        cancel2()
+        self.client.transactions.value.assert_called_once_with(
+            "subscriber.userB")
+        self.client.transaction.assert_called_once_with(
+            compare=[mock.ANY],
+            success=[self.client.transactions.delete.return_value],
+            failure=[])
+
+    def test_get_subscriber_node(self):
+        """Tests 'get_subscriber_node' method."""
+        self.client.get.return_value = (b"node1", mock.Mock())
+        self.assertEqual("node1", self.storage.get_subscriber_node("userB"))
+        self.client.get.assert_called_once_with("subscriber.userB")
+        self.client.get.return_value = (None, None)
+        self.assertIsNone(self.storage.get_subscriber_node("userB"))
+
+    def test_channel(self):
+        """Tests channel is saved and read by channel key."""
+        self.storage.create_channel(Channel("general", "General"))
+        self.client.put.assert_called_once_with(
+            "channel.general", b'{"name": "general", "title": "General"}')
+        self.client.get.return_value = (self.client.put.call_args[0][1],
+                                        mock.Mock())
+        self.assertEqual(Channel("general", "General"),
+                         self.storage.get_channel("general"))
+        self.client.get.assert_called_once_with("channel.general")
+
+    def test_join_channel(self):
+        """Tests member key is put with cursor at the current revision
+        only if it doesn't exist.
+        """
+        self.client.kvstub.Range.return_value = mock.Mock(
+            header=mock.Mock(revision=5))
+        self.storage.join_channel("general", "userA")
+        self.client.transactions.create.assert_called_once_with(
+            "member.userA.general")
+        self.client.transactions.put.assert_called_once_with(
+            "member.userA.general", "00000000000000000005")
+        self.storage.leave_channel("general", "userA")
+        self.client.delete.assert_called_once_with("member.userA.general")
+
+    def test_get_user_channels(self):
+        """Tests channels of user are read with cursors by one prefix."""
+        self.client.get_prefix.return_value = [
+            (b"00000000000000000005", mock.Mock(key=b"member.userA.general")),
+            (b"00000000000000000017", mock.Mock(key=b"member.userA.dev.team"))]
+        self.assertEqual({"general": 5, "dev.team": 17},
+                         self.storage.get_user_channels("userA"))
+        self.client.get_prefix.assert_called_once_with("member.userA.")
+
+    def test_set_channel_cursor(self):
+        """Tests cursor is put only over cursor before it."""
+        self.client.transactions = mock.MagicMock()
+        value = self.client.transactions.value.return_value
+        value.__lt__.return_value = "value < 9"
+        self.storage.set_channel_cursor("general", "userA", 9)
+        self.client.transactions.value.assert_called_once_with(
+            "member.userA.general")
+        value.__lt__.assert_called_once_with("00000000000000000009")
+        self.client.transaction.assert_called_once_with(
+            compare=["value < 9"],
+            success=[self.client.transactions.put.return_value], failure=[])
+        self.client.transactions.put.assert_called_once_with(
+            "member.userA.general", "00000000000000000009")
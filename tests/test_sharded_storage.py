@@ -0,0 +1,132 @@
+"""Python module for testing sharded_storage module."""
+
+from unittest import TestCase, mock
+
+from chat_storage import Channel, Message, User, message_seq
+from storages.memory_storage import MemoryStorage
+from storages.sharded_storage import HashRing, ShardedStorage
+
+
+class TestHashRing(TestCase):
+    """Tests HashRing class."""
+
+    def setUp(self):
+        """Creates logins to be placed on the ring."""
+        self.logins = [f"user_{x}" for x in range(10000)]
+
+    def test_get_node_balanced(self):
+        """Tests keys are spread evenly enough over nodes."""
+        ring = HashRing(["a", "b", "c", "d"])
+        counts = {}
+        for login in self.logins:
+            node = ring.get_node(login)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual({"a", "b", "c", "d"}, set(counts))
+        for count in counts.values():
+            self.assertLess(abs(count - 2500), 500)
+
+    def test_add_node_moves_minimal_keys(self):
+        """Tests only keys taken over by the new node are moved."""
+        ring = HashRing(["a", "b", "c", "d"])
+        before = {login: ring.get_node(login) for login in self.logins}
+        ring.add_node("e")
+        moved = [login for login in self.logins
+                 if ring.get_node(login) != before[login]]
+        self.assertTrue(all(ring.get_node(login) == "e" for login in moved))
+        self.assertLess(len(moved), len(self.logins) * 0.3)
+
+
+class TestShardedStorage(TestCase):
+    """Tests ShardedStorage class over memory shards."""
+
+    def setUp(self):
+        """Creates storage of three memory shards."""
+        self.storage = ShardedStorage("a; b; c", None, shard_storage="memory")
+        self.logins = [f"user_{x}" for x in range(30)]
+
+    def test_init(self):
+        """Tests every host group makes a shard of given type."""
+        self.assertEqual(["a", "b", "c"], list(self.storage.shards))
+        for shard in self.storage.shards.values():
+            self.assertIsInstance(shard, MemoryStorage)
+
+    def test_users_routed_and_gathered(self):
+        """Tests users are kept in their shards and listed from all."""
+        for login in self.logins:
+            self.storage.create_user(User(login, "AA AAA"))
+        for login in self.logins:
+            shard = self.storage.get_shard(login)
+            self.assertIn(login, [user.login
+                                  for user in shard.get_users_list()])
+        self.assertEqual(sorted(self.logins), sorted(
+            user.login for user in self.storage.get_users_list()))
+        page = self.storage.get_users_page("user_1", 5)
+        self.assertEqual(sorted(self.logins)[2:7],
+                         [user.login for user in page])
+
+    def test_messages_routed_by_recipient(self):
+        """Tests messages are saved, read and deleted in shard of login_to."""
+        messages = [Message("user_0", login, "Hi!") for login in self.logins]
+        self.storage.create_messages(messages)
+        for message in messages:
+            shard = self.storage.get_shard(message.login_to)
+            self.assertEqual([message],
+                             shard.get_user_messages(message.login_to))
+        self.storage.delete_user_messages(messages)
+        for login in self.logins:
+            self.assertEqual([], self.storage.get_user_messages(login))
+
+    def test_channels_routed(self):
+        """Tests channel is kept in shard of its log and memberships in
+        shards of users, with cursors at the last seq of the log.
+        """
+        channel = Channel("general")
+        self.storage.create_channel(channel)
+        self.assertEqual(channel, self.storage.get_shard(
+            "#general").get_channel("general"))
+        self.assertEqual(channel, self.storage.get_channel("general"))
+        self.storage.create_message(Message("user_0", "#general", "Hi!"))
+        for login in self.logins:
+            self.storage.join_channel("general", login)
+            self.assertEqual({"general": 1}, self.storage.get_shard(
+                login).get_user_channels(login))
+            self.storage.set_channel_cursor("general", login, 9)
+            self.assertEqual({"general": 9}, self.storage.get_shard(
+                login).get_user_channels(login))
+            self.storage.leave_channel("general", login)
+            self.assertEqual({}, self.storage.get_user_channels(login))
+
+    def test_compact_messages(self):
+        """Tests retention options reach every shard, which is compacted."""
+        storage = ShardedStorage("a; b", None, shard_storage="memory",
+                                 message_ttl=60)
+        storage.create_messages([Message("user_0", login, "Hi!", created_at=0)
+                                 for login in self.logins])
+        self.assertEqual(len(self.logins), storage.compact_messages())
+
+    def test_watch_user_messages(self):
+        """Tests watch of user is started in its shard."""
+        callback = mock.Mock()
+        cancel = self.storage.watch_user_messages("user_1", callback)
+        message = Message("user_0", "user_1", "Hi!")
+        self.storage.create_message(message)
+        callback.assert_called_once_with([message])
+        cancel()
+
+    def test_get_user_messages_page(self):
+        """Tests page of messages of user is read from its shard."""
+        message = Message("user_0", "user_1", "Hi!")
+        self.storage.create_message(message)
+        self.assertListEqual([message], self.storage.get_user_messages_page(
+            "user_1", 0, 10))
+        self.assertListEqual([], self.storage.get_user_messages_page(
+            "user_1", message_seq(message), 10))
+
+    def test_watch_users(self):
+        """Tests users watch of every shard calls callback."""
+        callback = mock.Mock()
+        cancel = self.storage.watch_users(callback)
+        for login in self.logins:
+            self.storage.create_user(User(login, "AA AAA"))
+        self.assertEqual(len(self.logins), callback.call_count)
+        cancel()
@@ -0,0 +1,242 @@
+"""Python module for testing sqlite_storage module."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from concurrent import futures
+from unittest import TestCase, mock
+
+from chat_storage import Channel, Message, MessageWatch, User, message_seq
+from storages.sqlite_storage import SqliteStorage
+
+
+class TestSqliteStorage(TestCase):
+    """Tests SqliteStorage class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Creates User and Message objects to be used by the tests."""
+        cls.user1 = User(login="userA", full_name="AA AAA")
+        cls.user2 = User(login="userB", full_name="BB BBB")
+        cls.message1 = Message(
+            login_from="user1", login_to="userB", body="Hello!", created_at=1234)
+        cls.message2 = Message(
+            login_from="user2", login_to="userB", body="Hello, you!", created_at=5678)
+
+    def setUp(self):
+        """Creates storage in temporary directory to be used by the tests."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "chat.db")
+        self.storage = SqliteStorage(self.path)
+
+    def test_close(self):
+        """Tests connections opened by all threads are closed."""
+        with futures.ThreadPoolExecutor(2) as executor:
+            list(executor.map(lambda _: self.storage.get_users_list(),
+                              range(4)))
+        connections = list(self.storage._connections)
+        self.assertGreater(len(connections), 1)
+        self.storage.close()
+        for connection in connections:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connection.execute("SELECT 1")
+
+    def test_users(self):
+        """Tests users are saved once per login and kept in file."""
+        self.storage.create_user(self.user2)
+        self.storage.create_user(self.user1)
+        self.storage.create_user(self.user1)
+        self.assertListEqual([self.user1, self.user2],
+                             self.storage.get_users_list())
+        self.assertListEqual([self.user1, self.user2],
+                             SqliteStorage(self.path).get_users_list())
+
+    def test_get_users_page(self):
+        """Tests pages of users within login prefix."""
+        users = [User(login, "") for login in ("ab", "abc", "abd", "b")]
+        for user in users:
+            self.storage.create_user(user)
+        self.assertListEqual(users[:2], self.storage.get_users_page(limit=2))
+        self.assertListEqual(users[2:], self.storage.get_users_page("abc"))
+        self.assertListEqual(users[1:3],
+                             self.storage.get_users_page("ab", 5, "ab"))
+
+    def test_watch_users(self):
+        """Tests 'watch_users' calls callback on saved user until cancelled."""
+        callback = mock.Mock()
+        cancel = self.storage.watch_users(callback)
+        self.storage.create_user(self.user1)
+        callback.assert_called_once_with()
+        cancel()
+        self.storage.create_user(self.user2)
+        callback.assert_called_once_with()
+
+    def test_subscriber_registry(self):
+        """Tests the latest registered subscriber node is returned."""
+        cancel1 = self.storage.register_subscriber("userB", "node1")
+        cancel2 = self.storage.register_subscriber("userB", "node2")
+        self.assertEqual("node2", self.storage.get_subscriber_node("userB"))
+        cancel2()
+        self.assertEqual("node1", self.storage.get_subscriber_node("userB"))
+        cancel1()
+        self.assertIsNone(self.storage.get_subscriber_node("userB"))
+
+    def test_channels(self):
+        """Tests members of channel get cursors at joining, which are
+        only moved forward.
+        """
+        self.storage.create_channel(Channel("general", "General"))
+        self.assertEqual(Channel("general", "General"),
+                         self.storage.get_channel("general"))
+        self.assertIsNone(self.storage.get_channel("random"))
+        self.storage.join_channel("general", "userB")
+        self.storage.create_message(Message("userB", "#general", "Hi"))
+        self.storage.join_channel("general", "userA")
+        self.storage.create_message(Message("userB", "#general", "Hi"))
+        self.storage.join_channel("general", "userA")
+        self.assertEqual({"general": 0},
+                         self.storage.get_user_channels("userB"))
+        self.assertEqual({"general": 1},
+                         self.storage.get_user_channels("userA"))
+        self.storage.set_channel_cursor("general", "userA", 3)
+        self.storage.set_channel_cursor("general", "userA", 2)
+        self.storage.set_channel_cursor("general", "userC", 3)
+        self.assertEqual({"general": 3},
+                         self.storage.get_user_channels("userA"))
+        self.assertEqual({}, self.storage.get_user_channels("userC"))
+        self.storage.leave_channel("general", "userA")
+        self.assertEqual({}, self.storage.get_user_channels("userA"))
+
+    def test_messages(self):
+        """Tests messages are returned per user in order of saving."""
+        self.storage.create_message(self.message2)
+        self.storage.create_message(self.message1)
+        self.assertListEqual([self.message2, self.message1],
+                             self.storage.get_user_messages("userB"))
+        self.assertListEqual([], self.storage.get_user_messages("userA"))
+
+    def test_create_messages(self):
+        """Tests 'create_messages' passes batch of recipient to watch."""
+        callback = mock.Mock()
+        self.storage.watch_user_messages("userB", callback)
+        message3 = Message(login_from="userB", login_to="userA", body="Hi!")
+        self.storage.create_messages([self.message1, message3, self.message2])
+        callback.assert_called_once_with([self.message1, self.message2])
+        self.assertListEqual([message3], self.storage.get_user_messages("userA"))
+
+    def test_concurrent_create_message(self):
+        """Tests messages saved from many threads are all kept and
+        notified.
+        """
+        messages = [Message("userA", "userB", str(x)) for x in range(200)]
+        notified = []
+        self.storage.watch_user_messages("userB", notified.extend)
+        with futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(self.storage.create_message, messages))
+        self.assertCountEqual(messages, notified)
+        self.assertListEqual(notified, self.storage.get_user_messages("userB"))
+
+    def test_create_message_error(self):
+        """Tests error of saving batch is raised to its caller."""
+        with mock.patch.object(self.storage, "_insert",
+                               side_effect=OSError("disk is full")):
+            with self.assertRaises(OSError):
+                self.storage.create_message(self.message1)
+        self.storage.create_message(self.message2)
+        self.assertListEqual([self.message2],
+                             self.storage.get_user_messages("userB"))
+
+    def test_delete_user_messages(self):
+        """Tests 'delete_user_message' and 'delete_user_messages' methods."""
+        self.storage.create_messages([self.message1, self.message2])
+        self.storage.delete_user_message(self.message2)
+        self.assertListEqual([self.message1],
+                             self.storage.get_user_messages("userB"))
+        self.storage.delete_user_messages([self.message1, self.message2])
+        self.assertListEqual([], self.storage.get_user_messages("userB"))
+
+    def test_get_user_messages_page(self):
+        """Tests 'get_user_messages_page' reads messages after seq up to
+        limit.
+        """
+        messages = [Message("userA", "userB", str(x)) for x in range(4)]
+        self.storage.create_messages(messages)
+        self.storage.ack_user_messages("userB", 1)
+        self.assertListEqual(messages[2:3], self.storage.get_user_messages_page(
+            "userB", 2, 1))
+        self.assertListEqual(messages[1:], self.storage.get_user_messages_page(
+            "userB"))
+        self.assertListEqual([], self.storage.get_user_messages_page(
+            "userB", 4))
+
+    def test_ack_user_messages(self):
+        """Tests 'ack_user_messages' deletes messages up to cursor by
+        seq, which messages get in order of saving.
+        """
+        message3 = Message(login_from="user3", login_to="userB", body="Hi!",
+                           message_id=None)
+        self.storage.create_messages([self.message2, self.message1, message3])
+        self.assertListEqual([1, 2, 3], [
+            message_seq(message)
+            for message in self.storage.get_user_messages("userB")])
+        self.assertEqual(1, self.storage.ack_user_messages("userB", 1))
+        self.assertListEqual([self.message1, message3],
+                             self.storage.get_user_messages("userB"))
+        self.assertEqual(1, self.storage.ack_user_messages("userB", 2))
+        self.assertEqual(0, self.storage.ack_user_messages("userA", 9))
+        self.assertListEqual([message3],
+                             self.storage.get_user_messages("userB"))
+
+    @mock.patch("storages.sqlite_storage.time.time", return_value=2000)
+    def test_compact_messages(self, mock_time):
+        """Tests 'compact_messages' deletes messages older than TTL and
+        the oldest messages over mailbox size.
+        """
+        storage = SqliteStorage(self.path, message_ttl=500, mailbox_size=2)
+        messages = [Message("userA", "userC", str(x), 3000) for x in range(4)]
+        storage.create_messages([self.message1, self.message2] + messages)
+        self.assertEqual(3, storage.compact_messages())
+        self.assertListEqual([self.message2],
+                             storage.get_user_messages("userB"))
+        self.assertListEqual(messages[2:], storage.get_user_messages("userC"))
+        self.assertEqual(0, self.storage.compact_messages())
+
+    def test_watch_user_messages(self):
+        """Tests 'watch_user_messages' passes saved and new messages
+        until cancelled.
+        """
+        self.storage.create_message(self.message1)
+        callback = mock.Mock()
+        cancel = self.storage.watch_user_messages("userB", callback)
+        callback.assert_called_once_with([self.message1])
+        self.storage.create_message(self.message2)
+        callback.assert_called_with([self.message2])
+        cancel()
+        self.storage.create_message(self.message1)
+        self.assertEqual(2, callback.call_count)
+
+    def test_watch_new_messages(self):
+        """Tests watch without pending messages passes only new ones."""
+        self.storage.create_message(self.message1)
+        callback = mock.Mock()
+        cancel = self.storage.watch_user_messages("userB", callback,
+                                                  with_pending=False)
+        callback.assert_not_called()
+        self.storage.create_message(self.message2)
+        callback.assert_called_once_with([self.message2])
+        cancel()
+
+    def test_message_watch_wakes_up(self):
+        """Tests MessageWatch blocks until message is created in
+        another thread.
+        """
+        watch = MessageWatch(self.storage, "userB")
+        sender = threading.Timer(
+            0.01, self.storage.create_message, (self.message1,))
+        sender.start()
+        self.assertListEqual([self.message1], next(iter(watch)))
+        watch.close()
+        sender.join()
@@ -1,9 +1,16 @@
 """Python module for testing chat_storage_factory module."""
 
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
 from chat_storage_factory import StorageFactory, UnknownStorageError
 from storages.etcd_storage import EtcdStorage
+from storages.memory_storage import MemoryStorage
+from storages.sharded_storage import ShardedStorage
+from storages.sqlite_storage import SqliteStorage
+from storages.user_cache_storage import UserCacheStorage
 
 
 class TestStorageFactory(TestCase):
@@ -22,6 +29,26 @@ class TestStorageFactory(TestCase):
             "etcd", 'localhost', 2379)
         self.assertIsInstance(storage, EtcdStorage)
 
+    def test_create_memory_storage(self):
+        """Tests 'create_storage' method with memory storage."""
+        storage = StorageFactory.create_storage("memory", None, None)
+        self.assertIsInstance(storage, MemoryStorage)
+
+    def test_create_sharded_storage(self):
+        """Tests 'create_storage' method with sharded storage."""
+        storage = StorageFactory.create_storage(
+            "sharded", "a;b", None, shard_storage="memory")
+        self.assertIsInstance(storage, ShardedStorage)
+        self.assertEqual(2, len(storage.shards))
+
+    def test_create_sqlite_storage(self):
+        """Tests 'create_storage' method with sqlite storage."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage = StorageFactory.create_storage(
+            "sqlite", os.path.join(directory, "chat.db"), None)
+        self.assertIsInstance(storage, SqliteStorage)
+
     def test_storage_type_valid_or_raiserror(self):
         """Tests 'create_storage' method and check raiserror."""
         with self.assertRaises(UnknownStorageError) as err:
@@ -29,3 +56,16 @@ class TestStorageFactory(TestCase):
                 "etty", 'local', 2379)
         expected = "Unknown storage type: etty"
         self.assertEqual(str(err.exception), expected)
+
+    def test_create_storage_with_wrapper(self):
+        """Tests 'create_storage' method wraps storage."""
+        storage = StorageFactory.create_storage(
+            "memory", None, None, ["user_cache"])
+        self.assertIsInstance(storage, UserCacheStorage)
+        self.assertIsInstance(storage.storage, MemoryStorage)
+
+    def test_storage_wrapper_valid_or_raiserror(self):
+        """Tests 'create_storage' method and check raiserror."""
+        with self.assertRaises(UnknownStorageError) as err:
+            StorageFactory.create_storage("memory", None, None, ["cache"])
+        self.assertEqual("Unknown storage wrapper: cache", str(err.exception))
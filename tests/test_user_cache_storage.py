@@ -0,0 +1,83 @@
+"""Python module for testing user_cache_storage module."""
+
+from unittest import TestCase, mock
+
+from chat_storage import User
+from storages.memory_storage import MemoryStorage
+from storages.user_cache_storage import UserCacheStorage
+
+
+class TestUserCacheStorage(TestCase):
+    """Tests UserCacheStorage class."""
+
+    def setUp(self):
+        """Creates cache over storage mock which can not watch users."""
+        self.user1 = User(login="userA", full_name="AA AAA")
+        self.storage = mock.Mock()
+        self.storage.watch_users.return_value = None
+        self.storage.get_users_list.side_effect = lambda: [self.user1]
+        self.cache = UserCacheStorage(self.storage, ttl=10)
+
+    def test_get_users_list_cached(self):
+        """Tests users are read once and the same list is returned."""
+        users = self.cache.get_users_list()
+        self.assertIs(users, self.cache.get_users_list())
+        self.assertListEqual([self.user1], users)
+        self.storage.get_users_list.assert_called_once_with()
+
+    @mock.patch("storages.user_cache_storage.time.monotonic")
+    def test_get_users_list_expired(self, mock_monotonic):
+        """Tests users are read again after ttl without watch."""
+        mock_monotonic.return_value = 100
+        self.cache.get_users_list()
+        mock_monotonic.return_value = 111
+        self.cache.get_users_list()
+        self.assertEqual(2, self.storage.get_users_list.call_count)
+
+    def test_create_user_invalidates(self):
+        """Tests 'create_user' saves user and drops cache."""
+        users = self.cache.get_users_list()
+        self.cache.create_user(self.user1)
+        self.storage.create_user.assert_called_once_with(self.user1)
+        self.assertIsNot(users, self.cache.get_users_list())
+
+    def test_other_methods_passed(self):
+        """Tests message methods are passed to wrapped storage."""
+        self.cache.get_user_messages("userA")
+        self.storage.get_user_messages.assert_called_once_with("userA")
+
+    def test_watch_invalidates(self):
+        """Tests users watch drops cache before ttl."""
+        storage = MemoryStorage()
+        cache = UserCacheStorage(storage, ttl=60)
+        users = cache.get_users_list()
+        self.assertIs(users, cache.get_users_list())
+        storage.create_user(self.user1)
+        self.assertListEqual([self.user1], cache.get_users_list())
+
+    @mock.patch("storages.user_cache_storage.time.monotonic")
+    def test_watched_expired(self, mock_monotonic):
+        """Tests users are read again after ttl even with watch, so
+        changes missed by broken watch are seen.
+        """
+        mock_monotonic.return_value = 100
+        self.storage.watch_users.return_value = mock.Mock()
+        cache = UserCacheStorage(self.storage, ttl=10)
+        cache.get_users_list()
+        cache.get_users_list()
+        mock_monotonic.return_value = 111
+        cache.get_users_list()
+        self.assertEqual(2, self.storage.get_users_list.call_count)
+
+    def test_get_users_page(self):
+        """Tests 'get_users_page' method pages cached users by login."""
+        users = [User(login=login, full_name="") for login in
+                 ["userC", "admin", "userA", "userB"]]
+        self.storage.get_users_list.side_effect = lambda: users
+        first = self.cache.get_users_page("", 2, "user")
+        self.assertListEqual(["userA", "userB"],
+                             [user.login for user in first])
+        second = self.cache.get_users_page("userB", 2, "user")
+        self.assertListEqual(["userC"], [user.login for user in second])
+        self.assertListEqual([], self.cache.get_users_page("", 2, "x"))
+        self.storage.get_users_list.assert_called_once_with()